@@ -0,0 +1,149 @@
+"""Checks of the API against a SQLite database loaded from `tradedata.fixtures`."""
+
+import csv
+import io
+import json
+import asyncio
+
+import pandas as pd
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import create_engine
+
+from tradedata.fixtures import generate_fixtures, load_fixture_database
+from tradedata.api.app import create_app, STREAM_BATCH_SIZE
+from tradedata.api.queries import encode_cursor
+
+ROWS = 300
+
+
+@pytest.fixture(scope = "module")
+def engine(tmp_path_factory):
+    """One month of exports and a control file, loaded with their lookups and rollups."""
+    dest = tmp_path_factory.mktemp("fixtures")
+    generate_fixtures(dest, rows = ROWS, tables = ["exports", "control"])
+    engine = create_engine(f"sqlite:///{dest / 'fixtures.db'}")
+    load_fixture_database(engine, dest)
+    yield engine
+    engine.dispose()
+
+
+def get(engine, path, batch_size = STREAM_BATCH_SIZE, **params):
+    """Requests `path` from an app serving `engine`; returns the status, content type and body."""
+    async def fetch():
+        async with TestClient(TestServer(create_app(engine, workers = 2, batch_size = batch_size))) as client:
+            response = await client.get(path, params = params)
+            return response.status, response.content_type, await response.text()
+    return asyncio.run(fetch())
+
+
+def get_json(engine, path, **params):
+    (status, content_type, body) = get(engine, path, **params)
+    assert status == 200, body
+    return json.loads(body)
+
+
+# FLOWS ########################################################################
+def test_pages_follow_the_keyset(engine):
+    pages = [get_json(engine, "/flows/exports", limit = 128)]
+    while pages[-1]["next"] is not None:
+        pages.append(get_json(engine, "/flows/exports", limit = 128, cursor = pages[-1]["next"]))
+
+    ids = [row["id"] for page in pages for row in page["data"]]
+    assert [len(page["data"]) for page in pages] == [128, 128, ROWS - 256]
+    assert ids == sorted(set(ids)) and len(ids) == ROWS
+    assert pages[0]["next"] == encode_cursor(ids[127])
+    assert "comcode_label" not in pages[0]["data"][0]
+
+
+def test_last_full_page_has_no_next(engine):
+    page = get_json(engine, "/flows/exports", limit = ROWS)
+    assert len(page["data"]) == ROWS
+    assert page["next"] is None
+
+
+def assert_labelled(rows):
+    assert len(rows) == ROWS
+    assert [int(x["id"]) for x in rows] == sorted(int(x["id"]) for x in rows)
+    assert all(x["cod_code_label"] == f"Country {x['cod_code']}" for x in rows)
+    assert all(x["port_code_label"] == f"Port {x['port_code']}" for x in rows)
+    assert all(x["comcode_label"] for x in rows)
+
+
+def test_ndjson_streams_every_batch_with_labels(engine):
+    (status, content_type, body) = get(engine, "/flows/exports.ndjson", batch_size = 64, labels = "true")
+    assert status == 200
+    assert content_type == "application/x-ndjson"
+    assert_labelled([json.loads(x) for x in body.splitlines()])
+
+
+def test_csv_streams_every_batch_with_labels(engine):
+    (status, content_type, body) = get(engine, "/flows/exports.csv", batch_size = 64, labels = "true")
+    assert status == 200
+    assert content_type == "text/csv"
+    rows = list(csv.DictReader(io.StringIO(body)))
+    assert {"comcode_label", "cod_code_label", "port_code_label"} <= set(rows[0])
+    assert_labelled(rows)
+
+
+BAD_PARAMETERS = [
+    {"cursor": "not a cursor"},
+    {"cursor": encode_cursor("abc")},
+    {"comcode": "0101.10"},
+    {"comcode": "010110000"}
+]
+
+# Streams ignore `limit`
+BAD_LIMITS = [{"limit": "0"}, {"limit": "10001"}, {"limit": "abc"}]
+
+
+@pytest.mark.parametrize(("path", "params"),
+    [(x, y) for x in ["/flows/exports", "/aggregates/exports"] for y in BAD_PARAMETERS + BAD_LIMITS]
+    + [(x, y) for x in ["/flows/exports.ndjson", "/flows/exports.csv"] for y in BAD_PARAMETERS])
+def test_bad_parameters_are_400(engine, path, params):
+    (status, content_type, body) = get(engine, path, **params)
+    assert status == 400
+    assert "error" in json.loads(body)
+
+
+def test_table_without_id_is_503(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    pd.DataFrame({"comcode": ["01011000"], "value": [1]}).to_sql("exports", engine, index = False)
+
+    for path in ["/flows/exports", "/flows/exports.csv"]:
+        (status, content_type, body) = get(engine, path)
+        assert status == 503
+        assert "id column" in json.loads(body)["error"]
+
+
+# AGGREGATES ###################################################################
+@pytest.mark.parametrize(("params", "digits", "source"), [
+    ({}, 0, "exports_rollup_chapter"),
+    ({"level": "heading"}, 0, "exports_rollup_heading"),
+    ({}, 4, "exports_rollup_heading"),
+    ({}, 6, "exports_rollup_comcode"),
+    ({"level": "comcode", "by": "country"}, 0, "exports_rollup_comcode"),
+    ({"port": "LHR"}, 0, "exports"),
+    ({"port": None}, 4, "exports")
+])
+def test_aggregates_use_the_smallest_rollup(engine, params, digits, source):
+    # Filter on the first `digits` of the comcode, and the port, of a row that is in the data
+    row = get_json(engine, "/flows/exports", limit = 1)["data"][0]
+    params = {k: row["port_code"] if k == "port" and v is None else v for (k, v) in params.items()}
+    if digits:
+        params["comcode"] = row["comcode"][0:digits]
+
+    result = get_json(engine, "/aggregates/exports", **params)
+    assert result["source"] == source
+    assert result["data"] and not result["truncated"]
+    if digits:
+        assert all(x["code"] == params["comcode"][0:2] for x in result["data"])
+
+
+def test_aggregates_match_the_raw_table(engine):
+    rollup = get_json(engine, "/aggregates/exports", level = "heading")["data"]
+    with engine.connect() as conn:
+        (rows, value) = conn.execute("SELECT COUNT(*), SUM(value) FROM exports").first()
+
+    assert sum(x["row_count"] for x in rollup) == rows == ROWS
+    assert sum(x["value"] for x in rollup) == value
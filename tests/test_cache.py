@@ -0,0 +1,59 @@
+"""Checks of the API result cache's invalidation from the load ledger."""
+
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import create_engine
+
+from tradedata.api.cache import QueryCache
+from tradedata.ledger import create_load_ledger, load_ledger, start_load
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'ledger.db'}")
+    create_load_ledger(engine)
+    yield engine
+    engine.dispose()
+
+
+def finish(engine, load_id, finished_at, months):
+    """Commits the end of a load, with a chosen `finished_at`."""
+    with engine.begin() as conn:
+        conn.execute(load_ledger.update().where(load_ledger.c.id == load_id)
+                     .values(status = "complete", finished_at = finished_at, months = months))
+
+
+@pytest.mark.parametrize("disk", [False, True])
+def test_sync_sees_loads_committed_out_of_order(engine, tmp_path, disk):
+    cache = QueryCache(disk_dir = tmp_path / "cache" if disk else None)
+    cache.put("january", 1, ["imports:2020-01"])
+    cache.put("february", 2, ["imports:2020-02"])
+    cache.sync(engine)
+
+    # A finishes first, but B commits first and a sync runs in between
+    first = start_load(engine, "imports", date(2020, 1, 1))
+    second = start_load(engine, "imports", date(2020, 2, 1))
+    now = datetime.now()
+    finish(engine, second, now, "2020-02")
+    assert cache.sync(engine) == 1
+    assert cache.get("february") is None
+    assert cache.get("january") == 1
+
+    finish(engine, first, now - timedelta(seconds = 1), "2020-01")
+    if disk:
+        cache = QueryCache(disk_dir = tmp_path / "cache")
+    assert cache.sync(engine) == 1
+    assert cache.get("january") is None
+
+
+def test_sync_acts_on_each_load_once(engine):
+    cache = QueryCache()
+    cache.sync(engine)
+    load_id = start_load(engine, "exports", date(2020, 1, 1))
+    finish(engine, load_id, datetime.now(), "2020-01")
+    assert cache.sync(engine) == 0
+
+    cache.put("january", 1, ["exports:2020-01"])
+    assert cache.sync(engine) == 0
+    assert cache.get("january") == 1
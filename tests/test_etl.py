@@ -0,0 +1,122 @@
+"""Checks of the ETL against synthetic trade files from `tradedata.fixtures`."""
+
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from tradedata.fixtures import generate_fixtures
+from tradedata.initialise.table_plan import load_table_plans, convert_trade_dates
+from tradedata.initialise.create_database import FooterlessFile, read_trade_table, etl_trade_table
+from tradedata.initialise.control_file import parse_control_lines
+from tradedata.update.delta_load import row_hashes, key_columns
+
+ROWS = 500
+
+
+@pytest.fixture(scope = "module")
+def fixtures(tmp_path_factory):
+    """One month of every table, with a 28 column control file, and their plans."""
+    dest = tmp_path_factory.mktemp("fixtures")
+    paths = generate_fixtures(dest, rows = ROWS, control_rows = 2500, control_columns = 28)
+    return {x.name[0:6]: x for x in paths}, load_table_plans(dest / "lookups")
+
+
+# FOOTERLESS FILE ##############################################################
+@pytest.mark.parametrize("block_size", [7, 64, 1024 * 1024])
+def test_footerless_file_withholds_footer(fixtures, block_size):
+    (paths, plans) = fixtures
+    with FooterlessFile(paths["SMKE19"], block_size = block_size) as trade_file:
+        text = trade_file.read()
+        while True:
+            block = trade_file.read()
+            if not block:
+                break
+            text += block
+
+    lines = paths["SMKE19"].read_text().splitlines(keepends = True)
+    assert text == "".join(lines[0:-1])
+
+
+def test_read_trade_table_skips_header_and_footer(fixtures):
+    (paths, plans) = fixtures
+    plan = plans["exports"]
+    with FooterlessFile(paths["SMKE19"], block_size = 1024) as trade_file:
+        chunks = list(read_trade_table(trade_file, plan.column_names, chunksize = 128))
+
+    data = pd.concat(chunks)
+    assert len(data) == ROWS
+    assert not data["comcode"].isin(["000000000", "999999999"]).any()
+
+
+# DATES ########################################################################
+def test_convert_trade_dates():
+    dates = pd.Series(["0202013", "0000000", "0202001", "0201912", None], index = [5, 6, 7, 8, 9])
+    converted = convert_trade_dates(dates, "0%Y%m", date(2020, 1, 1))
+
+    assert list(converted.index) == [5, 6, 7, 8, 9]
+    assert list(converted) == [date(2020, 12, 31), date(2020, 1, 1), date(2020, 1, 1), date(2019, 12, 1), None]
+
+
+def test_etl_trade_table_dates(fixtures):
+    (paths, plans) = fixtures
+    plan = plans["dispatches"]
+    data = etl_trade_table(paths["SMKX46"], plan.spec_list, plan.recode_dict, plan.date_format)
+
+    assert len(data) == ROWS
+    assert set(data["date"]) <= {date(2020, 1, 1), date(2020, 12, 31)}
+
+
+# CONTROL FILE #################################################################
+def test_parse_control_lines(fixtures):
+    (paths, plans) = fixtures
+    with open(paths["SMKA12"], encoding = "windows-1252", newline = "") as f:
+        records = list(parse_control_lines(f))
+
+    # Garbage rows, the header and the footer are skipped
+    assert len(records) == 2500
+    assert all(len(x) == 5 for x in records)
+    assert all(len(x[0]) == 8 and x[0].isdigit() for x in records)
+    assert all(x[4] and x[4] == x[4].strip() for x in records)
+    assert not any("\0" in field for x in records for field in x)
+
+
+# ROW HASHES ###################################################################
+@pytest.fixture(scope = "module")
+def imports(fixtures):
+    (paths, plans) = fixtures
+    plan = plans["imports"]
+    return etl_trade_table(paths["SMKI19"], plan.spec_list, plan.recode_dict, plan.date_format), plan
+
+
+def test_row_hashes_ignore_row_order(imports):
+    (data, plan) = imports
+    keys = key_columns(plan.dtype_dict)
+    (row_key, row_hash) = row_hashes(data, keys)
+
+    shuffled = data.sample(frac = 1, random_state = 0)
+    (shuffled_key, shuffled_hash) = row_hashes(shuffled, keys)
+
+    assert dict(zip(row_key, row_hash)) == dict(zip(shuffled_key, shuffled_hash))
+    assert len(set(row_key)) == len(data)
+
+
+def test_row_hashes_number_duplicate_rows(imports):
+    (data, plan) = imports
+    doubled = pd.concat([data.iloc[0:1], data.iloc[0:1]], ignore_index = True)
+    (row_key, row_hash) = row_hashes(doubled, key_columns(plan.dtype_dict))
+
+    assert row_key[0] != row_key[1]
+    assert row_hash[0] == row_hash[1]
+
+
+def test_row_hashes_change_with_measures_only(imports):
+    (data, plan) = imports
+    changed = data.copy()
+    changed.loc[changed.index[0], "value"] += 1
+    (row_key, row_hash) = row_hashes(data, key_columns(plan.dtype_dict))
+    (changed_key, changed_hash) = row_hashes(changed, key_columns(plan.dtype_dict))
+
+    assert np.array_equal(np.sort(row_key), np.sort(changed_key))
+    assert (row_hash != changed_hash).sum() == 1
@@ -0,0 +1 @@
+"""Async read API over the trade tables; see `tradedata.api.app`."""
@@ -0,0 +1,295 @@
+"""
+TITLE: API Application
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Async HTTP API over the trade tables, built on aiohttp.
+
+    GET /health
+    GET /flows/{table}          One page of JSON, with a `next` cursor.
+    GET /flows/{table}.ndjson   Every matching row, streamed as NDJSON.
+    GET /flows/{table}.csv      Every matching row, streamed as CSV.
+    GET /aggregates/{table}     Summed measures by month and comcode `level`,
+                                optionally `by=country`, from the rollups.
+    GET /cache                  Result cache counters.
+    GET /dimensions             Sizes of the lookup maps used for labels.
+
+Flows can be filtered with the `from`, `to`, `comcode`, `country`, `origin` and
+`port` parameters; see `tradedata.api.queries.parse_filters`. With `labels=true`
+each code column gets a `<column>_label` alongside it (country, port and
+commodity names), from the in-memory lookup maps of `tradedata.dimensions`
+rather than joins to the lookup tables.
+
+Queries run on a thread pool against a pooled SQLAlchemy engine, sized so each
+thread can hold one connection, keeping the event loop free. Streamed results
+are fetched a batch at a time by keyset, so memory use is bounded by the batch
+size however many rows match. JSON pages and aggregates are cached (see
+`tradedata.api.cache`); the cache follows the load ledger every
+`sync_interval` seconds, dropping results for any month that was loaded.
+Results are cached without labels, and labelled as they are served, so a
+reloaded lookup table shows up without invalidating anything. Run with:
+
+    tradedata serve --port 8080
+    tradedata serve --database_url sqlite:///fixtures.db
+
+or `python -m tradedata.api.app`, which takes the same options. The SQLite
+database is built from synthetic files by
+`tradedata fixtures --database_url sqlite:///fixtures.db`.
+"""
+
+import io
+import csv
+import json
+import asyncio
+import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+from sqlalchemy import create_engine
+
+from tradedata.utils import read_credentials
+from tradedata.api.queries import QueryError, SchemaError, parse_filters, fetch_page, reflect_table
+from tradedata.api.queries import encode_cursor, MAX_PAGE_SIZE
+from tradedata.api.queries import parse_aggregate, parse_labels, fetch_aggregates
+from tradedata.api.cache import QueryCache, cache_key, query_tags
+from tradedata.dimensions import LABELLED_COLUMNS, dimension_cache
+
+# Rows fetched per query when streaming NDJSON / CSV.
+STREAM_BATCH_SIZE = 5000
+
+
+# FUNCTIONS ####################################################################
+async def run_query(request, function, *args, **kwargs):
+    """Runs a blocking query function on the app's thread pool."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(request.app["executor"], partial(function, *args, **kwargs))
+
+
+def dumps(data):
+    """JSON encodes rows, writing dates as ISO strings."""
+    return json.dumps(data, default = str)
+
+
+@web.middleware
+async def error_middleware(request, handler):
+    """Returns invalid parameters as a 400, and tables the API can't query yet as a 503, with a JSON error body."""
+    try:
+        return await handler(request)
+    except QueryError as e:
+        return web.json_response({"error": str(e)}, status = 400, dumps = dumps)
+    except SchemaError as e:
+        return web.json_response({"error": str(e)}, status = 503, dumps = dumps)
+
+
+async def health(request):
+    return web.json_response({"status": "ok"})
+
+
+async def cached_query(request, filters, key_parts, function, *args):
+    """Runs a query through the app's result cache, if it has one."""
+    cache = request.app["cache"]
+    if cache is None:
+        return await run_query(request, function, *args)
+
+    key = cache_key(request.path, filters, *key_parts)
+    result = cache.get(key)
+    if result is None:
+        result = await run_query(request, function, *args)
+        cache.put(key, result, query_tags(filters))
+    return result
+
+
+async def label_rows(request, rows, columns = LABELLED_COLUMNS):
+    """Adds `<column>_label`s to rows from the app's dimension cache, which may reload a lookup table first."""
+    return await run_query(request, request.app["dimensions"].enrich_rows, rows, columns)
+
+
+async def get_flows(request):
+    """One page of trade flows as JSON: `{"data": [...], "next": cursor or null}`."""
+    filters = parse_filters(request.match_info["table"], request.query)
+    labels = parse_labels(request.query)
+    rows, last_id = await cached_query(request, filters, [], fetch_page, request.app["engine"], filters)
+    if labels:
+        rows = await label_rows(request, rows)
+    next_cursor = encode_cursor(last_id) if last_id is not None else None
+    return web.json_response({"data": rows, "next": next_cursor}, dumps = dumps)
+
+
+async def stream_flows(request):
+    """Streams every matching trade flow as NDJSON or CSV, one batch in memory at a time.
+
+    A `cursor` from a JSON page resumes the stream after that page; `limit` is ignored.
+    """
+    fmt = request.match_info["format"]
+    params = dict(request.query, limit = str(MAX_PAGE_SIZE))
+    filters = parse_filters(request.match_info["table"], params)
+    labels = parse_labels(request.query)
+    engine = request.app["engine"]
+    batch_size = request.app["batch_size"]
+
+    # Fetch the first batch before sending headers, so bad filters can still 400
+    table = await run_query(request, reflect_table, engine, filters["table"])
+    rows, last_id = await run_query(request, fetch_page, engine, filters, limit = batch_size)
+
+    columns = [x.name for x in table.columns]
+    if labels:
+        columns += [f"{x}_label" for x in LABELLED_COLUMNS if x in table.c]
+        rows = await label_rows(request, rows)
+
+    content_type = "application/x-ndjson" if fmt == "ndjson" else "text/csv"
+    response = web.StreamResponse(headers = {"Content-Type": f"{content_type}; charset=utf-8"})
+    await response.prepare(request)
+
+    if fmt == "csv":
+        await response.write((",".join(columns) + "\r\n").encode())
+
+    while True:
+        if fmt == "ndjson":
+            chunk = "".join(dumps(row) + "\n" for row in rows)
+        else:
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows([row[x] for x in columns] for row in rows)
+            chunk = buffer.getvalue()
+        await response.write(chunk.encode())
+
+        if last_id is None:
+            break
+        rows, last_id = await run_query(request, fetch_page, engine, filters,
+                                        after = last_id, limit = batch_size)
+        if labels:
+            rows = await label_rows(request, rows)
+
+    await response.write_eof()
+    return response
+
+
+async def get_aggregates(request):
+    """Aggregates as JSON: `{"data": [...], "source": table queried, "truncated": bool}`."""
+    filters = parse_filters(request.match_info["table"], request.query)
+    level, by_country = parse_aggregate(request.query)
+    labels = parse_labels(request.query)
+    rows, source, truncated = await cached_query(request, filters, [level, by_country], fetch_aggregates,
+                                                 request.app["engine"], filters, level, by_country)
+    if labels:
+        # Only full comcodes have descriptions; chapters and headings aren't in `control`
+        columns = {"cod_code": "country", **({"code": "comcode"} if level == "comcode" else {})}
+        rows = await label_rows(request, rows, columns)
+    return web.json_response({"data": rows, "source": source, "truncated": truncated}, dumps = dumps)
+
+
+async def cache_info(request):
+    cache = request.app["cache"]
+    return web.json_response(cache.info() if cache is not None else {"enabled": False})
+
+
+async def dimensions_info(request):
+    return web.json_response(request.app["dimensions"].info())
+
+
+async def sync_cache_once(app):
+    """Syncs the result cache with the load ledger, reporting rather than raising if the ledger can't be read."""
+    loop = asyncio.get_event_loop()
+    try:
+        await loop.run_in_executor(app["executor"], app["cache"].sync, app["engine"])
+    except Exception as e:
+        # Keep serving if the ledger can't be read; a later sync will catch up
+        print(f"Result cache could not sync with the load ledger: {e!r}")
+
+
+async def sync_cache(app):
+    """Background task keeping the result cache in step with the load ledger."""
+    while True:
+        await asyncio.sleep(app["sync_interval"])
+        await sync_cache_once(app)
+
+
+def create_app(engine, workers = 8, batch_size = STREAM_BATCH_SIZE, cache = None, sync_interval = 30):
+    """Builds the API application.
+
+    :param engine: SQLAlchemy Engine to query; its pool should allow `workers` connections.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param workers: Number of queries run at once.
+    :type workers: int
+    :param batch_size: Rows fetched per query when streaming.
+    :type batch_size: int
+    :param cache: Result cache for JSON pages and aggregates; None disables caching.
+    :type cache: tradedata.api.cache.QueryCache
+    :param sync_interval: Seconds between checks of the load ledger for loads invalidating the cache, or reloading a lookup table.
+    :type sync_interval: float
+    :return: aiohttp.web.Application
+    """
+    app = web.Application(middlewares = [error_middleware])
+    app["engine"] = engine
+    app["executor"] = ThreadPoolExecutor(max_workers = workers)
+    app["batch_size"] = batch_size
+    app["cache"] = cache
+    app["sync_interval"] = sync_interval
+    app["dimensions"] = dimension_cache(engine, check_interval = sync_interval)
+
+    app.router.add_get("/health", health)
+    app.router.add_get("/flows/{table:[a-z]+}", get_flows)
+    app.router.add_get("/flows/{table:[a-z]+}.{format:ndjson|csv}", stream_flows)
+    app.router.add_get("/aggregates/{table:[a-z]+}", get_aggregates)
+    app.router.add_get("/cache", cache_info)
+    app.router.add_get("/dimensions", dimensions_info)
+
+    async def start(app):
+        if app["cache"] is not None:
+            # Catch up with loads finished while the API was down before serving from the disk tier
+            await sync_cache_once(app)
+            app["sync_task"] = asyncio.ensure_future(sync_cache(app))
+
+    async def close(app):
+        if "sync_task" in app:
+            app["sync_task"].cancel()
+        app["executor"].shutdown(wait = True)
+        app["engine"].dispose()
+    app.on_startup.append(start)
+    app.on_cleanup.append(close)
+
+    return app
+
+
+# MAIN #########################################################################
+def main(argv = None, prog = None):
+    """Entry point of `tradedata serve`; `argv` defaults to the command line."""
+
+    # Parse Arguments
+    parser = argparse.ArgumentParser(prog = prog, description="Serve the Trade Data API.")
+    parser.add_argument("--host", help="Interface to listen on.", default = "0.0.0.0")
+    parser.add_argument("--port", type=int, help="Port to listen on.", default = 8080)
+    parser.add_argument("--workers", type=int,
+                        help="Number of database queries run at once; also the connection pool size.",
+                        default = 8)
+    parser.add_argument("--database_url",
+                        help="SQLAlchemy URL to serve from, e.g. a SQLite stand-in; defaults to the Postgres in conf/credentials.yml.",
+                        default = None)
+    parser.add_argument("--no_cache", action = "store_true",
+                        help="Disable the result cache.")
+    parser.add_argument("--cache_entries", type=int,
+                        help="Most results held in the in-memory cache.",
+                        default = 1024)
+    parser.add_argument("--cache_dir",
+                        help="Directory for an on-disk tier of the result cache, kept across restarts.",
+                        default = None)
+    parser.add_argument("--sync_interval", type=float,
+                        help="Seconds between checks of the load ledger for loads invalidating the cache.",
+                        default = 30)
+    args = parser.parse_args(argv)
+
+    if args.database_url is None:
+        db_c = read_credentials("conf/credentials.yml")["database"]
+        url = f'postgresql+psycopg2://{db_c["username"]}:{db_c["password"]}@{db_c["host"]}/{db_c["database"]}'
+        engine = create_engine(url, pool_size = args.workers, max_overflow = 0, pool_pre_ping = True)
+    else:
+        engine = create_engine(args.database_url)
+
+    cache = None if args.no_cache else QueryCache(args.cache_entries, disk_dir = args.cache_dir)
+    web.run_app(create_app(engine, args.workers, cache = cache, sync_interval = args.sync_interval),
+                host = args.host, port = args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,316 @@
+"""
+TITLE: API Result Cache
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Result cache in front of the API's query layer.
+
+Results are kept in an in-process LRU bounded by entry count and size, with an
+optional on-disk tier (one pickle per entry plus a JSON manifest, in the style
+of the archive cache) that survives restarts. Keys are hashes of the normalised
+query parameters.
+
+Each entry is tagged with the table and months it depends on, e.g.
+`imports:2020-01`, or `imports:*` if its date range is open. The data only
+changes when something is loaded, so the cache follows the load ledger with
+`sync`. Each load finished since the last sync invalidates only the entries
+tagged with its table and the months the ledger records it as having changed
+(its `months`, or its `period` for a load recorded without them). Refreshing a
+table's rollups is recorded as a load of `<table>_rollups`, and invalidates the
+entries for `<table>`.
+
+Loads finish on several threads (and hosts), and a ledger entry's
+`finished_at` is set before its UPDATE commits, so entries can become visible
+out of `finished_at` order. Each sync therefore re-reads the entries finished
+within `SYNC_LOOKBACK` of the latest it has seen, skipping the ids it has
+already acted on, so an entry committed late is still picked up.
+
+The disk tier saves how far through the ledger it has synced alongside its
+manifest, so after a restart the first sync replays the loads finished while
+the API was down. A disk tier without a saved position (e.g. written by an
+older version) can't be brought up to date, and is cleared when it is opened.
+"""
+
+import json
+import time
+import pickle
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select
+
+from tradedata.ledger import load_ledger, parse_months
+
+# Date ranges spanning more months than this are tagged with the whole table
+MAX_TAGGED_MONTHS = 600
+
+# How far before the latest `finished_at` seen each sync re-reads the ledger
+SYNC_LOOKBACK = timedelta(minutes = 5)
+
+# Format of the ledger `finished_at` saved with the disk tier
+SYNCED_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+
+# FUNCTIONS ####################################################################
+def cache_key(*parts):
+    """Hash of the normalised query parameters in `parts` (dicts are sorted by key)."""
+    normalised = json.dumps(parts, sort_keys = True, default = str)
+    return hashlib.sha256(normalised.encode()).hexdigest()
+
+
+def query_tags(filters):
+    """Tags of the table and months a query on `filters` depends on.
+
+    :param filters: Filter dict from `tradedata.api.queries.parse_filters`.
+    :type filters: Dict
+    :return: List of tags, `table:YYYY-MM` per month in the range, or `table:*` for an open range.
+    """
+    table_name = filters["table"]
+    start, end = filters.get("from"), filters.get("to")
+    if start is None or end is None:
+        return [f"{table_name}:*"]
+
+    months = (end.year - start.year) * 12 + end.month - start.month + 1
+    if months > MAX_TAGGED_MONTHS:
+        return [f"{table_name}:*"]
+    return [f"{table_name}:{start.year + (start.month - 1 + i) // 12}-{(start.month - 1 + i) % 12 + 1:02d}"
+            for i in range(max(months, 0))]
+
+
+class QueryCache:
+    """LRU result cache with an optional disk tier, invalidated per table and month.
+
+    :param max_entries: Most results held in memory.
+    :type max_entries: int
+    :param max_bytes: Most (pickled) bytes of results held in memory.
+    :type max_bytes: int
+    :param disk_dir: Directory for the disk tier; None keeps results in memory only.
+    :type disk_dir: pathlib.Path() object, or str.
+    :param disk_max_bytes: Size above which least recently used results are evicted from disk.
+    :type disk_max_bytes: int
+    """
+
+    def __init__(self, max_entries = 1024, max_bytes = 256 * 1024 ** 2,
+                 disk_dir = None, disk_max_bytes = 2 * 1024 ** 3):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._lock = threading.RLock()
+        self._entries = OrderedDict()   # key : (value, tags, size)
+        self._bytes = 0
+        self._synced = None             # (latest finished_at, ids seen within SYNC_LOOKBACK of it)
+
+        self.stats = {"hits": 0, "misses": 0, "disk_hits": 0, "evictions": 0,
+                      "disk_evictions": 0, "invalidations": 0}
+
+        self.disk_dir = None if disk_dir is None else Path(disk_dir)
+        if self.disk_dir is not None:
+            (self.disk_dir / "objects").mkdir(parents = True, exist_ok = True)
+            self.manifest_path = self.disk_dir / "manifest.json"
+            self.synced_path = self.disk_dir / "synced.json"
+            if self.manifest_path.exists():
+                self.manifest = json.loads(self.manifest_path.read_text())
+            else:
+                self.manifest = {}
+
+            # Entries whose ledger position is unknown may be stale
+            if self.synced_path.exists():
+                self._synced = self._load_synced()
+            elif self.manifest:
+                self.clear()
+
+
+    # Lookup -----------------------------------------------------------------------------
+    def get(self, key):
+        """Returns the cached result for `key`, or None on a miss.
+
+        Results found on disk are promoted back into memory.
+        """
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return self._entries[key][0]
+
+            if self.disk_dir is not None and key in self.manifest:
+                path = self.disk_dir / "objects" / key
+                if path.exists():
+                    value = pickle.loads(path.read_bytes())
+                    self.manifest[key]["last_used"] = time.time()
+                    self._save()
+                    self._put_memory(key, value, self.manifest[key]["tags"], self.manifest[key]["size"])
+                    self.stats["hits"] += 1
+                    self.stats["disk_hits"] += 1
+                    return value
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, key, value, tags):
+        """Caches `value` under `key`, tagged with the table/months it depends on (see `query_tags`)."""
+        data = pickle.dumps(value, protocol = pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._put_memory(key, value, list(tags), len(data))
+            if self.disk_dir is not None:
+                tmp = self.disk_dir / "objects" / f"{key}.tmp"
+                tmp.write_bytes(data)
+                tmp.replace(self.disk_dir / "objects" / key)
+                self.manifest[key] = {"tags": list(tags), "size": len(data), "last_used": time.time()}
+                self._evict_disk()
+                self._save()
+
+    def _put_memory(self, key, value, tags, size):
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+        self._entries[key] = (value, tags, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            self._bytes -= self._entries.popitem(last = False)[1][2]
+            self.stats["evictions"] += 1
+
+
+    # Disk tier --------------------------------------------------------------------------
+    def _save(self):
+        """Atomically writes the disk tier's manifest."""
+        tmp = self.manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.manifest))
+        tmp.replace(self.manifest_path)
+
+    def _load_synced(self):
+        """Reads the ledger position saved by `_save_synced`."""
+        synced = json.loads(self.synced_path.read_text())
+        finished_at = synced["finished_at"]
+        return (None if finished_at is None else datetime.strptime(finished_at, SYNCED_FORMAT),
+                set(synced["ids"]))
+
+    def _save_synced(self):
+        """Atomically writes the ledger position the disk tier has been synced to."""
+        (finished_at, ids) = self._synced
+        tmp = self.synced_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"finished_at": None if finished_at is None else finished_at.strftime(SYNCED_FORMAT),
+                                   "ids": sorted(ids)}))
+        tmp.replace(self.synced_path)
+
+    def _remove_disk(self, key):
+        self.manifest.pop(key, None)
+        path = self.disk_dir / "objects" / key
+        if path.exists():
+            path.unlink()
+
+    def _evict_disk(self):
+        """Removes least recently used results until the disk tier fits within `disk_max_bytes`."""
+        total = sum(x["size"] for x in self.manifest.values())
+        for key in sorted(self.manifest, key = lambda x: self.manifest[x]["last_used"]):
+            if total <= self.disk_max_bytes:
+                break
+            total -= self.manifest[key]["size"]
+            self._remove_disk(key)
+            self.stats["disk_evictions"] += 1
+
+
+    # Invalidation -----------------------------------------------------------------------
+    def invalidate(self, table_name, period = None):
+        """Drops the entries depending on a table's month, or on any of its months if `period` is None.
+
+        :return: Number of entries dropped.
+        """
+        def matches(tags):
+            if period is None:
+                return any(x.split(":")[0] == table_name for x in tags)
+            return f"{table_name}:{period:%Y-%m}" in tags or f"{table_name}:*" in tags
+
+        with self._lock:
+            keys = {k for (k, x) in self._entries.items() if matches(x[1])}
+            for key in keys:
+                self._bytes -= self._entries.pop(key)[2]
+
+            if self.disk_dir is not None:
+                disk_keys = {k for (k, x) in self.manifest.items() if matches(x["tags"])}
+                for key in disk_keys:
+                    self._remove_disk(key)
+                self._save()
+                keys |= disk_keys
+
+            self.stats["invalidations"] += len(keys)
+            return len(keys)
+
+    def clear(self):
+        """Drops every entry."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self.disk_dir is not None:
+                for key in list(self.manifest):
+                    self._remove_disk(key)
+                self._save()
+
+    def sync(self, engine):
+        """Invalidates the entries affected by loads that finished since the last sync.
+
+        The first sync of a cache without a saved ledger position only notes
+        where the ledger is up to. Entries finished within `SYNC_LOOKBACK` of
+        the latest seen are read again, for those that committed late. Each load invalidates the months it changed;
+        loads of lookup tables (no period) invalidate every entry for the table.
+
+        :param engine: SQLAlchemy Engine holding the load ledger.
+        :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+        :return: Number of entries dropped.
+        """
+        query = select([load_ledger.c.id, load_ledger.c.table_name, load_ledger.c.period,
+                        load_ledger.c.months, load_ledger.c.finished_at]) \
+            .where(load_ledger.c.finished_at.isnot(None))
+        with self._lock:
+            synced = self._synced
+        if synced is not None and synced[0] is not None:
+            query = query.where(load_ledger.c.finished_at >= synced[0] - SYNC_LOOKBACK)
+
+        with engine.connect() as conn:
+            rows = conn.execute(query.order_by(load_ledger.c.finished_at)).fetchall()
+
+        if not rows:
+            if synced is None:
+                with self._lock:
+                    self._synced = (None, set())
+                    if self.disk_dir is not None:
+                        self._save_synced()
+            return 0
+        last = rows[-1]["finished_at"]
+        if synced is not None and synced[0] is not None:
+            last = max(last, synced[0])
+        seen = {row["id"] for row in rows if row["finished_at"] >= last - SYNC_LOOKBACK}
+
+        dropped = 0
+        if synced is not None:
+            for row in rows:
+                if row["id"] in synced[1]:
+                    continue
+                table_name = row["table_name"]
+                if table_name.endswith("_rollups"):
+                    table_name = table_name[0:-len("_rollups")]
+                for period in parse_months(row["months"]) or [row["period"]]:
+                    dropped += self.invalidate(table_name, period)
+
+        with self._lock:
+            self._synced = (last, seen)
+            if self.disk_dir is not None:
+                self._save_synced()
+        return dropped
+
+
+    # Reporting --------------------------------------------------------------------------
+    def info(self):
+        """Hit / miss / eviction counters, and the current size of each tier."""
+        with self._lock:
+            info = dict(self.stats, entries = len(self._entries), bytes = self._bytes)
+            lookups = self.stats["hits"] + self.stats["misses"]
+            info["hit_rate"] = self.stats["hits"] / lookups if lookups else None
+            if self.disk_dir is not None:
+                info["disk_entries"] = len(self.manifest)
+                info["disk_bytes"] = sum(x["size"] for x in self.manifest.values())
+            return info
@@ -0,0 +1,312 @@
+"""
+TITLE: API Queries
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Query layer behind the API. Request parameters are validated into a filter
+dict, and turned into parameterised SQLAlchemy Core queries on the trade tables.
+
+Aggregates are answered from the smallest rollup table (see `tradedata.rollups`)
+that holds the level and filters asked for, falling back to the raw rows.
+
+Results are paginated on the trade tables' `id` column (keyset pagination):
+each page asks for rows with `id` greater than the last one returned, so every
+page costs the same however deep into the results it is, unlike OFFSET. Only
+portable Core constructs are used so the API can run against a SQLite stand-in.
+"""
+
+import re
+import json
+import base64
+import threading
+from datetime import date, timedelta
+
+from sqlalchemy import MetaData, Table
+from sqlalchemy import select, func, and_, literal_column
+from sqlalchemy.exc import NoSuchTableError
+
+from tradedata.rollups import ROLLUP_LEVELS, ROLLUP_MEASURES, rollup_name, choose_rollup_level
+
+TRADE_TABLES = ["imports", "exports", "arrivals", "dispatches"]
+
+# Query parameter : column, for parameters taking one or more comma separated codes
+CODE_FILTERS = {"country": "cod_code", "origin": "coo_code", "port": "port_code"}
+
+# Filters the rollups cannot answer, as they are not grouped by these columns
+RAW_ONLY_FILTERS = ["origin", "port"]
+
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+class QueryError(ValueError):
+    """Raised for invalid request parameters; returned to the client as a 400."""
+
+
+class SchemaError(RuntimeError):
+    """Raised when a table lacks a column the API needs; returned to the client as a 503."""
+
+
+# FUNCTIONS ####################################################################
+def reflect_table(engine, table_name):
+    """Returns the reflected SQLAlchemy Table for `table_name`, cached per engine."""
+    key = (str(engine.url), table_name)
+    with _tables_lock:
+        if key not in _tables:
+            _tables[key] = Table(table_name, MetaData(), autoload = True, autoload_with = engine)
+        return _tables[key]
+
+
+def forget_table(engine, table_name):
+    """Drops a table from the `reflect_table` cache, so it is reflected again when next used."""
+    with _tables_lock:
+        _tables.pop((str(engine.url), table_name), None)
+
+
+def parse_date(value, end = False):
+    """Parses a `YYYY-MM-DD` or `YYYY-MM` date parameter.
+
+    A month as the `end` of a range is taken to be its last day.
+    """
+    match = re.fullmatch(r"(\d{4})-(\d{2})(?:-(\d{2}))?", value)
+    if match is None:
+        raise QueryError(f"Invalid date {value!r}; expected YYYY-MM-DD or YYYY-MM")
+    year, month, day = match.groups()
+    try:
+        if day is not None:
+            return date(int(year), int(month), int(day))
+        if end:
+            return date(int(year) + int(month) // 12, int(month) % 12 + 1, 1) - timedelta(days = 1)
+        return date(int(year), int(month), 1)
+    except ValueError:
+        raise QueryError(f"Invalid date {value!r}")
+
+
+def encode_cursor(last_id):
+    """Opaque cursor for the page following the row with `id` of `last_id`."""
+    return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Inverse of `encode_cursor`; returns the `id` to resume after."""
+    try:
+        return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))["id"])
+    except (ValueError, KeyError, TypeError):
+        raise QueryError(f"Invalid cursor {cursor!r}")
+
+
+def parse_filters(table_name, params):
+    """Validates request parameters into a filter dict for `flows_query`.
+
+    :param table_name: Trade table requested; one of `TRADE_TABLES`.
+    :type table_name: String
+    :param params: Request query parameters: `from`, `to`, `comcode` (an exact code or a prefix, e.g. a chapter), `country`, `origin`, `port`, `limit` and `cursor`.
+    :type params: Mapping of str : str.
+    :raises QueryError: If the table or any parameter is invalid.
+    :return: Dict with `table`, `from`, `to`, `comcode`, a list of codes for each of `CODE_FILTERS`, `limit` and `after`.
+    """
+    if table_name not in TRADE_TABLES:
+        raise QueryError(f"Unknown table {table_name!r}; expected one of {TRADE_TABLES}")
+
+    filters = {"table": table_name}
+    filters["from"] = parse_date(params["from"]) if params.get("from") else None
+    filters["to"] = parse_date(params["to"], end = True) if params.get("to") else None
+
+    comcode = params.get("comcode")
+    if comcode and not re.fullmatch(r"[0-9A-Za-z]{1,8}", comcode):
+        raise QueryError(f"Invalid comcode {comcode!r}")
+    filters["comcode"] = comcode or None
+
+    for (param, column) in CODE_FILTERS.items():
+        codes = params.get(param)
+        filters[param] = [x.strip() for x in codes.split(",") if x.strip()] if codes else None
+
+    try:
+        limit = int(params.get("limit", DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise QueryError(f"Invalid limit {params.get('limit')!r}")
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        raise QueryError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+    filters["limit"] = limit
+
+    filters["after"] = decode_cursor(params["cursor"]) if params.get("cursor") else None
+    return filters
+
+
+def filter_conditions(table, filters):
+    """Returns the WHERE conditions for the date, comcode and code filters in `filters`.
+
+    :param table: Trade table, or a rollup (whose comcode prefix column is `code`).
+    :type table: sqlalchemy.Table
+    :param filters: Filter dict from `parse_filters`.
+    :type filters: Dict
+    :raises QueryError: If a filter is on a column the table does not have (e.g. `port` on EU trade).
+    :return: List of SQLAlchemy conditions.
+    """
+    conditions = []
+    if filters.get("from") is not None:
+        conditions.append(table.c.date >= filters["from"])
+    if filters.get("to") is not None:
+        conditions.append(table.c.date <= filters["to"])
+    if filters.get("comcode"):
+        code_column = table.c.comcode if "comcode" in table.c else table.c.code
+        if len(filters["comcode"]) == 8:
+            conditions.append(code_column == filters["comcode"])
+        else:
+            conditions.append(code_column.startswith(filters["comcode"], autoescape = True))
+    for (param, column) in CODE_FILTERS.items():
+        if filters.get(param):
+            if column not in table.c:
+                raise QueryError(f"{table.name} cannot be filtered by {param}")
+            conditions.append(table.c[column].in_(filters[param]))
+    return conditions
+
+
+def flows_query(table, filters, after = None, limit = None):
+    """Builds the parameterised query for a page of trade flows.
+
+    :param table: Reflected trade table.
+    :type table: sqlalchemy.Table
+    :param filters: Filter dict from `parse_filters`.
+    :type filters: Dict
+    :param after: Only return rows with an `id` above this.
+    :type after: int
+    :param limit: Maximum number of rows.
+    :type limit: int
+    :return: SQLAlchemy Select ordered by `id`.
+    """
+    conditions = filter_conditions(table, filters)
+    if after is not None:
+        conditions.append(table.c.id > after)
+
+    query = select([table]).order_by(table.c.id)
+    if conditions:
+        query = query.where(and_(*conditions))
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def fetch_page(engine, filters, after = None, limit = None):
+    """Fetches one page of trade flows.
+
+    :param engine: SQLAlchemy Engine to query.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param filters: Filter dict from `parse_filters`.
+    :type filters: Dict
+    :param after: Resume after this `id`; defaults to the cursor in `filters`.
+    :type after: int
+    :param limit: Page size; defaults to the limit in `filters`.
+    :type limit: int
+    :raises SchemaError: If the table has no `id` column, as in a database created before the API.
+    :return: Tuple of (list of row dicts, `id` to fetch the next page after, or None on the last page).
+    """
+    after = filters.get("after") if after is None else after
+    limit = limit or filters["limit"]
+    table = reflect_table(engine, filters["table"])
+    if "id" not in table.c:
+        # Reflect again next time, in case the column has been added since
+        forget_table(engine, table.name)
+        raise SchemaError(f"{table.name} has no id column to paginate on; run a monthly update, or "
+                          f"`tradedata.initialise.create_database.ensure_id`, to add it")
+
+    # One extra row tells us whether there is another page without a COUNT
+    query = flows_query(table, filters, after, limit + 1)
+    with engine.connect() as conn:
+        rows = [dict(row) for row in conn.execute(query).fetchall()]
+
+    if len(rows) > limit:
+        rows = rows[0:limit]
+        return rows, rows[-1]["id"]
+    return rows, None
+
+
+def parse_aggregate(params):
+    """Validates the `level` (default "chapter") and `by` parameters of an aggregate request.
+
+    :return: Tuple of (level, whether to group by country too).
+    """
+    level = params.get("level", "chapter")
+    if level not in ROLLUP_LEVELS:
+        raise QueryError(f"Invalid level {level!r}; expected one of {list(ROLLUP_LEVELS)}")
+    by = [x for x in params.get("by", "").split(",") if x]
+    if any(x != "country" for x in by):
+        raise QueryError("by only accepts `country`")
+    return level, "country" in by
+
+
+def parse_labels(params):
+    """Validates the `labels` parameter: whether to add readable labels to the codes in the results."""
+    labels = params.get("labels", "false").lower()
+    if labels not in ("true", "false", "1", "0"):
+        raise QueryError(f"Invalid labels {params.get('labels')!r}; expected true or false")
+    return labels in ("true", "1")
+
+
+def aggregate_source(engine, filters, level):
+    """Table an aggregate is computed from: the smallest rollup that can answer it, or the raw trade table.
+
+    :return: Tuple of (Table, whether it is a rollup).
+    """
+    if not any(filters.get(x) for x in RAW_ONLY_FILTERS):
+        name = rollup_name(filters["table"], choose_rollup_level(level, filters.get("comcode")))
+        try:
+            return reflect_table(engine, name), True
+        except NoSuchTableError:
+            pass
+    return reflect_table(engine, filters["table"]), False
+
+
+def aggregate_query(table, is_rollup, filters, level, by_country, limit = None):
+    """Builds the query summing each measure by month, comcode prefix at `level` and optionally country.
+
+    :param table: Rollup or raw trade table, from `aggregate_source`.
+    :type table: sqlalchemy.Table
+    :param is_rollup: Whether `table` is a rollup.
+    :type is_rollup: bool
+    :return: SQLAlchemy Select ordered by date and code.
+    """
+    code_column = table.c.code if is_rollup else table.c.comcode
+    code = func.substr(code_column, literal_column("1"), literal_column(str(ROLLUP_LEVELS[level])))
+    row_count = func.sum(table.c.row_count) if is_rollup else func.count()
+    measures = [x for x in ROLLUP_MEASURES if x in table.c]
+
+    keys = [table.c.date] + ([table.c.cod_code] if by_country else []) + [code.label("code")]
+    query = select(keys + [func.sum(table.c[x]).label(x) for x in measures]
+                   + [row_count.label("row_count")])
+
+    conditions = filter_conditions(table, filters)
+    if conditions:
+        query = query.where(and_(*conditions))
+
+    query = query.group_by(*[table.c.date] + ([table.c.cod_code] if by_country else []) + [code])
+    query = query.order_by(table.c.date, code)
+    if limit is not None:
+        query = query.limit(limit)
+    return query
+
+
+def fetch_aggregates(engine, filters, level = "chapter", by_country = False):
+    """Fetches summed measures by month and comcode prefix, from the smallest rollup that can answer.
+
+    :param engine: SQLAlchemy Engine to query.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param filters: Filter dict from `parse_filters`; `limit` caps the rows returned.
+    :type filters: Dict
+    :param level: Comcode level to group by; one of `ROLLUP_LEVELS`.
+    :type level: String
+    :param by_country: Group by `cod_code` as well.
+    :type by_country: bool
+    :return: Tuple of (list of row dicts, name of the table queried, whether the results were truncated at `limit`).
+    """
+    table, is_rollup = aggregate_source(engine, filters, level)
+    query = aggregate_query(table, is_rollup, filters, level, by_country, filters["limit"] + 1)
+    with engine.connect() as conn:
+        rows = [dict(row) for row in conn.execute(query).fetchall()]
+
+    truncated = len(rows) > filters["limit"]
+    return rows[0:filters["limit"]], table.name, truncated
@@ -0,0 +1,293 @@
+"""
+TITLE: ETL Benchmarks
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Times each stage of the ETL over synthetic files from `tradedata.fixtures`.
+
+    tradedata benchmark --rows 10000 1000000 10000000
+    tradedata benchmark --rows 1000000 --compare benchmarks/results/20201201-120000.json
+
+For each size, one month of every table is generated as nested zips and then
+put through the pipeline a stage at a time:
+
+    unzip     extract the nested archives (`unzip_trade_data`)
+    parse     read each file (`read_trade_table`, or `etl_control_table`)
+    convert   data types and dates (`TablePlan.convert`)
+    recode    recodes and comcode trimming (`TablePlan.recode_columns`)
+    load      write to the database (`write_trade_table`, or `upsert_control_table`)
+
+Loads go to a SQLite file in the working directory by default, with pandas
+INSERTs. Pass `--database_url` for a local Postgres to time COPY and the
+control upsert instead; the benchmark's tables are dropped and recreated in
+their own schema there (`BENCHMARK_SCHEMA`), leaving any loaded trade tables
+alone. Other databases given by URL are only written to with `--force`, as
+their tables of the same names would be dropped.
+
+Each stage records its wall time, rows per second and peak memory: the
+process's peak resident set size while the stage ran, and how far that rose
+above the size when it started. Memory is sampled from `/proc/self/statm` on a
+background thread, which costs the stage next to nothing (`tracemalloc` would
+slow pandas down many times over); it is not recorded where there is no
+`/proc`. Results are saved as JSON to `benchmarks/results/`, with the
+commit and library versions, so that runs can be compared with `--compare`.
+"""
+
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import platform
+import subprocess
+from pathlib import Path
+from datetime import datetime
+
+import pandas as pd
+import sqlalchemy
+from sqlalchemy import create_engine
+from sqlalchemy.engine.url import make_url
+
+from tradedata.fixtures import generate_fixtures
+from tradedata.metrics import PeakRSS
+from tradedata.initialise.download_data import unzip_trade_data
+from tradedata.initialise.table_plan import load_table_plans, file_table
+from tradedata.initialise.create_database import FooterlessFile, read_trade_table, file_period
+from tradedata.initialise.create_database import etl_control_table, upsert_control_table
+from tradedata.initialise.create_database import create_trade_table, write_trade_table
+
+RESULTS_DIR = "benchmarks/results"
+BENCHMARK_SCHEMA = "tradedata_benchmark"
+BENCHMARK_SIZES = [10000, 1000000, 10000000]
+STAGES = ["unzip", "parse", "convert", "recode", "load"]
+
+
+# FUNCTIONS ####################################################################
+def measure(results, stage, table_name, rows, function, *args, **kwargs):
+    """Runs `function` as one stage of the benchmark, appending its timings to `results`.
+
+    :param results: Results of the benchmark so far.
+    :type results: List of Dicts.
+    :param stage: Stage name, one of `STAGES`.
+    :type stage: String
+    :param table_name: Table the stage works on, or None for all of them.
+    :type table_name: String
+    :param rows: Rows the stage handles, for the throughput; None takes the length of what `function` returns.
+    :type rows: int
+    :param function: Function to time, called with `args` and `kwargs`.
+    :type function: Function
+    :return: Whatever `function` returns.
+    """
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        value = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+    rows = len(value) if rows is None else rows
+    growth = rss.peak - rss.start if rss.start is not None else None
+    results.append({"stage": stage, "table": table_name, "rows": rows, "seconds": seconds,
+                    "rows_per_second": rows / seconds if seconds > 0 else None,
+                    "peak_rss_bytes": rss.peak, "rss_growth_bytes": growth})
+    memory = f"{rss.peak / 1024 ** 2:9.1f} MB peak (+{growth / 1024 ** 2:.1f})" if growth is not None else ""
+    print(f"  {stage:<8} {table_name or 'all':<11} {rows:>10,} rows {seconds:8.2f}s {memory}")
+    return value
+
+
+def benchmark_engine(url, work_dir, force = False):
+    """Engine for the benchmark to load into: SQLite in `work_dir` by default, or `url`.
+
+    A Postgres engine has its search path set to `BENCHMARK_SCHEMA`, created
+    if missing, so the benchmark's tables never touch those of a loaded database.
+
+    :param url: SQLAlchemy URL of the database, or None for SQLite in `work_dir`.
+    :type url: String
+    :param work_dir: Directory for the SQLite database.
+    :type work_dir: pathlib.Path() object, or str.
+    :param force: Allow a database other than Postgres, whose tables named as the trade tables are dropped.
+    :type force: bool
+    :raises ValueError: If `url` is not a Postgres database and `force` is not set.
+    :return: SQLAlchemy Engine.
+    """
+    if url is None:
+        return create_engine(f"sqlite:///{Path(work_dir) / 'benchmark.db'}")
+
+    if make_url(url).get_backend_name() != "postgresql":
+        if not force:
+            raise ValueError(f"Only Postgres databases are benchmarked in their own schema; pass --force to "
+                             f"drop and recreate the trade tables in {url}")
+        return create_engine(url)
+
+    engine = create_engine(url, connect_args = {"options": f"-csearch_path={BENCHMARK_SCHEMA}"})
+    with engine.begin() as conn:
+        conn.execute(f'CREATE SCHEMA IF NOT EXISTS "{BENCHMARK_SCHEMA}"')
+    return engine
+
+
+def prepare_database(engine, plans):
+    """Drops and recreates the benchmark's tables, where the database needs them up front (Postgres).
+
+    Use an engine from `benchmark_engine`, so that on Postgres only the tables in `BENCHMARK_SCHEMA` are dropped.
+    """
+    cascade = " CASCADE" if engine.dialect.name == "postgresql" else ""
+    with engine.begin() as conn:
+        for table_name in list(plans) + ["control_hash"]:
+            conn.execute(f'DROP TABLE IF EXISTS "{table_name}"{cascade}')
+
+    if engine.dialect.name == "postgresql":
+        for (table_name, plan) in plans.items():
+            create_trade_table(engine, plan.spec_list, table_name)
+        with engine.begin() as conn:
+            conn.execute('ALTER TABLE control ADD PRIMARY KEY (comcode);')
+
+
+def benchmark_size(rows, work_dir, engine, seed = 0):
+    """Runs every stage over one month of fixtures with `rows` records per trade file.
+
+    :param rows: Records per trade file.
+    :type rows: int
+    :param work_dir: Directory for the fixtures; emptied first.
+    :type work_dir: pathlib.Path() object, or str.
+    :param engine: SQLAlchemy Engine to load into; SQLite or Postgres.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param seed: Random seed for the fixtures.
+    :type seed: int
+    :return: List of stage results, each with the `size` benchmarked.
+    """
+    work_dir = Path(work_dir)
+    shutil.rmtree(work_dir, ignore_errors = True)
+
+    print(f"Generating fixtures with {rows:,} rows per trade file...")
+    generate_fixtures(work_dir, rows = rows, zipped = True, nested = True, seed = seed)
+    plans = load_table_plans(work_dir / "lookups")
+    prepare_database(engine, plans)
+    method = "copy" if engine.dialect.name == "postgresql" else "to_sql"
+
+    results = []
+    measure(results, "unzip", None, rows * (len(plans) - 1), unzip_trade_data, work_dir)
+
+    for path in sorted(x for x in work_dir.iterdir() if x.is_file()):
+        table_name = file_table(path)
+        plan = plans[table_name]
+
+        if table_name == "control":
+            data = measure(results, "parse", table_name, None, etl_control_table, path, plan.spec_list)
+            if engine.dialect.name == "postgresql":
+                measure(results, "load", table_name, len(data), upsert_control_table, data, engine, True)
+            continue
+
+        def parse():
+            with FooterlessFile(path) as trade_file:
+                return read_trade_table(trade_file, plan.column_names, categorical = plan.categorical)
+
+        data = measure(results, "parse", table_name, rows, parse)
+        data = measure(results, "convert", table_name, rows, plan.convert, data, file_period(path))
+        data = measure(results, "recode", table_name, rows, plan.recode_columns, data)
+        measure(results, "load", table_name, rows, write_trade_table,
+                data, engine, table_name, plan.dtype_dict, method)
+        del data
+
+    for result in results:
+        result["size"] = rows
+    return results
+
+
+def run_info(engine):
+    """Where and on what a benchmark ran, saved with its results."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output = True,
+                                text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"started_at": datetime.now().isoformat(timespec = "seconds"),
+            "commit": commit,
+            "python": platform.python_version(),
+            "pandas": pd.__version__,
+            "sqlalchemy": sqlalchemy.__version__,
+            "platform": platform.platform(),
+            "database": engine.dialect.name}
+
+
+def save_results(run, results_dir = RESULTS_DIR):
+    """Writes a benchmark run to `results_dir` as `YYYYmmdd-HHMMSS.json`, returning the path."""
+    results_dir = Path(results_dir)
+    results_dir.mkdir(parents = True, exist_ok = True)
+    path = results_dir / (datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    path.write_text(json.dumps(run, indent = 2))
+    return path
+
+
+def compare_results(previous, current):
+    """Prints each stage's time in `current` against `previous`, for the stages both runs have.
+
+    :param previous: Earlier run, as saved by `save_results`.
+    :type previous: Dict
+    :param current: Later run.
+    :type current: Dict
+    :return: pandas.DataFrame of seconds and peak MB before and after, per size, stage and table.
+    """
+    keys = ["size", "stage", "table"]
+    before = pd.DataFrame(previous["results"]).fillna({"table": "all"}).set_index(keys)
+    after = pd.DataFrame(current["results"]).fillna({"table": "all"}).set_index(keys)
+
+    comparison = pd.DataFrame({
+        "seconds_before": before["seconds"],
+        "seconds_after": after["seconds"],
+        "peak_mb_before": before["peak_rss_bytes"] / 1024 ** 2,
+        "peak_mb_after": after["peak_rss_bytes"] / 1024 ** 2
+    }).dropna(subset = ["seconds_before", "seconds_after"])
+    comparison["speedup"] = comparison["seconds_before"] / comparison["seconds_after"]
+
+    print(f"Compared with {previous['started_at']} (commit {previous['commit']}):")
+    print(comparison.round(2).to_string())
+    return comparison
+
+
+# MAIN #########################################################################
+def main(argv = None, prog = None):
+    """Entry point of `tradedata benchmark`; `argv` defaults to the command line."""
+
+    # Parse Arguments
+    parser = argparse.ArgumentParser(prog = prog, description="Benchmark the ETL stages over synthetic trade files.")
+    parser.add_argument("--rows", type=int, nargs = "+",
+                        help="Rows per trade file; each size is benchmarked in turn.",
+                        default = BENCHMARK_SIZES)
+    parser.add_argument("--work_dir",
+                        help="Directory for the fixtures and SQLite database; defaults to a temporary directory.",
+                        default = None)
+    parser.add_argument("--database_url",
+                        help=f"SQLAlchemy URL of a local database to load into, in its {BENCHMARK_SCHEMA} schema for Postgres; defaults to SQLite in the work directory.",
+                        default = None)
+    parser.add_argument("--force", action = "store_true",
+                        help="Allow a --database_url other than Postgres, dropping its tables named as the trade tables.")
+    parser.add_argument("--results_dir", help="Directory the results are saved to.", default = RESULTS_DIR)
+    parser.add_argument("--compare", help="Earlier results file to compare this run with.", default = None)
+    parser.add_argument("--seed", type=int, help="Random seed for the fixtures.", default = 0)
+    args = parser.parse_args(argv)
+
+    work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix = "tradedata-benchmark-"))
+    work_dir.mkdir(parents = True, exist_ok = True)
+    try:
+        engine = benchmark_engine(args.database_url, work_dir, args.force)
+    except ValueError as e:
+        parser.error(str(e))
+
+    run = run_info(engine)
+    run["results"] = []
+    for rows in args.rows:
+        run["results"].extend(benchmark_size(rows, work_dir / "fixtures", engine, args.seed))
+    engine.dispose()
+
+    path = save_results(run, args.results_dir)
+    print(f"Results saved to {path}")
+
+    if args.compare is not None:
+        compare_results(json.loads(Path(args.compare).read_text()), run)
+
+    if args.work_dir is None:
+        shutil.rmtree(work_dir, ignore_errors = True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+TITLE: Command Line
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+The `tradedata` command, with one subcommand per script:
+
+    tradedata download -t data/ --min_year 2010 --max_year 2019
+    tradedata unzip -t data/
+    tradedata create --workers 4
+    tradedata update -t data/monthlyupdate/ -y 20 -m 01
+    tradedata backfill --from 201901 --to 202012
+    tradedata status
+    tradedata coverage --from 201001 --to 202012
+    tradedata serve --port 8080
+    tradedata mirror --mirror_dir data/mirror
+    tradedata fixtures --dest data/fixtures --rows 10000
+    tradedata benchmark --rows 10000 1000000
+
+`tradedata <command> --help` lists each subcommand's options. Only the module
+of the subcommand being run is imported, and only once the command line has
+been read, so `tradedata status` doesn't pay for pandas, bs4 and friends.
+Installed as a console script by the `[tool.poetry.scripts]` entry in
+`pyproject.toml`; `python -m tradedata.cli` works too.
+"""
+
+import sys
+import argparse
+import importlib
+
+# Subcommand : (module, entry point, description)
+COMMANDS = {
+    "download": ("tradedata.initialise.download_data", "main", "Download and unzip the yearly trade data archives."),
+    "unzip": ("tradedata.initialise.download_data", "unzip_main", "Unzip downloaded archives, including nested zips."),
+    "create": ("tradedata.initialise.create_database", "main", "Create and populate the trade data database."),
+    "update": ("tradedata.update.monthly_update", "main", "Load a recent month's trade data to the database."),
+    "backfill": ("tradedata.update.backfill", "main", "Load a range of months, pipelining the stages."),
+    "status": ("tradedata.update.check_trade_records", "status_main", "Show the latest load of each table."),
+    "coverage": ("tradedata.update.check_trade_records", "coverage_main", "Show the months loaded per trade table."),
+    "serve": ("tradedata.api.app", "main", "Serve the HTTP API over the trade tables."),
+    "mirror": ("tradedata.mirror.export", "main", "Export the loaded trade tables to the Parquet mirror."),
+    "fixtures": ("tradedata.fixtures", "main", "Write synthetic trade files for testing and benchmarks."),
+    "benchmark": ("tradedata.benchmark", "main", "Benchmark the ETL stages over synthetic trade files.")
+}
+
+
+# FUNCTIONS ####################################################################
+def main(argv = None):
+    """Runs the subcommand named in `argv`, which defaults to the command line; returns its exit status."""
+    parser = argparse.ArgumentParser(
+        prog = "tradedata",
+        description = "ETL HMRC's trade data into PostgreSQL.",
+        epilog = "commands:\n" + "\n".join(f"  {name:<10} {x[2]}" for (name, x) in COMMANDS.items()),
+        formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices = list(COMMANDS), metavar = "command",
+                        help="One of the commands below; `tradedata <command> --help` for its options.")
+    parser.add_argument("args", nargs = argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    (module, function, _) = COMMANDS[args.command]
+    entry_point = getattr(importlib.import_module(module), function)
+    entry_point(args.args, prog = f"tradedata {args.command}")
+    return 0
+
+
+# MAIN #########################################################################
+if __name__ == '__main__':
+    sys.exit(main())
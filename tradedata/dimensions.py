@@ -0,0 +1,237 @@
+"""
+TITLE: Dimension Cache
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+In-memory code to label maps of the lookup tables, for adding readable labels
+to query results without joining the lookups in every query.
+
+The `clearance`, `country`, `port` and `quantity` lookups and the `control`
+commodity table are small, and change only when they are loaded. Each is read
+once into a `CodeMap`: a sorted numpy array of codes and an array of labels
+aligned with it, looked up a column at a time with a binary search
+(`numpy.searchsorted`). Results are labelled with `enrich_rows` (lists of row
+dicts, as the API returns) or `enrich` (DataFrames), which add a
+`<column>_label` for each column in `LABELLED_COLUMNS`:
+
+    cache = dimension_cache(engine)
+    rows = cache.enrich_rows(rows)        # cod_code -> cod_code_label, ...
+
+Every load of a lookup table, and every control file upserted, is recorded in
+the load ledger, so the cache follows the ledger: at most every
+`check_interval` seconds it counts the finished loads of each lookup table,
+and reloads the tables whose count or latest finish time has moved.
+
+Comcodes are matched on their first 8 digits, so the check digit of the trade
+and control tables' comcodes doesn't stop a `comcode` level aggregate's codes
+being labelled.
+"""
+
+import time
+import threading
+
+import numpy as np
+
+from sqlalchemy import select, func, and_, table, column
+from sqlalchemy.exc import DBAPIError
+
+from tradedata.ledger import load_ledger
+
+# Dimension : (lookup table, code column, label column, characters of the code matched on)
+DIMENSIONS = {
+    "clearance": ("clearance", "code", "name", None),
+    "country": ("country", "code", "name", None),
+    "port": ("port", "code", "name", None),
+    "quantity": ("quantity", "code", "name", None),
+    "comcode": ("control", "comcode", "description", 8)
+}
+
+# Column : dimension its codes are labelled from
+LABELLED_COLUMNS = {
+    "comcode": "comcode",
+    "cod_code": "country",
+    "coo_code": "country",
+    "port_code": "port",
+    "supp_unit_eu": "quantity",
+    "supp_unit_non_eu": "quantity"
+}
+
+# Seconds between checks of the load ledger for reloaded lookup tables
+CHECK_INTERVAL = 30
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# FUNCTIONS ####################################################################
+class CodeMap:
+    """Codes and their labels, in arrays sorted by code.
+
+    :param codes: Codes; whitespace (e.g. the padding of `char` columns) is stripped.
+    :type codes: Sequence of str.
+    :param labels: Label of each code.
+    :type labels: Sequence of str.
+    :param width: Characters of each code to match on; None for all of them.
+    :type width: int
+    """
+
+    def __init__(self, codes, labels, width = None):
+        self.width = width
+        codes = self.normalise(codes)
+        order = np.argsort(codes, kind = "stable")
+        self.codes = codes[order]
+        self.labels = np.asarray(labels, dtype = object)[order]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def normalise(self, values):
+        values = np.char.strip(np.asarray(values, dtype = str))
+        return values if self.width is None else values.astype(f"U{self.width}")
+
+    def lookup(self, values):
+        """Labels of `values`, with None for codes not in the map.
+
+        :param values: Codes to look up.
+        :type values: Sequence of str, or numpy.ndarray
+        :return: numpy object array of labels, aligned with `values`.
+        """
+        values = self.normalise(values)
+        if len(self.codes) == 0:
+            return np.full(len(values), None, dtype = object)
+        position = np.minimum(np.searchsorted(self.codes, values), len(self.codes) - 1)
+        return np.where(self.codes[position] == values, self.labels[position], None)
+
+    def lookup_column(self, values):
+        """Labels of a DataFrame column; a categorical column is looked up once per category."""
+        categories = getattr(values, "cat", None)
+        if categories is None:
+            return self.lookup(values.to_numpy())
+        labels = np.append(self.lookup(categories.categories.to_numpy()), None)
+        return labels[categories.codes.to_numpy()]
+
+
+class DimensionCache:
+    """Code to label maps of the lookup tables, reloaded as the load ledger records loads of them.
+
+    :param engine: SQLAlchemy Engine holding the lookup tables and the load ledger.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param dimensions: Dimension : (table, code column, label column, code width), as `DIMENSIONS`.
+    :type dimensions: Dict
+    :param check_interval: Seconds between checks of the ledger for reloaded lookup tables.
+    :type check_interval: float
+    """
+
+    def __init__(self, engine, dimensions = DIMENSIONS, check_interval = CHECK_INTERVAL):
+        self.engine = engine
+        self.dimensions = dimensions
+        self.check_interval = check_interval
+        self.tables = sorted({x[0] for x in dimensions.values()})
+        self._lock = threading.RLock()
+        self._maps = {}
+        self._versions = {}     # table : (finished loads, latest finished_at) when its maps were read
+        self._checked = None    # time.monotonic() of the last ledger check
+        self.stats = {"checks": 0, "reloads": 0}
+
+    def ledger_versions(self):
+        """Number of finished loads and latest finish time of each lookup table in the ledger.
+
+        :return: Dict of table : (count, finished_at), or None if the ledger can't be read.
+        """
+        query = select([load_ledger.c.table_name, func.count(), func.max(load_ledger.c.finished_at)]) \
+            .where(and_(load_ledger.c.table_name.in_(self.tables), load_ledger.c.finished_at.isnot(None))) \
+            .group_by(load_ledger.c.table_name)
+        try:
+            with self.engine.connect() as conn:
+                return {row[0]: (row[1], row[2]) for row in conn.execute(query)}
+        except DBAPIError:
+            return None
+
+    def read_table(self, table_name):
+        """Reads the maps of the dimensions held in a lookup table; a missing table gives empty maps."""
+        dimensions = {name: x for (name, x) in self.dimensions.items() if x[0] == table_name}
+        if not self.engine.has_table(table_name):
+            return {name: CodeMap([], [], x[3]) for (name, x) in dimensions.items()}
+
+        maps = {}
+        with self.engine.connect() as conn:
+            for (name, (_, code, label, width)) in dimensions.items():
+                query = select([column(code), column(label)]).select_from(table(table_name)) \
+                    .where(column(code).isnot(None))
+                rows = conn.execute(query).fetchall()
+                maps[name] = CodeMap([x[0] for x in rows], [x[1] for x in rows], width)
+        return maps
+
+    def refresh(self, force = False):
+        """Reloads the lookup tables loaded since they were last read, or all of them if `force`.
+
+        :return: List of the tables reloaded.
+        """
+        with self._lock:
+            versions = self.ledger_versions()
+            self.stats["checks"] += 1
+            reload = [x for x in self.tables if force or x not in self._versions
+                      or (versions is not None and versions.get(x) != self._versions[x])]
+            for table_name in reload:
+                self._maps = {**self._maps, **self.read_table(table_name)}
+                self._versions[table_name] = None if versions is None else versions.get(table_name)
+                self.stats["reloads"] += 1
+            self._checked = time.monotonic()
+            return reload
+
+    def maps(self):
+        """Dimension : CodeMap, refreshed first if `check_interval` has passed since the last check of the ledger."""
+        if self._checked is None or time.monotonic() - self._checked >= self.check_interval:
+            self.refresh()
+        return self._maps
+
+    def lookup(self, dimension, values):
+        """Labels of codes of a dimension; see `CodeMap.lookup`."""
+        return self.maps()[dimension].lookup(values)
+
+    def enrich_rows(self, rows, columns = None):
+        """Adds a `<column>_label` to row dicts for each labelled column they have.
+
+        :param rows: Rows, all with the same keys.
+        :type rows: List of dicts.
+        :param columns: Column : dimension to label; defaults to `LABELLED_COLUMNS`.
+        :type columns: Dict
+        :return: New list of new row dicts; `rows` is left as it is, so cached results can be labelled.
+        """
+        if not rows:
+            return list(rows)
+        columns = LABELLED_COLUMNS if columns is None else columns
+        maps = self.maps()
+        labels = {f"{name}_label": maps[dimension].lookup([row[name] for row in rows]).tolist()
+                  for (name, dimension) in columns.items() if name in rows[0]}
+        return [dict(row, **{key: values[i] for (key, values) in labels.items()})
+                for (i, row) in enumerate(rows)]
+
+    def enrich(self, frame, columns = None):
+        """Adds a `<column>_label` column to a DataFrame for each labelled column it has.
+
+        :param frame: Query results or processed trade data.
+        :type frame: pandas.DataFrame
+        :param columns: Column : dimension to label; defaults to `LABELLED_COLUMNS`.
+        :type columns: Dict
+        :return: New DataFrame with the label columns.
+        """
+        columns = LABELLED_COLUMNS if columns is None else columns
+        maps = self.maps()
+        return frame.assign(**{f"{name}_label": maps[dimension].lookup_column(frame[name])
+                               for (name, dimension) in columns.items() if name in frame.columns})
+
+    def info(self):
+        """Size of each map, and ledger check / reload counters."""
+        with self._lock:
+            return dict(self.stats, sizes = {name: len(x) for (name, x) in self._maps.items()})
+
+
+def dimension_cache(engine, check_interval = CHECK_INTERVAL):
+    """Returns the process's DimensionCache for `engine`, creating it on first use."""
+    key = str(engine.url)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = DimensionCache(engine, check_interval = check_interval)
+        return _caches[key]
@@ -0,0 +1,428 @@
+"""
+TITLE: Synthetic Fixtures
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Writes synthetic trade files in the layout of the UKTradeInfo releases, for
+benchmarking and trying out the ETL without downloading anything.
+
+    tradedata fixtures --dest data/fixtures --rows 1000000 --zip --nested
+
+Each SMKE19 / SMKI19 / SMKX46 / SMKM46 file has a header and footer record and
+`rows` pipe delimited records, with skewed comcode, country and port
+frequencies. EU files include 13th month (`0YYYY13`) and all-zero periods, and
+non-EU files some late declarations for the previous month. The SMKA12 control
+file is windows-1252 with 27 columns, or 28 with the description split in two,
+plus some short garbage rows.
+
+Files can be zipped one per archive as they are published monthly, or nested
+inside a yearly archive (`SMKE19_2020archive.zip` holding `SMKE192001.zip`).
+The table specifications and recodes matching the files are written to
+`<dest>/lookups`, so `load_table_plans(<dest>/lookups)` can process them,
+along with country and port lookups for the codes used. `load_fixture_database`
+loads the lot into Postgres or SQLite, e.g. for the API:
+
+    tradedata fixtures --dest data/fixtures --database_url sqlite:///fixtures.db
+"""
+
+import json
+import shutil
+import zipfile
+import argparse
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import create_engine
+
+from tradedata.initialise.table_plan import TRADE_FILES, TABLE_SPECS, load_table_plans, file_table
+from tradedata.initialise.create_database import LOOKUP_DTYPES, create_trade_table, create_and_load_lookup_tables
+from tradedata.initialise.create_database import etl_control_table, load_control_table, load_trade_table, file_period
+from tradedata.ledger import create_load_ledger, recorded_load, file_checksum
+from tradedata.rollups import build_rollups
+
+# Rows generated and written at a time
+CHUNK_ROWS = 250000
+
+# Distinct comcodes drawn from in the trade files
+COMCODE_COUNT = 9000
+
+COUNTRIES = ["AE", "AU", "BE", "BR", "CA", "CH", "CN", "CZ", "DE", "DK", "ES", "FI", "FR", "GR",
+             "HK", "HU", "IE", "IL", "IN", "IT", "JP", "KR", "MX", "MY", "NL", "NO", "NZ", "PL",
+             "PT", "QA", "RO", "RU", "SA", "SE", "SG", "TH", "TR", "TW", "US", "VN", "ZA"]
+
+PORTS = ["LHR", "DOV", "FXT", "SOU", "LGW", "MAN", "EMA", "TIL", "IMM", "HUL", "BEL", "LIV",
+         "STN", "PME", "HRH", "GRG", "ABD", "BRS", "CWL", "EDI", "NCL", "PLY", "TEE", "LTN"]
+
+# Mode of transport code : name, as in `recode_mode_of_transport.json`
+MODES_OF_TRANSPORT = {"0": "Unknown", "1": "Sea", "2": "Rail", "3": "Road", "4": "Air",
+                      "5": "Post", "7": "Fixed Installations", "8": "Inland Waterway",
+                      "9": "Own Propulsion"}
+
+NON_EU_EXPORT_COLUMNS = [
+    {"name": "comcode", "type": "char(9)"},
+    {"name": "sitc", "type": "char(5)"},
+    {"name": "record_type", "type": "char(3)"},
+    {"name": "cod_code", "type": "char(2)"},
+    {"name": "date", "type": "date"},
+    {"name": "port_code", "type": "char(3)"},
+    {"name": "border_mot", "type": "varchar(20)"}, # recoded to mode of transport names
+    {"name": "inland_mot", "type": "varchar(20)"},
+    {"name": "suppression", "type": "char(1)"},
+    {"name": "value", "type": "bigint"},
+    {"name": "net_mass", "type": "bigint"},
+    {"name": "supp_unit", "type": "bigint"},
+    {"name": "filler", "type": "skip"}
+]
+
+NON_EU_IMPORT_COLUMNS = NON_EU_EXPORT_COLUMNS[0:4] + [{"name": "coo_code", "type": "char(2)"}] + NON_EU_EXPORT_COLUMNS[4:]
+
+EU_TRADE_COLUMNS = [
+    {"name": "comcode", "type": "char(9)"},
+    {"name": "sitc", "type": "char(5)"},
+    {"name": "record_type", "type": "char(3)"},
+    {"name": "cod_code", "type": "char(2)"},
+    {"name": "date", "type": "date"},
+    {"name": "nature_of_transaction", "type": "char(3)"},
+    {"name": "value", "type": "bigint"},
+    {"name": "net_mass", "type": "bigint"},
+    {"name": "supp_unit", "type": "bigint"},
+    {"name": "filler", "type": "skip"}
+]
+
+CONTROL_COLUMNS = [
+    {"name": "comcode", "type": "text"},
+    {"name": "sitc", "type": "text"},
+    {"name": "supp_unit_eu", "type": "text"},
+    {"name": "supp_unit_non_eu", "type": "text"},
+    {"name": "description", "type": "text"}
+]
+
+FIXTURE_SPECS = {
+    "controlfilecols.json": CONTROL_COLUMNS,
+    "noneuexportcols.json": NON_EU_EXPORT_COLUMNS,
+    "noneuimportcols.json": NON_EU_IMPORT_COLUMNS,
+    "eutradecols.json": EU_TRADE_COLUMNS
+}
+
+# Table : file prefix
+TABLE_PREFIXES = {table: prefix for (prefix, table) in TRADE_FILES.items()}
+
+
+# FUNCTIONS ####################################################################
+def write_lookups(lookups_dir):
+    """Writes the table specifications and mode of transport recodes matching the fixtures."""
+    lookups_dir = Path(lookups_dir)
+    lookups_dir.mkdir(parents = True, exist_ok = True)
+    for (filename, columns) in FIXTURE_SPECS.items():
+        (lookups_dir / filename).write_text(json.dumps({"columns": columns}, indent = 2))
+    (lookups_dir / "recode_mode_of_transport.json").write_text(json.dumps(MODES_OF_TRANSPORT, indent = 2))
+
+    # Lookups in the column order of LOOKUP_DTYPES, with made up names
+    pd.DataFrame({"name": [f"Country {x}" for x in COUNTRIES], "code": COUNTRIES,
+                  "seq": [f"{i:03d}" for i in range(len(COUNTRIES))]}) \
+        .to_csv(lookups_dir / "country_lookup.csv", index = False)
+    pd.DataFrame({"name": [f"Port {x}" for x in PORTS], "code": PORTS,
+                  "seq": [f"{i:03d}" for i in range(len(PORTS))], "type": "Port"}) \
+        .to_csv(lookups_dir / "port_lookup.csv", index = False)
+
+
+def fixture_comcodes(count = COMCODE_COUNT, seed = 0):
+    """Distinct 8 digit comcodes followed by a check digit, as they appear in the trade files."""
+    rng = np.random.default_rng(seed)
+    codes = 1000000 + rng.choice(97000000, size = count, replace = False)
+    return np.array([f"{x:08d}{x % 10}" for x in np.sort(codes)], dtype = object)
+
+
+def skewed_choice(rng, values, size, power = 2.0):
+    """Draws from `values`, with earlier values more frequent, like codes in real trade data."""
+    values = np.asarray(values, dtype = object)
+    return values[(rng.random(size) ** power * len(values)).astype(np.int64)]
+
+
+def period_strings(rng, table_name, year, month, size):
+    """Period column for a trade file covering `year` / `month`, in its table's format.
+
+    Non-EU files hold some late declarations for the previous month. EU files
+    hold some 13th month (annual adjustment) and all-zero periods.
+    """
+    if table_name in ("exports", "imports"):
+        previous = (year, month - 1) if month > 1 else (year - 1, 12)
+        formats = np.array([f"{month:02d}/{year}", f"{previous[1]:02d}/{previous[0]}"], dtype = object)
+        return formats[(rng.random(size) < 0.05).astype(np.int64)]
+
+    formats = np.array([f"0{year}{month:02d}", f"0{year}13", "0000000"], dtype = object)
+    return formats[np.searchsorted([0.98, 0.995], rng.random(size), side = "right")]
+
+
+def trade_chunk(rng, table_name, columns, comcodes, year, month, size):
+    """Generates `size` raw records of a trade file as a DataFrame of strings."""
+    generated = {
+        "comcode": skewed_choice(rng, comcodes, size),
+        "sitc": skewed_choice(rng, [f"{x:05d}" for x in range(0, 99999, 997)], size),
+        "record_type": np.full(size, "000", dtype = object),
+        "cod_code": skewed_choice(rng, COUNTRIES, size),
+        "coo_code": skewed_choice(rng, COUNTRIES, size, power = 1.5),
+        "date": period_strings(rng, table_name, year, month, size),
+        "port_code": skewed_choice(rng, PORTS, size),
+        "border_mot": skewed_choice(rng, ["0" + x for x in MODES_OF_TRANSPORT], size, power = 1.2),
+        "inland_mot": skewed_choice(rng, list(MODES_OF_TRANSPORT), size, power = 1.2),
+        "suppression": np.where(rng.random(size) < 0.01, "1", " "),
+        "nature_of_transaction": skewed_choice(rng, ["110", "120", "210", "300", "400", "999"], size),
+        "value": np.round(rng.lognormal(8, 2.5, size)).astype(np.int64),
+        "net_mass": np.round(rng.lognormal(6, 2.5, size)).astype(np.int64),
+        "supp_unit": rng.integers(0, 10000, size),
+        "filler": np.full(size, "", dtype = object)
+    }
+    return pd.DataFrame({x["name"]: generated[x["name"]] for x in columns})
+
+
+def write_trade_file(path, table_name, columns, rows, year, month, comcodes, seed = 0):
+    """Writes a trade file with a header, `rows` records and a footer.
+
+    :param path: File to write.
+    :type path: pathlib.Path() object, or str.
+    :param table_name: Table the file loads into; sets the period format.
+    :type table_name: String
+    :param columns: Specification of the file's columns.
+    :type columns: List of Dictionaries with keys `name` and `type`.
+    :param rows: Number of records.
+    :type rows: int
+    :param year: Year the file covers.
+    :type year: int
+    :param month: Month the file covers.
+    :type month: int
+    :param comcodes: Comcodes (with check digits) to draw from, e.g. from `fixture_comcodes`.
+    :type comcodes: numpy.ndarray
+    :param seed: Random seed.
+    :type seed: int
+    :return: Path of the file written.
+    """
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+    prefix = TABLE_PREFIXES[table_name]
+    with open(path, "w", encoding = "utf-8", newline = "") as f:
+        f.write(f"000000000|{prefix}|{year % 100:02d}{month:02d}|HEADER\n")
+        for start in range(0, rows, CHUNK_ROWS):
+            chunk = trade_chunk(rng, table_name, columns, comcodes, year, month, min(CHUNK_ROWS, rows - start))
+            f.write(chunk.to_csv(sep = "|", header = False, index = False))
+        f.write(f"999999999|{rows}|TRAILER\n")
+    return path
+
+
+def write_control_file(path, comcodes, year, month, columns = 27, seed = 0):
+    """Writes an SMKA12 control file, one record per comcode, in windows-1252.
+
+    :param path: File to write.
+    :type path: pathlib.Path() object, or str.
+    :param comcodes: Comcodes (with check digits) to describe.
+    :type comcodes: numpy.ndarray
+    :param year: Year the file covers.
+    :type year: int
+    :param month: Month the file covers.
+    :type month: int
+    :param columns: 27, or 28 to split each description over two columns.
+    :type columns: int
+    :param seed: Random seed.
+    :type seed: int
+    :return: Path of the file written.
+    """
+    assert columns in (27, 28), "`columns` must be 27 or 28."
+    rng = np.random.default_rng(seed)
+    path = Path(path)
+
+    words = ["live", "bovine", "animals", "fresh", "chilled", "frozen", "café", "crème", "of",
+             "parts", "machinery", "other", "woven", "fabrics", "cotton", "steel", "articles"]
+    with open(path, "w", encoding = "windows-1252", newline = "") as f:
+        f.write(f"000000000|SMKA12|{year % 100:02d}{month:02d}|HEADER\r\n")
+        for (i, comcode) in enumerate(comcodes):
+            description = " ".join(rng.choice(words, size = rng.integers(2, 9)))
+            row = [comcode] + [f"{rng.integers(0, 99):02d}" for _ in range(25)] + [f" {description} "]
+            row[1] = "\0" if i % 997 == 0 else row[1]
+            if columns == 28:
+                cut = len(description) // 2
+                row[26:27] = [description[:cut], description[cut:]]
+            f.write("|".join(row) + "\r\n")
+            if i % 1000 == 999:
+                f.write("99|garbage\r\n")
+        f.write(f"999999999|{len(comcodes)}|TRAILER\r\n")
+    return path
+
+
+def zip_fixtures(paths, nested = False):
+    """Zips each file into its own archive alongside it, removing the file.
+
+    :param paths: Trade files to zip.
+    :type paths: List of pathlib.Path() objects.
+    :param nested: Group the monthly archives into one yearly archive per file prefix.
+    :type nested: bool
+    :return: List of archive paths.
+    """
+    archives = []
+    for path in paths:
+        archive = path.with_name(path.name + ".zip")
+        with zipfile.ZipFile(archive, "w", compression = zipfile.ZIP_DEFLATED) as z:
+            z.write(path, path.name)
+        path.unlink()
+        archives.append(archive)
+
+    if not nested:
+        return archives
+
+    yearly = {}
+    for archive in archives:
+        (prefix, yy) = (archive.name[0:6], archive.name[6:8])
+        yearly.setdefault(archive.with_name(f"{prefix}_20{yy}archive.zip"), []).append(archive)
+
+    for (outer, inner) in yearly.items():
+        with zipfile.ZipFile(outer, "w", compression = zipfile.ZIP_STORED) as z:
+            for archive in inner:
+                z.write(archive, archive.name)
+                archive.unlink()
+    return sorted(yearly)
+
+
+def generate_fixtures(dest, rows = 10000, year = 2020, months = (1,), tables = None,
+                      control_rows = None, control_columns = 27, zipped = False, nested = False, seed = 0):
+    """Writes a set of synthetic trade files, and their lookups, to `dest`.
+
+    :param dest: Directory for the files; the lookups go in `dest/lookups`.
+    :type dest: pathlib.Path() object, or str.
+    :param rows: Records per trade file.
+    :type rows: int
+    :param year: Year the files cover.
+    :type year: int
+    :param months: Months to write a file for, per table.
+    :type months: List of int.
+    :param tables: Tables to write files for; defaults to all of them, including control.
+    :type tables: List of str.
+    :param control_rows: Comcodes in each control file; defaults to those drawn from in the trade files.
+    :type control_rows: int
+    :param control_columns: Columns of the control file, 27 or 28.
+    :type control_columns: int
+    :param zipped: Zip each file into its own archive.
+    :type zipped: bool
+    :param nested: With `zipped`, nest the monthly archives in a yearly one.
+    :type nested: bool
+    :param seed: Random seed; the same arguments and seed always write the same files.
+    :type seed: int
+    :return: List of paths written (archives if `zipped`).
+    """
+    dest = Path(dest)
+    dest.mkdir(parents = True, exist_ok = True)
+    write_lookups(dest / "lookups")
+    tables = list(TABLE_PREFIXES) if tables is None else tables
+
+    comcodes = fixture_comcodes(seed = seed)
+    paths = []
+    for (i, table_name) in enumerate(tables):
+        columns = FIXTURE_SPECS[TABLE_SPECS[table_name]]
+        for month in months:
+            path = dest / f"{TABLE_PREFIXES[table_name]}{year % 100:02d}{month:02d}"
+            file_seed = seed * 10000 + i * 100 + month
+            if table_name == "control":
+                codes = comcodes if control_rows is None else fixture_comcodes(control_rows, seed = file_seed)
+                paths.append(write_control_file(path, codes, year, month, control_columns, file_seed))
+            else:
+                paths.append(write_trade_file(path, table_name, columns, rows, year, month, comcodes, file_seed))
+
+    if zipped:
+        paths = zip_fixtures(paths, nested)
+    return paths
+
+
+def load_fixture_database(engine, dest):
+    """Creates the tables and loads the fixtures `generate_fixtures` wrote to `dest`.
+
+    Works on Postgres, loading as `tradedata create` does, or on SQLite, where
+    trade tables are INSERTed by pandas and the control file is written
+    without an upsert. Every load is recorded in the ledger and the rollups
+    are built, so the API can serve the database. Zipped fixtures are skipped.
+
+    :param engine: SQLAlchemy Engine for an empty Postgres or SQLite database.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param dest: Directory the fixtures were written to.
+    :type dest: pathlib.Path() object, or str.
+    :return: Dict of table : rows loaded.
+    """
+    dest = Path(dest)
+    postgres = engine.dialect.name == "postgresql"
+    plans = load_table_plans(dest / "lookups")
+
+    # Ledger first, so there are no tables to seed it from
+    create_load_ledger(engine)
+    for (table_name, plan) in plans.items():
+        create_trade_table(engine, plan.spec_list, table_name)
+    if postgres:
+        with engine.begin() as conn:
+            conn.execute('ALTER TABLE control ADD PRIMARY KEY (comcode)')
+
+    for (table_name, lookup_dtypes) in LOOKUP_DTYPES.items():
+        path = dest / "lookups" / f"{table_name}_lookup.csv"
+        if path.exists():
+            create_and_load_lookup_tables(engine, path, table_name, lookup_dtypes)
+
+    counts = {}
+    for path in sorted(x for x in dest.glob("SMK*") if x.is_file() and x.suffix != ".zip"):
+        table_name = file_table(path)
+        plan = plans[table_name]
+        if table_name == "control" and postgres:
+            rows = sum(load_control_table(path, engine, plan.spec_list).values())
+        elif table_name == "control":
+            with recorded_load(engine, "control", file_period(path), path, file_checksum(path)) as entry:
+                data = etl_control_table(path, plan.spec_list).drop_duplicates(subset = "comcode", keep = "last")
+                data.to_sql("control", engine, if_exists = "append", index = False)
+                rows = entry["row_count"] = len(data)
+        else:
+            rows = load_trade_table(path, engine, table_name, plan.spec_list, plan.recode_dict,
+                                    plan.date_format, method = "copy" if postgres else "to_sql")
+        counts[table_name] = counts.get(table_name, 0) + rows
+
+    build_rollups(engine, [x for x in counts if x != "control"])
+    return counts
+
+
+# MAIN #########################################################################
+def main(argv = None, prog = None):
+    """Entry point of `tradedata fixtures`; `argv` defaults to the command line."""
+
+    # Parse Arguments
+    parser = argparse.ArgumentParser(prog = prog, description="Write synthetic trade files for testing and benchmarks.")
+    parser.add_argument("--dest", help="Directory to write the files to.", default = "data/fixtures")
+    parser.add_argument("--rows", type=int, help="Records per trade file.", default = 10000)
+    parser.add_argument("--year", type=int, help="Year the files cover.", default = 2020)
+    parser.add_argument("--months", type=int, nargs = "+", help="Months to write files for.", default = [1])
+    parser.add_argument("--tables", nargs = "+", choices = list(TABLE_PREFIXES),
+                        help="Tables to write files for; defaults to all.", default = None)
+    parser.add_argument("--control_rows", type=int,
+                        help="Comcodes in each control file; defaults to the comcodes used in the trade files.",
+                        default = None)
+    parser.add_argument("--control_columns", type=int, choices = [27, 28],
+                        help="Columns in the control file; 28 splits the description in two.", default = 27)
+    parser.add_argument("--zip", action = "store_true", help="Zip each file into its own archive.")
+    parser.add_argument("--nested", action = "store_true", help="With --zip, nest monthly archives in yearly ones.")
+    parser.add_argument("--seed", type=int, help="Random seed.", default = 0)
+    parser.add_argument("--clean", action = "store_true", help="Empty the destination directory first.")
+    parser.add_argument("--database_url",
+                        help="SQLAlchemy URL of an empty database to load the fixtures into (without --zip), "
+                             "e.g. sqlite:///fixtures.db.",
+                        default = None)
+    args = parser.parse_args(argv)
+
+    if args.clean:
+        shutil.rmtree(args.dest, ignore_errors = True)
+
+    paths = generate_fixtures(args.dest, args.rows, args.year, args.months, args.tables,
+                              args.control_rows, args.control_columns, args.zip, args.nested, args.seed)
+    for path in paths:
+        print(f"Wrote {path}")
+
+    if args.database_url is not None:
+        assert not args.zip, "Zipped fixtures can't be loaded; leave out --zip."
+        load_fixture_database(create_engine(args.database_url), args.dest)
+
+
+if __name__ == '__main__':
+    main()
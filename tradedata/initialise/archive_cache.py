@@ -0,0 +1,271 @@
+"""
+TITLE: Archive Cache
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Persistent, content-addressed cache of downloaded trade data archives.
+
+Archives are stored once under `objects/` by the SHA-256 of their contents, and
+a JSON manifest maps each URL to its object, the ETag / Last-Modified it was
+served with and the members it extracts to. Extracted members are kept under
+`extracted/<sha256>/`, so a run that has already fetched a month can be repeated
+without any network I/O; `revalidate = True` checks the server with a
+conditional GET instead. When the cache grows beyond `max_bytes` the least
+recently used archives (and their extracted members) are evicted.
+"""
+
+import json
+import time
+import shutil
+import hashlib
+import zipfile
+import threading
+from pathlib import Path
+
+from concurrent.futures import ThreadPoolExecutor
+
+from tradedata.initialise.download_data import download_file
+from tradedata.initialise.download_data import DownloadResult
+
+
+class ArchiveCache:
+    """Content-addressed cache of archives and their extracted members.
+
+    :param cache_dir: Directory holding the cache. Created if it does not exist.
+    :type cache_dir: pathlib.Path() object, or str.
+    :param max_bytes: Size above which least recently used archives are evicted.
+    :type max_bytes: int
+    """
+
+    def __init__(self, cache_dir = "data/cache", max_bytes = 20 * 1024 ** 3):
+        self.root = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.manifest_path = self.root / "manifest.json"
+        self._lock = threading.RLock()
+
+        (self.root / "objects").mkdir(parents = True, exist_ok = True)
+        (self.root / "extracted").mkdir(exist_ok = True)
+        (self.root / "tmp").mkdir(exist_ok = True)
+
+        if self.manifest_path.exists():
+            self.manifest = json.loads(self.manifest_path.read_text())
+        else:
+            self.manifest = {"archives": {}, "links": {}}
+
+
+    # Manifest ---------------------------------------------------------------------------
+    def _save(self):
+        """Atomically writes the manifest to disk."""
+        tmp = self.manifest_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.manifest, indent = 1))
+        tmp.replace(self.manifest_path)
+
+    def object_path(self, sha256):
+        """Path of the archive with the given content hash."""
+        return self.root / "objects" / sha256[0:2] / sha256
+
+    def entry(self, url):
+        """Manifest entry for `url`, or None if it is not cached."""
+        entry = self.manifest["archives"].get(url)
+        if entry is None or not self.object_path(entry["sha256"]).exists():
+            return None
+        return entry
+
+    def _touch(self, url):
+        self.manifest["archives"][url]["last_used"] = time.time()
+        self._save()
+
+
+    # Fetching ---------------------------------------------------------------------------
+    def links(self, key, fetch, max_age = 24 * 60 * 60):
+        """Returns a cached list of links, calling `fetch()` if missing or older than `max_age` seconds.
+
+        Used to avoid re-scraping the index pages with `get_hyperlinks` on every run.
+        """
+        with self._lock:
+            cached = self.manifest["links"].get(key)
+            if cached and time.time() - cached["fetched"] < max_age:
+                return cached["links"]
+
+        links = fetch()
+        with self._lock:
+            self.manifest["links"][key] = {"fetched": time.time(), "links": links}
+            self._save()
+        return links
+
+    def cached_urls(self):
+        """URLs with an archive currently in the cache."""
+        with self._lock:
+            return [url for url in self.manifest["archives"] if self.entry(url)]
+
+    def fetch(self, url, session, revalidate = False, **kwargs):
+        """Returns the path of the cached archive for `url`, downloading it if necessary.
+
+        A cached archive is returned without any network I/O unless `revalidate`
+        is set, in which case a conditional GET is made with the stored ETag /
+        Last-Modified and the archive is only downloaded again if it changed.
+
+        :param url: URL of the archive.
+        :type url: String
+        :param session: Session to make requests with.
+        :type session: requests.Session
+        :param revalidate: Check a cached archive is still current with the server.
+        :type revalidate: bool
+        :param kwargs: Passed on to `download_file`.
+        :raises IOError: If the archive could not be downloaded.
+        :return: pathlib.Path of the archive within the cache.
+        """
+        with self._lock:
+            entry = self.entry(url)
+            if entry and not revalidate:
+                self._touch(url)
+                return self.object_path(entry["sha256"])
+
+        # Each URL downloads into its own directory so concurrent fetches don't collide
+        tmp_dir = self.root / "tmp" / hashlib.sha256(url.encode()).hexdigest()[0:16]
+        validators = {"etag": entry.get("etag"), "last_modified": entry.get("last_modified")} if entry else {}
+        result = download_file(url, tmp_dir, session, **validators, **kwargs)
+
+        if result.status == "not_modified":
+            with self._lock:
+                self._touch(url)
+            return self.object_path(entry["sha256"])
+        if result.status == "failed":
+            raise IOError(f"Could not download {url}: {result.error}")
+
+        sha256 = file_sha256(result.path)
+        target = self.object_path(sha256)
+        target.parent.mkdir(exist_ok = True)
+        if target.exists():
+            result.path.unlink() # Identical content already cached under another URL/version
+        else:
+            result.path.replace(target)
+
+        with self._lock:
+            self.manifest["archives"][url] = {
+                "sha256": sha256, "size": result.bytes,
+                "etag": result.etag, "last_modified": result.last_modified,
+                "fetched": time.time(), "last_used": time.time(),
+                "members": None, "extracted_size": 0
+            }
+            self._save()
+            self.evict(keep = [url])
+
+        return target
+
+
+    def fetch_all(self, urls, session, workers = 4, revalidate = False):
+        """Fetches several archives concurrently with `fetch`.
+
+        :return: List of DownloadResult in the order of `urls`; archives served from the cache have status "cached".
+        """
+        def fetch_one(url):
+            before = self.entry(url)
+            fetched = before["fetched"] if before else None
+            try:
+                path = self.fetch(url, session, revalidate)
+            except IOError as e:
+                return DownloadResult(url, None, "failed", 0, None, repr(e))
+            entry = self.entry(url)
+            if entry["fetched"] != fetched:
+                status = "downloaded"
+            else:
+                status = "not_modified" if revalidate else "cached"
+            return DownloadResult(url, path, status, entry["size"], None, None,
+                                  entry["etag"], entry["last_modified"])
+
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            return list(pool.map(fetch_one, urls))
+
+
+    # Extraction -------------------------------------------------------------------------
+    def members(self, url):
+        """Names of the files an archive extracts to, nested zips flattened, from the manifest.
+
+        :return: List of member names, or None if the archive has not been extracted yet.
+        """
+        entry = self.entry(url)
+        return entry["members"] if entry else None
+
+    def extract(self, url):
+        """Extracts a cached archive, including any nested zips, and returns its member paths.
+
+        Members are extracted once into `extracted/<sha256>/` and reused on
+        subsequent calls.
+
+        :param url: URL of an archive already in the cache (see `fetch`).
+        :type url: String
+        :raises KeyError: If `url` is not cached.
+        :return: List of pathlib.Path of the extracted members.
+        """
+        with self._lock:
+            entry = self.entry(url)
+            if entry is None:
+                raise KeyError(f"{url} is not in the archive cache")
+
+            out_dir = self.root / "extracted" / entry["sha256"]
+            if entry["members"] is not None and all((out_dir / x).exists() for x in entry["members"]):
+                self._touch(url)
+                return [out_dir / x for x in entry["members"]]
+
+            # Unpack, then iteratively unpack nested zips into the same directory
+            shutil.rmtree(out_dir, ignore_errors = True)
+            out_dir.mkdir(parents = True)
+            with zipfile.ZipFile(self.object_path(entry["sha256"])) as z:
+                z.extractall(out_dir)
+            nested = [x for x in out_dir.rglob("*") if x.suffix.lower() == ".zip"]
+            while nested:
+                for archive in nested:
+                    with zipfile.ZipFile(archive) as z:
+                        z.extractall(out_dir)
+                    archive.unlink()
+                nested = [x for x in out_dir.rglob("*") if x.suffix.lower() == ".zip"]
+
+            members = sorted(str(x.relative_to(out_dir)) for x in out_dir.rglob("*") if x.is_file())
+            entry["members"] = members
+            entry["extracted_size"] = sum((out_dir / x).stat().st_size for x in members)
+            entry["last_used"] = time.time()
+            self._save()
+            self.evict(keep = [url])
+
+        return [out_dir / x for x in members]
+
+
+    # Eviction ---------------------------------------------------------------------------
+    def size(self):
+        """Total bytes of cached archives and extracted members."""
+        objects = {e["sha256"]: e["size"] + e.get("extracted_size", 0)
+                   for e in self.manifest["archives"].values()}
+        return sum(objects.values())
+
+    def evict(self, keep = []):
+        """Removes least recently used archives until the cache fits within `max_bytes`.
+
+        :param keep: URLs that must not be evicted (e.g. the one just fetched).
+        :type keep: List of str.
+        """
+        with self._lock:
+            archives = self.manifest["archives"]
+            candidates = sorted((url for url in archives if url not in keep),
+                                key = lambda url: archives[url]["last_used"])
+
+            for url in candidates:
+                if self.size() <= self.max_bytes:
+                    break
+                sha256 = archives.pop(url)["sha256"]
+                if not any(e["sha256"] == sha256 for e in archives.values()):
+                    if self.object_path(sha256).exists():
+                        self.object_path(sha256).unlink()
+                    shutil.rmtree(self.root / "extracted" / sha256, ignore_errors = True)
+
+            self._save()
+
+
+def file_sha256(path, block_size = 1024 * 1024):
+    """SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
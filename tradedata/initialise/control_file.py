@@ -0,0 +1,87 @@
+"""
+TITLE: Control File
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Streaming parser for the SMKA12 control file (comcode lookups), and the record
+hashes used to upsert only the comcodes that changed.
+
+The control file is read a line at a time and only the five fields loaded
+(columns 0, 7, 24, 25 and 26) are kept, so memory use follows the number of
+comcodes rather than the size of the file. Some releases split the description
+over a 28th column; the two halves are merged row by row.
+
+Each comcode's record is hashed, and the hashes of the records last loaded are
+kept in the `control_hash` table. A monthly release changes a few hundred
+codes, so comparing hashes lets `upsert_control_table` stage and merge only
+the codes that were added or changed.
+"""
+
+import hashlib
+
+from sqlalchemy import MetaData, Table, Column
+from sqlalchemy import Text, BigInteger
+from sqlalchemy import select
+
+# Columns of the control file that are loaded, in specification order
+CONTROL_FIELDS = [0, 7, 24, 25, 26]
+
+# Fewest columns a control record can have; shorter rows are garbage
+CONTROL_MIN_COLUMNS = 27
+
+metadata = MetaData()
+
+control_hash = Table(
+    "control_hash", metadata,
+    Column("comcode", Text, primary_key = True),
+    Column("record_hash", BigInteger, nullable = False)
+)
+
+
+# FUNCTIONS ####################################################################
+def create_control_hash(engine):
+    """Creates the `control_hash` table if it does not already exist."""
+    metadata.create_all(engine, tables = [control_hash])
+
+
+def parse_control_lines(lines):
+    """Yields the loaded fields of each record in the lines of a control file.
+
+    The header (first line) and footer (last line) are skipped, as are rows
+    with fewer than `CONTROL_MIN_COLUMNS` columns. Fields are stripped, and the
+    comcode loses its trailing check digit.
+
+    :param lines: Lines of the control file, e.g. an open text file.
+    :type lines: Iterable of str.
+    :return: Generator of tuples of (comcode, field 7, field 24, field 25, description).
+    """
+    lines = iter(lines)
+    next(lines, None)   # Header
+
+    # Hold one line back, so the last line (the footer) is never parsed
+    previous = next(lines, None)
+    for line in lines:
+        row = previous.rstrip("\r\n").replace("\0", "").split("|")
+        previous = line
+        if len(row) < CONTROL_MIN_COLUMNS:
+            continue
+
+        description = row[26].strip()
+        if len(row) == 28:
+            description = (description + " " + row[27].strip()).strip()
+
+        yield (row[0][0:-1].strip(), row[7].strip(), row[24].strip(), row[25].strip(), description)
+
+
+def record_hash(record):
+    """Signed 64 bit hash of a control record's fields, stable between runs."""
+    digest = hashlib.blake2b("|".join(record).encode(), digest_size = 8).digest()
+    return int.from_bytes(digest, "big", signed = True)
+
+
+def read_control_hashes(engine):
+    """Returns a Dict of comcode : record hash for the control records last loaded."""
+    with engine.connect() as conn:
+        rows = conn.execute(select([control_hash.c.comcode, control_hash.c.record_hash]))
+        return {comcode: value for (comcode, value) in rows}
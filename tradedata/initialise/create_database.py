@@ -7,66 +7,53 @@ DESCRIPTION:
 Programatically create and populate the Trade Data Database.
 """
 
-import json
 import pandas as pd
-import re
 import os
+import time
+import tempfile
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pathlib import Path
 from datetime import datetime
-from datetime import timedelta
 
-from sqlalchemy import create_engine
-from sqlalchemy import MetaData
-from sqlalchemy import Table, Column, String, Integer, Float, Boolean, BigInteger, Text, CHAR, Date
-from sqlalchemy import ForeignKey, Index, PrimaryKeyConstraint
-from sqlalchemy.dialects.postgresql import insert
-
-from tradedata.utils import read_credentials
+from sqlalchemy import MetaData, Sequence
+from sqlalchemy import Table, Column, String, Integer, BigInteger, Text, Date
+from sqlalchemy import inspect
+from sqlalchemy import ForeignKey, PrimaryKeyConstraint
+
+from tradedata.utils import read_credentials, connect_to_postgres
+from tradedata.utils import ArchiveMember, data_path, open_data_file
+from tradedata.initialise.download_data import walk_archives
+from tradedata.initialise.table_plan import parse_specification
+from tradedata.initialise.table_plan import compile_plan, load_table_plans, file_table
+from tradedata.initialise.control_file import parse_control_lines, record_hash
+from tradedata.initialise.control_file import create_control_hash, read_control_hashes
+from tradedata.ledger import create_load_ledger, recorded_load, file_checksum
+from tradedata.initialise.partitions import PARTITION_GRANULARITIES
+from tradedata.initialise.partitions import create_default_partition, ensure_partition
+from tradedata.initialise.partitions import partition_default_rows
+from tradedata.initialise.indices import INDEX_SPECS, index_name, build_indices, drop_indices
+from tradedata.rollups import build_rollups
+from tradedata.metrics import stage, iter_stage, add_metrics_arguments, configure_from_args
+
+# Load methods accepted by `load_trade_table`; `copy` streams through Postgres
+# COPY, `to_sql` is the (much slower) pandas INSERT fallback.
+LOAD_METHODS = ["copy", "to_sql"]
+
+# Bytes held in memory before the COPY buffer spills to a temporary file.
+COPY_BUFFER_SIZE = 64 * 1024 * 1024
+
+# Lookup table : dtypes of the columns of its `<table>_lookup.csv`, in order
+LOOKUP_DTYPES = {
+    "clearance": {"name":Text, "seq":String(3), "code":String(3)},
+    "country": {"name":Text, "code":String(2), "seq":String(3)},
+    "port": {"name":Text, "code":String(3), "seq":String(3), "type":Text},
+    "quantity": {"code":Text, "name":Text}
+}
 
 # FUNCTIONS ####################################################################
 
-def connect_to_postgres(username = "", password = "", host = "localhost", database = ""):
-    """Returns a SQLAlchemy PostgreSQL engine using psycopg2"""
-    engine = create_engine(f'postgresql+psycopg2://{username}:{password}@{host}/{database}')
-    return engine
-
-
-def parse_specification(dict_list):
-    """Returns a Dictionary of name : SQLAlchemy dtypes from specification jsons"""
-
-    names = [x["name"] for x in dict_list]
-
-    dtypes = []
-    for column in dict_list:
-        if column["type"] == "boolean":
-            dtypes.append(Boolean())
-        elif column["type"] == "date":
-            dtypes.append(Date())
-        elif column["type"] == "integer":
-            dtypes.append(Integer())
-        elif column["type"] == "bigint":
-            dtypes.append(BigInteger())
-        elif column["type"] == "float":
-            dtypes.append(Float())
-        elif column["type"] == "text":
-            dtypes.append(Text())
-        elif re.findall("varchar", column["type"]):
-            stringlength = int(re.findall("[0-9]+", column["type"])[0])
-            dtypes.append(String(stringlength))
-        elif re.findall("char", column["type"]):
-            stringlength = int(re.findall("[0-9]+", column["type"])[0])
-            dtypes.append(CHAR(stringlength))
-        else:
-            dtypes.append("REMOVE")
-
-    dtypes_dict = dict(zip(names,dtypes))
-    dtypes_dict = {name:dtype for (name,dtype) in dtypes_dict.items() if not dtype == "REMOVE"}
-
-    return dtypes_dict
-
-
-
-def create_trade_table(engine, dict_list, table_name):
+def create_trade_table(engine, dict_list, table_name, partition_by = None):
     """Create table according to specification in `dict_list`.
 
     :param engine: SQLAlchemy PostgreSQL Engine class.
@@ -75,23 +62,47 @@ def create_trade_table(engine, dict_list, table_name):
     :type dict_list: list of dictionaries, all of which contain a `name` and `type` key.
     :param table_name: Name for the table to be created.
     :type table_name: String
+    :param partition_by: If "month" or "year", create the table range partitioned on `date` with a default partition; partitions for each period are added by `ensure_partition`.
+    :type partition_by: String
     :raises AssertionError: Throws an error if `dict_list` is not a list.
     :raises AssertionError: Throws an error if all the dicts in `dict_list` do not contain a `name` and `type` key.
     :return: Does not return anything; builds the table in Postgres Database supplied by `engine`.
     """
     assert type(dict_list) == type([]), "dict_list is not a list"
     assert all(['name' in x.keys() and 'type' in x.keys() for x in dict_list]), "dict_list dicts do not all contain 'name' and 'type' keys"
+    assert partition_by is None or partition_by in PARTITION_GRANULARITIES, f"partition_by must be one of {PARTITION_GRANULARITIES}"
 
     # Generate Columns for Table. Ignore REMOVEs
     table_spec = parse_specification(dict_list)
 
+    metadata = MetaData()
+
+    # Row id from a sequence, giving the API a stable keyset to paginate on.
+    # Not a primary key, since those must include the partition key. SQLite
+    # (the API's stand-in) has no sequences; its integer primary key numbers rows instead.
     columns = []
+    if table_name != "control" and engine.dialect.name != "postgresql":
+        columns.append(Column("id", Integer, primary_key = True))
+    elif table_name != "control":
+        id_seq = Sequence(f"{table_name}_id_seq", metadata = metadata)
+        columns.append(Column("id", BigInteger, server_default = id_seq.next_value(), nullable = False))
     for column in table_spec.keys():
         columns.append(Column(column, table_spec[column]))
 
-    metadata = MetaData()
-    data = Table(table_name, metadata, *columns)
+    # Month of the file each row came from, which can differ from its `date`
+    if table_name != "control":
+        columns.append(Column("load_period", Date))
+
+    options = {}
+    if partition_by is not None:
+        options["postgresql_partition_by"] = "RANGE (date)"
+
+    data = Table(table_name, metadata, *columns, **options)
     metadata.create_all(engine)
+
+    if partition_by is not None:
+        create_default_partition(engine, table_name)
+
     print(f"Table {table_name} Created Successfully!")
 
 
@@ -107,24 +118,26 @@ def create_and_load_lookup_tables(engine, filepath, table_name, dtype_dict):
     :type table_name: String
     :param dtype_dict: Dictionary with table column names as keys and SQLAlchemy Column Types as values.
     :type dtype_dict: Dict
-    :return: Does not return anything; builds the table in Postgres Database supplied by `engine`.
+    :return: Does not return anything; builds the table in Postgres Database supplied by `engine` and records the load in the load ledger.
     """
 
-    lookup = pd.read_csv(filepath, dtype="object", keep_default_na=False)
-    lookup.columns = dtype_dict.keys()
-    lookup.to_sql(table_name,
-                  engine,
-                  if_exists='replace',
-                  index=False,
-                  dtype=dtype_dict)
+    with recorded_load(engine, table_name, None, filepath, file_checksum(filepath)) as entry:
+        lookup = pd.read_csv(filepath, dtype="object", keep_default_na=False)
+        lookup.columns = dtype_dict.keys()
+        lookup.to_sql(table_name,
+                      engine,
+                      if_exists='replace',
+                      index=False,
+                      dtype=dtype_dict)
+        entry["row_count"] = len(lookup)
 
 
 
 def etl_control_table(path, spec_list):
     """Loads and manipulates the Control files (Comcode Lookups)
 
-    :param path: Path to the Trade Data File
-    :type path: pathlib.Path() object, or str.
+    :param path: Path to the Control File
+    :type path: pathlib.Path() object, str, or ArchiveMember.
     :param spec_list: Specification for the data file to be loaded.
     :type spec_list: List of Dictionaries with keys `name` and `type`.
     :raises AssertionError: If the `name` column is not found in every dict contained within the spec_list argument, the function will fail.
@@ -133,36 +146,139 @@ def etl_control_table(path, spec_list):
     assert type(spec_list) == type([]), "`spec_list` is not a list."
     assert all(["name" in x.keys() for x in spec_list]), "`name` column not found in all column specifications in `spec_list`"
 
-    # Read Control File as string, kill NULs and split by newline & delim into list of lists
-    path = Path(path)
-    x_file = open(path, "r", encoding = "windows-1252").read().replace("\0","").split("\n")
-    x_file = [x.split("|") for x in x_file]
+    # Stream the file, keeping only the loaded fields of each record
+    with stage("parse", file = path, table = "control", bytes = file_size(path)) as s, \
+         open_data_file(path, encoding = "windows-1252") as f:
+        data = pd.DataFrame.from_records(list(parse_control_lines(f)),
+                                         columns = [x["name"] for x in spec_list])
+        s.rows = len(data)
 
-    # Kill first, last and second last row. Kill garbage rows with fewer than 27 columns
-    x_file = x_file[1:-2]
-    x_file = [row for row in x_file if len(row) >= 27]
+    return data
 
-    # If len(x_file[i] == 28), there is a double description column that needs to be merged.
-    if len(x_file[0]) == 28:
-        for i in range(len(x_file)):
-            x_file[i][26] = x_file[i][26].strip() + " " + x_file[i].pop().strip()
 
-    # Convert To DataFrame, make pretty
-    data = pd.DataFrame(x_file)
-    data = data.iloc[:,[0,7,24,25,26]]
-    data.columns = [x["name"] for x in spec_list]
-    data["comcode"] = data["comcode"].str[0:-1]
-    data = data.apply(lambda x: x.str.strip())
 
-    return data
+def file_period(path):
+    """Returns the month a trade file covers, taken from the `YYMM` suffix of its name.
+
+    :param path: Path to the Trade Data File, e.g. `SMKM462001`.
+    :type path: pathlib.Path() object, str, or ArchiveMember.
+    :return: `datetime.date` for the first day of the month.
+    """
+    return datetime.strptime(data_path(path).stem[-4:] + "01", "%y%m%d").date()
+
+
+def file_size(path):
+    """Size in bytes of a data file on disk, or None for a file inside an archive."""
+    return None if isinstance(path, ArchiveMember) else Path(path).stat().st_size
+
+
+
+class FooterlessFile:
+    """Read-only text stream over a trade file that withholds its final line.
+
+    Trade files end in a footer record that does not match the column layout.
+    `pd.read_csv(skipfooter = 1)` would drop it, but forces the Python parser
+    and cannot be combined with `chunksize`. Wrapping the file in this class
+    lets the C parser read it in chunks without ever seeing the footer.
+    """
+
+    def __init__(self, path, block_size = 1024 * 1024):
+        self._file = open_data_file(path, encoding = "utf-8", newline = "")
+        self._block_size = block_size
+        self._held = ""
+        self._eof = False
+
+    def read(self, size = -1):
+        if self._eof:
+            return ""
+
+        block = self._file.read(self._block_size if size is None or size < 0 else max(size, 1))
+        data = self._held + block
+
+        if not block:
+            # End of file; release everything bar the last non-empty line.
+            self._eof = True
+            self._held = ""
+            cut = data.rstrip("\r\n").rfind("\n")
+            return data[:cut + 1]
+
+        # Hold back the (possibly incomplete) last line and the complete line before it.
+        cut = data.rfind("\n")
+        cut = data.rfind("\n", 0, cut) if cut > 0 else -1
+        self._held = data[cut + 1:]
+        released = data[:cut + 1]
+
+        # Never return "" before EOF, since readers take that to mean EOF.
+        return released if released else self.read(size)
+
+    def __iter__(self):
+        pending = ""
+        while True:
+            data = self.read()
+            if not data:
+                if pending:
+                    yield pending
+                return
+            lines = (pending + data).splitlines(keepends = True)
+            pending = lines.pop() if not lines[-1].endswith("\n") else ""
+            yield from lines
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+
+def read_trade_table(trade_file, column_names, chunksize = None, categorical = ()):
+    """Reads a Trade Data File as strings, without its header and footer rows.
+
+    :param trade_file: Open Trade Data File.
+    :type trade_file: FooterlessFile
+    :param column_names: Names for the columns in the file.
+    :type column_names: List of str.
+    :param chunksize: If given, return an iterator of DataFrames of at most this many rows.
+    :type chunksize: int
+    :param categorical: Columns to read straight into categoricals rather than object strings.
+    :type categorical: List of str.
+    :return: DataFrame, or iterator of DataFrames if `chunksize` is given.
+    """
+    dtype = {x: "category" if x in categorical else "str" for x in column_names}
+    return pd.read_csv(trade_file, sep = "|", header = None,
+                       names = column_names, dtype = dtype,
+                       skiprows = 1, keep_default_na = False,
+                       chunksize = chunksize)
+
+
+
+def transform_trade_table(data, spec_list, recode_dict, date_format, period):
+    """Converts data types and recodes columns of a raw trade DataFrame.
+
+    :param data: Raw data, as returned by `read_trade_table`.
+    :type data: pandas.DataFrame
+    :param spec_list: Specification for the data file to be loaded.
+    :type spec_list: List of Dictionaries with keys `name` and `type`.
+    :param recode_dict: Dict of Dicts that specifies recoding for data columns.
+    :type recode_dict: Dictionary with keys corresponding to column names from `spec_list`.
+    :param date_format: `strptime` Date String to transform date columns.
+    :type date_format: String.
+    :param period: Month the file covers, as returned by `file_period`.
+    :type period: datetime.date
+    :return: Returns a processed DataFrame.
+    """
+    return compile_plan(spec_list, recode_dict, date_format).transform(data, period)
 
 
 
 def etl_trade_table(path, spec_list, recode_dict, date_format):
     """Loads and manipulates the EU/NonEU Import/Export files
 
-    :param path: Path to the Trade Data File
-    :type path: pathlib.Path() object, or str.
+    :param path: Path to the Trade Data File, or a file within a zip archive.
+    :type path: pathlib.Path() object, str, or ArchiveMember.
     :param spec_list: Specification for the data file to be loaded.
     :type spec_list: List of Dictionaries with keys `name` and `type`.
     :param recode_dict: Dict of Dicts that specifies recoding for data columns.
@@ -172,117 +288,577 @@ def etl_trade_table(path, spec_list, recode_dict, date_format):
     :raises AssertionError: If the `name` or `type` column is not found in every dict contained within the spec_list argument, the function will fail.
     :return: Returns a processed DataFrame.
     """
-    assert type(path) == type("") or type(path) == type(Path(".")), "`path` is not a pathlib Path or string."
+    assert type(path) == type("") or type(path) == type(Path(".")) or isinstance(path, ArchiveMember), "`path` is not a pathlib Path, string or ArchiveMember."
     assert type(spec_list) == type([]), "`spec_list` is not a list."
     assert all(["name" in x.keys() for x in spec_list]), "`name` column not found in all column specifications in `spec_list`"
     assert all(["type" in x.keys() for x in spec_list]), "`type` column not found in all column specifications in `spec_list`"
     assert type(recode_dict) == type({}), "`recode_dict` is not a dictionary."
 
     # Load Table
-    path = Path(path)
-    column_names = [x["name"] for x in spec_list]
-    data = pd.read_csv(path, sep = "|", header = None,
-                       names = column_names, dtype = 'str',
-                       skiprows = 1, skipfooter = 1, keep_default_na = False)
-
-    # Process spec_list
-    specification = pd.DataFrame(spec_list)
-
-    # Convert Column DataTypes
-    for i in range(0,len(specification)):
-        column = specification["name"][i]
-        col_dtype = specification["type"][i]
-
-        # Special handling for 13 month dates in EU Trade
-        if re.findall("date", col_dtype):
-            dates = data[column]
-            dates_transformed = [""] * len(data)
-            for i,date in enumerate(dates):
-                if re.search("020..13", date):
-                    date_transformed = datetime.strptime(date[0:5] + "12", date_format).date()
-                    date_transformed = date_transformed + timedelta(days = 30) # Set to YYYY/12/31
-                    dates_transformed[i] = date_transformed
-                elif date == "0000000":
-                    dates_transformed[i] = datetime.strptime(str(trade_file)[-4:] + "01", "%y%m%d").date() # Set to current year/month
-                else:
-                    dates_transformed[i] = datetime.strptime(date, date_format).date()
-            data[column] = dates_transformed
-        # All Other Types
-        elif re.findall("char", col_dtype) or re.findall("str", col_dtype):
-            data[column] = data[column].astype("str")
-        elif re.findall("bigint", col_dtype):
-            data[column] = data[column].astype("int64")
-        elif re.findall("int", col_dtype):
-            data[column] = data[column].astype("int32")
-        elif re.findall("float", col_dtype):
-            data[column] = data[column].astype("float")
-        elif re.findall("boo", col_dtype):
-            data[column] = data[column].astype("bool")
-        else:
-            data.drop(column, axis = 1, inplace = True)
-
-    # Recode Columns
-    for column in recode_dict.keys():
-        data[column].replace(recode_dict[column], inplace=True)
-    data["comcode"] = data["comcode"].str[0:-1]
+    path = data_path(path)
+    plan = compile_plan(spec_list, recode_dict, date_format)
+    table_name = file_table(path, strict = False)
+
+    with stage("parse", file = path, table = table_name, bytes = file_size(path)) as s:
+        with FooterlessFile(path) as trade_file:
+            data = read_trade_table(trade_file, plan.column_names, categorical = plan.categorical)
+        s.rows = len(data)
+    with stage("convert", file = path, table = table_name, rows = len(data)):
+        data = plan.convert(data, file_period(path))
+    with stage("recode", file = path, table = table_name, rows = len(data)):
+        data = plan.recode_columns(data)
 
     return data
 
 
 
-def load_control_table(path, engine, spec_list):
-    # TODO Better Docstring
-    """Does necessary transformations using etl_control_table and UPSERTs to database."""
+def etl_trade_table_chunks(path, spec_list, recode_dict, date_format, chunksize = 100000):
+    """Streaming version of `etl_trade_table` with bounded memory.
+
+    Yields processed DataFrames of at most `chunksize` rows; concatenated, they
+    are identical to the output of `etl_trade_table`.
+
+    :param path: Path to the Trade Data File, or a file within a zip archive.
+    :type path: pathlib.Path() object, str, or ArchiveMember.
+    :param spec_list: Specification for the data file to be loaded.
+    :type spec_list: List of Dictionaries with keys `name` and `type`.
+    :param recode_dict: Dict of Dicts that specifies recoding for data columns.
+    :type recode_dict: Dictionary with keys corresponding to column names from `spec_list`.
+    :param date_format: `strptime` Date String to transform date columns.
+    :type date_format: String.
+    :param chunksize: Maximum number of rows per chunk.
+    :type chunksize: int
+    :raises AssertionError: If the `name` or `type` column is not found in every dict contained within the spec_list argument, the function will fail.
+    :return: Generator of processed DataFrames.
+    """
+    assert type(path) == type("") or type(path) == type(Path(".")) or isinstance(path, ArchiveMember), "`path` is not a pathlib Path, string or ArchiveMember."
+    assert type(spec_list) == type([]), "`spec_list` is not a list."
+    assert all(["name" in x.keys() for x in spec_list]), "`name` column not found in all column specifications in `spec_list`"
+    assert all(["type" in x.keys() for x in spec_list]), "`type` column not found in all column specifications in `spec_list`"
+    assert type(recode_dict) == type({}), "`recode_dict` is not a dictionary."
+    assert chunksize > 0, "`chunksize` must be positive."
+
+    path = data_path(path)
+    plan = compile_plan(spec_list, recode_dict, date_format)
+    period = file_period(path)
+    table_name = file_table(path, strict = False)
+
+    with FooterlessFile(path) as trade_file:
+        chunks = read_trade_table(trade_file, plan.column_names, chunksize = chunksize,
+                                  categorical = plan.categorical)
+        for chunk in iter_stage("parse", chunks, file = path, table = table_name):
+            with stage("convert", file = path, table = table_name, rows = len(chunk)):
+                chunk = plan.convert(chunk, period)
+            with stage("recode", file = path, table = table_name, rows = len(chunk)):
+                chunk = plan.recode_columns(chunk)
+            yield chunk
+
+
+
+def load_control_table(path, engine, spec_list, full = False, data = None):
+    """Does necessary transformations using etl_control_table and UPSERTs to database.
+
+    The load is recorded in the load ledger.
+
+    :param path: Path to the Control File
+    :type path: pathlib.Path() object, or str.
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param spec_list: Specification for the control file to be loaded.
+    :type spec_list: List of Dictionaries with keys `name` and `type`.
+    :param full: Merge every record, rather than only those whose hash has changed.
+    :type full: bool
+    :param data: The file already processed by `etl_control_table` (e.g. in another process), to load in place of parsing it again.
+    :type data: pandas.DataFrame
+    :return: Dict with counts of `inserted`, `updated` and `unchanged` rows.
+    """
+    with recorded_load(engine, "control", file_period(path), path, file_checksum(path)) as entry:
+        if data is None:
+            data = etl_control_table(path, spec_list)
+        counts = upsert_control_table(data, engine, full)
+        entry["row_count"] = sum(counts.values())
+    return counts
+
 
-    # Data load
-    data = etl_control_table(path, spec_list)
-    # Connect to Table
-    metadata = MetaData()
-    control = Table('control', metadata, autoload=True, autoload_with=engine)
 
-    # Execute Update
-    conn = engine.connect()
-    for i in range(len(data)):
-        if i % 1000 == 0: print(f"Insert: {i}/{len(data)}")
+def upsert_control_table(data, engine, full = False):
+    """UPSERTs a processed control DataFrame to the `control` table.
 
-        insert_data = dict(data.iloc[i,:])
-        insert_stmt = insert(control).values(insert_data)
-        do_update_stmt = insert_stmt.on_conflict_do_update(
-            constraint='control_pkey', set_=insert_data)
-        conn.execute(do_update_stmt)
+    Each record is hashed and compared with the hash stored in `control_hash`
+    when it was last loaded; only new and changed records are COPYed to a
+    temporary staging table and merged into `control` with a single `INSERT
+    ... SELECT ... ON CONFLICT (comcode) DO UPDATE`. Their hashes are updated
+    in the same transaction. Rows whose values have not changed are left
+    untouched.
+
+    :param data: Processed control data, as returned by `etl_control_table`.
+    :type data: pandas.DataFrame
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param full: Merge every record, rather than only those whose hash has changed; use if `control` was changed outside of these loads.
+    :type full: bool
+    :return: Dict with counts of `inserted`, `updated` and `unchanged` rows.
+    """
+
+    # Later rows win where a comcode is repeated, as with row-by-row upserts
+    data = data.drop_duplicates(subset = "comcode", keep = "last")
+
+    # Keep only the records added or changed since the last load
+    create_control_hash(engine)
+    hashes = [record_hash(x) for x in data.itertuples(index = False, name = None)]
+    stored = {} if full else read_control_hashes(engine)
+    changed = [stored.get(comcode) != value for (comcode, value) in zip(data["comcode"], hashes)]
+    staged = data[changed]
+    staged_hashes = pd.DataFrame({"comcode": staged["comcode"],
+                                  "record_hash": [x for (x, y) in zip(hashes, changed) if y]})
+
+    columns = list(data.columns)
+    dtype_dict = {column: Text() for column in columns}
+    column_list = ", ".join(f'"{x}"' for x in columns)
+    update_columns = [x for x in columns if x != "comcode"]
+    set_list = ", ".join(f'"{x}" = EXCLUDED."{x}"' for x in update_columns)
+    current = ", ".join(f'control."{x}"' for x in update_columns)
+    excluded = ", ".join(f'EXCLUDED."{x}"' for x in update_columns)
+
+    upsert_sql = f"""
+        INSERT INTO control ({column_list})
+        SELECT {column_list} FROM control_staging
+        ON CONFLICT (comcode) DO UPDATE SET {set_list}
+        WHERE ROW({current}) IS DISTINCT FROM ROW({excluded})
+        RETURNING (xmax = 0) AS inserted
+    """
+    hash_sql = """
+        INSERT INTO control_hash (comcode, record_hash)
+        SELECT comcode, record_hash FROM control_hash_staging
+        ON CONFLICT (comcode) DO UPDATE SET record_hash = EXCLUDED.record_hash
+    """
+
+    # Stage and merge in one transaction
+    results = []
+    with stage("load", table = "control", rows = len(staged), records = len(data)):
+        conn = engine.raw_connection()
+        try:
+            if len(staged):
+                with conn.cursor() as cursor:
+                    cursor.execute("CREATE TEMPORARY TABLE control_staging "
+                                   "(LIKE control INCLUDING DEFAULTS) ON COMMIT DROP")
+                    copy_dataframe(cursor, staged, "control_staging", dtype_dict)
+                    cursor.execute(upsert_sql)
+                    results = [row[0] for row in cursor.fetchall()]
+
+                    cursor.execute("CREATE TEMPORARY TABLE control_hash_staging "
+                                   "(LIKE control_hash) ON COMMIT DROP")
+                    copy_dataframe(cursor, staged_hashes, "control_hash_staging",
+                                   {"comcode": Text(), "record_hash": BigInteger()})
+                    cursor.execute(hash_sql)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    counts = {"inserted": sum(results),
+              "updated": len(results) - sum(results),
+              "unchanged": len(data) - len(results)}
+    print(f"Control: {counts['inserted']} inserted, {counts['updated']} updated, "
+          f"{counts['unchanged']} unchanged ({len(staged)} of {len(data)} records changed).")
+
+    return counts
+
+
+
+def copy_dataframe(cursor, data, table_name, dtype_dict):
+    """Streams a DataFrame into a table using Postgres `COPY FROM STDIN`.
+
+    The frame is written as CSV to a spooled buffer (in memory up to
+    `COPY_BUFFER_SIZE`, on disk beyond that) and handed to psycopg2's
+    `copy_expert`. Column order is taken from `dtype_dict`, and string columns
+    are flagged `FORCE_NOT_NULL` so that empty strings load as '' rather than
+    NULL, matching what `to_sql` would insert.
+
+    :param cursor: psycopg2 cursor; the caller owns the transaction.
+    :type cursor: psycopg2.extensions.cursor
+    :param data: Processed data to load.
+    :type data: pandas.DataFrame
+    :param table_name: Name of the table to copy into.
+    :type table_name: String
+    :param dtype_dict: Dictionary of column name : SQLAlchemy type, as returned by `parse_specification`.
+    :type dtype_dict: Dict
+    :return: Number of rows copied.
+    """
+    columns = list(dtype_dict.keys())
+    text_columns = [name for (name, dtype) in dtype_dict.items()
+                    if isinstance(dtype, (String, Text))]
+
+    column_list = ", ".join(f'"{x}"' for x in columns)
+    options = "FORMAT csv"
+    if text_columns:
+        options += ", FORCE_NOT_NULL (" + ", ".join(f'"{x}"' for x in text_columns) + ")"
+    copy_sql = f'COPY "{table_name}" ({column_list}) FROM STDIN WITH ({options})'
+
+    with tempfile.SpooledTemporaryFile(max_size=COPY_BUFFER_SIZE, mode="w+", newline="") as buffer:
+        data.to_csv(buffer, columns=columns, header=False, index=False)
+        buffer.seek(0)
+        cursor.copy_expert(copy_sql, buffer)
+
+    return len(data)
+
+
+def copy_to_table(data, engine, table_name, dtype_dict, replace_period = None):
+    """Bulk loads data with `copy_dataframe` in a single transaction.
+
+    :param data: Processed data to load; either one DataFrame or an iterable of them (e.g. from `etl_trade_table_chunks`).
+    :type data: pandas.DataFrame, or iterable of pandas.DataFrame
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Name of the table to copy into.
+    :type table_name: String
+    :param dtype_dict: Dictionary of column name : SQLAlchemy type, as returned by `parse_specification`.
+    :type dtype_dict: Dict
+    :param replace_period: Delete the rows with this `load_period` in the same transaction, before copying.
+    :type replace_period: datetime.date
+    :return: Number of rows copied.
+    """
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+
+    rows = 0
+    conn = engine.raw_connection()
+    try:
+        with conn.cursor() as cursor:
+            if replace_period is not None:
+                cursor.execute(f'DELETE FROM "{table_name}" WHERE load_period = %s', (replace_period,))
+            for frame in data:
+                rows += copy_dataframe(cursor, frame, table_name, dtype_dict)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    return rows
+
+
+def write_trade_table(data, engine, table_name, dtype_dict, method="copy", period=None, replace=False):
+    """Appends processed trade data to a table.
+
+    :param data: Processed data to load; either one DataFrame or an iterable of them.
+    :type data: pandas.DataFrame, or iterable of pandas.DataFrame
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Name of the table to append to.
+    :type table_name: String
+    :param dtype_dict: Dictionary of column name : SQLAlchemy type, as returned by `parse_specification`.
+    :type dtype_dict: Dict
+    :param method: One of `LOAD_METHODS`; `copy` (default) bulk loads with COPY, `to_sql` falls back to pandas INSERTs.
+    :type method: String.
+    :param period: Month of the file the data came from, as returned by `file_period`; written to each row as `load_period`.
+    :type period: datetime.date
+    :param replace: Delete the rows loaded from the same month's file first, in the same transaction; needs `period`.
+    :type replace: bool
+    :raises AssertionError: If `method` is not one of `LOAD_METHODS`.
+    :return: Number of rows loaded.
+    """
+    assert method in LOAD_METHODS, f"`method` must be one of {LOAD_METHODS}."
+    assert period is not None or not replace, "`replace` needs the `period` the rows were loaded with."
+
+    if isinstance(data, pd.DataFrame):
+        data = [data]
+    if period is not None:
+        data = (frame.assign(load_period = period) for frame in data)
+        dtype_dict = {**dtype_dict, "load_period": Date()}
+
+    if method == "copy":
+        return copy_to_table(data, engine, table_name, dtype_dict, period if replace else None)
+
+    rows = 0
+    with engine.begin() as conn:
+        if replace:
+            conn.execute(f'DELETE FROM "{table_name}" WHERE load_period = %s', (period,))
+        for frame in data:
+            frame.to_sql(table_name, conn, if_exists='append',
+                         index=False, dtype=dtype_dict)
+            rows += len(frame)
+    return rows
+
+
+def data_months(data):
+    """First day of each month the rows of processed trade data are dated in.
+
+    :param data: Processed data, with a `date` column of `datetime.date`.
+    :type data: pandas.DataFrame
+    :return: Set of `datetime.date`.
+    """
+    return {x.replace(day = 1) for x in data["date"].dropna().unique()}
+
+
+def loaded_months(engine, table_name, period):
+    """First day of each month the rows loaded from a month's file are dated in, i.e. the months replacing that load changes.
+
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Trade table.
+    :type table_name: String
+    :param period: `load_period` of the rows, as returned by `file_period`.
+    :type period: datetime.date
+    :return: Set of `datetime.date`.
+    """
+    with engine.connect() as conn:
+        rows = conn.execute(f"SELECT DISTINCT date_trunc('month', date)::date FROM \"{table_name}\" "
+                            "WHERE load_period = %s AND date IS NOT NULL", (period,))
+        return {row[0] for row in rows}
 
 
+def ensure_load_period(engine, table_name):
+    """Adds the `load_period` column and its index to a trade table created before they existed."""
+    if "load_period" not in {x["name"] for x in inspect(engine).get_columns(table_name)}:
+        with engine.begin() as conn:
+            conn.execute(f'ALTER TABLE "{table_name}" ADD COLUMN load_period DATE')
 
-def load_trade_table(trade_file, engine, table_name, spec_list, recode_dict, datestring):
-    # TODO Better Docstring
-    """Load Trade Table to Database"""
-    data = etl_trade_table(trade_file, spec_list, recode_dict, datestring)
-    dtype_dict = parse_specification(spec_list)
-    data.to_sql(table_name, engine, if_exists='append',
-                index=False, dtype=dtype_dict)
+    name = index_name({"table": table_name, "columns": ["load_period"]})
+    with engine.begin() as conn:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table_name}" (load_period)')
 
 
-def generate_indices(engine, index_dict):
-    # TODO Better Docstring
-    """Creates indices on multiple tables in a SQL database.
+def ensure_id(engine, table_name):
+    """Adds the `id` column, from its sequence, and its index to a trade table created before they existed.
 
-    Takes the table names as keys, and the columns as values (in a list).
+    Existing rows are numbered as the column is added, which rewrites the table
+    under an exclusive lock, so the first run on a large table takes a while.
     """
+    if "id" not in {x["name"] for x in inspect(engine).get_columns(table_name)}:
+        with engine.begin() as conn:
+            conn.execute(f'CREATE SEQUENCE IF NOT EXISTS "{table_name}_id_seq"')
+            conn.execute(f'ALTER TABLE "{table_name}" '
+                         f"ADD COLUMN id BIGINT NOT NULL DEFAULT nextval('\"{table_name}_id_seq\"')")
+            conn.execute(f'ALTER SEQUENCE "{table_name}_id_seq" OWNED BY "{table_name}".id')
 
-    for table in index_dict.keys():
-        metadata = MetaData()
-        sql_table = Table(table, metadata, autoload=True, autoload_with=engine)
+    name = index_name({"table": table_name, "columns": ["id"]})
+    with engine.begin() as conn:
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{table_name}" (id)')
 
-        for col in index_dict[table]:
-            print(f"Creating Index on Column {col} for Table {table}")
-            sql_col = sql_table.c.get(col)
-            Index(f"ix_{table}_{col}", sql_col).create(engine)
+
+def load_trade_table(trade_file, engine, table_name, spec_list, recode_dict, datestring,
+                     method="copy", chunksize=None, replace=False, data=None):
+    """Load Trade Table to Database.
+
+    :param trade_file: Path to the Trade Data File, or a file within a zip archive.
+    :type trade_file: pathlib.Path() object, str, or ArchiveMember.
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Name of the table to append to.
+    :type table_name: String
+    :param spec_list: Specification for the data file to be loaded.
+    :type spec_list: List of Dictionaries with keys `name` and `type`.
+    :param recode_dict: Dict of Dicts that specifies recoding for data columns.
+    :type recode_dict: Dictionary with keys corresponding to column names from `spec_list`.
+    :param datestring: `strptime` Date String to transform date columns.
+    :type datestring: String.
+    :param method: One of `LOAD_METHODS`; `copy` (default) bulk loads with COPY, `to_sql` falls back to pandas INSERTs.
+    :type method: String.
+    :param chunksize: If given, stream the file through `etl_trade_table_chunks` in chunks of this many rows, so memory stays flat regardless of file size.
+    :type chunksize: int
+    :param replace: Replace the rows of an earlier load of the same month's file (by their `load_period`) in the same transaction, rather than appending.
+    :type replace: bool
+    :param data: The file already processed by `etl_trade_table` (e.g. in another process), to load in place of running the ETL again; `chunksize` is then ignored.
+    :type data: pandas.DataFrame
+    :raises AssertionError: If `method` is not one of `LOAD_METHODS`.
+    :return: Number of rows loaded. The load is also recorded in the load ledger, with the months of the rows it loaded and replaced.
+    """
+    assert method in LOAD_METHODS, f"`method` must be one of {LOAD_METHODS}."
+
+    dtype_dict = compile_plan(spec_list).dtype_dict
+    checksum = file_checksum(trade_file)
+    period = file_period(trade_file)
+
+    with recorded_load(engine, table_name, period, trade_file, checksum) as entry:
+        start = time.perf_counter()
+        if data is not None:
+            data = [data]
+        elif chunksize:
+            data = etl_trade_table_chunks(trade_file, spec_list, recode_dict, datestring, chunksize)
+        else:
+            data = [etl_trade_table(trade_file, spec_list, recode_dict, datestring)]
+            start = time.perf_counter()
+
+        # Months changed: those of the rows replaced, and of each frame as it is written
+        months = loaded_months(engine, table_name, period) if replace else set()
+        def tracked(frames):
+            for frame in frames:
+                months.update(data_months(frame))
+                yield frame
+
+        # Streamed chunks are parsed as they are written, so the load stage includes their ETL
+        with stage("load", file = trade_file, table = table_name) as s:
+            rows = write_trade_table(tracked(data), engine, table_name, dtype_dict, method, period, replace)
+            s.rows = rows
+        entry["row_count"] = rows
+        entry["months"] = months
+    elapsed = time.perf_counter() - start
+
+    rate = rows / elapsed if elapsed > 0 else float("inf")
+    print(f"Loaded {rows} rows to {table_name} in {elapsed:.1f}s ({rate:,.0f} rows/s)")
+
+    return rows
+
+
+def etl_file(trade_file, table_name, spec_list, recode_dict = None, datestring = None):
+    """Runs the ETL for one file of either kind; used as the process pool worker in `parallel_load`.
+
+    :return: Processed DataFrame.
+    """
+    if table_name == "control":
+        return etl_control_table(trade_file, spec_list)
+    return etl_trade_table(trade_file, spec_list, recode_dict, datestring)
+
+
+def parallel_load(jobs, engine, workers=4, db_connections=2, method="copy"):
+    """Parses files in a process pool and loads them over a bounded number of DB connections.
+
+    Control files are parsed in parallel but upserted one at a time in the order
+    given, and all of them are loaded before any trade table. Trade files are
+    then parsed by `workers` processes and handed to `db_connections` loader
+    threads as they finish. A new file is only parsed once an earlier one has
+    been loaded or has failed, so at most `workers` parsed files are held in
+    memory at once. Every load is recorded in the load ledger.
+
+    :param jobs: Files to load, as tuples of `(trade_file, table_name, spec_list, recode_dict, datestring)`. `recode_dict` and `datestring` are ignored for `control`.
+    :type jobs: List of tuples.
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param workers: Number of parser processes.
+    :type workers: int
+    :param db_connections: Number of concurrent database loads.
+    :type db_connections: int
+    :param method: One of `LOAD_METHODS`, passed to `write_trade_table`.
+    :type method: String.
+    :return: Dict of file : result, where result is the row count (trade files), the `upsert_control_table` counts (control files), or the exception raised while processing the file.
+    """
+    assert workers > 0 and db_connections > 0, "`workers` and `db_connections` must be positive."
+
+    control_jobs = [job for job in jobs if job[1] == "control"]
+    trade_jobs = [job for job in jobs if job[1] != "control"]
+    results = {}
+
+    with ProcessPoolExecutor(max_workers = workers) as parsers:
+
+        # Control tables: parse in parallel, upsert sequentially in file order.
+        futures = [parsers.submit(etl_file, *job) for job in control_jobs]
+        for job, future in zip(control_jobs, futures):
+            trade_file = job[0]
+            try:
+                with recorded_load(engine, "control", file_period(trade_file),
+                                   trade_file, file_checksum(trade_file)) as entry:
+                    results[trade_file] = upsert_control_table(future.result(), engine)
+                    entry["row_count"] = sum(results[trade_file].values())
+            except Exception as e:
+                results[trade_file] = e
+
+        # Trade tables: parse -> load pipeline
+        remaining = iter(trade_jobs)
+        parsing = {}
+        loading = {}
+
+        def write_recorded(job, data):
+            trade_file, table_name, spec_list = job[0:3]
+            with recorded_load(engine, table_name, file_period(trade_file),
+                               trade_file, file_checksum(trade_file)) as entry, \
+                 stage("load", file = trade_file, table = table_name, rows = len(data)):
+                entry["row_count"] = write_trade_table(data, engine, table_name,
+                                                       compile_plan(spec_list).dtype_dict, method,
+                                                       file_period(trade_file))
+                entry["months"] = data_months(data)
+            return entry["row_count"]
+
+        def submit_parse():
+            job = next(remaining, None)
+            if job is not None:
+                parsing[parsers.submit(etl_file, *job)] = job
+
+        with ThreadPoolExecutor(max_workers = db_connections) as loaders:
+            for _ in range(workers):
+                submit_parse()
+
+            while parsing or loading:
+                done, _ = wait(list(parsing) + list(loading), return_when = FIRST_COMPLETED)
+                for future in done:
+                    if future in parsing:
+                        job = parsing.pop(future)
+                        try:
+                            data = future.result()
+                        except Exception as e:
+                            results[job[0]] = e
+                            submit_parse()
+                            continue
+                        loading[loaders.submit(write_recorded, job, data)] = job
+                    else:
+                        job = loading.pop(future)
+                        try:
+                            results[job[0]] = future.result()
+                            print(f"Loaded {job[0]} ({results[job[0]]} rows)")
+                        except Exception as e:
+                            results[job[0]] = e
+                        submit_parse()
+
+    # Per-file failure report
+    failures = {f:e for (f,e) in results.items() if isinstance(e, Exception)}
+    if failures:
+        print("The following files could not be loaded:")
+        for f, e in failures.items():
+            print(f"{f}: {e!r}")
+
+    return results
+
+
+def generate_indices(engine, index_dict, workers=4, maintenance_work_mem="1GB"):
+    """Creates single column indices on multiple tables in a SQL database.
+
+    Takes the table names as keys, and the columns as values (in a list), and
+    builds them with `build_indices`. For composite or BRIN indexes, pass
+    specs to `build_indices` directly.
+    """
+    specs = [{"table": table, "columns": [col]}
+             for table in index_dict.keys()
+             for col in index_dict[table]]
+    return build_indices(engine, specs, workers, maintenance_work_mem)
 
 
 
 
 # Main Program Loop
-if __name__ == '__main__':
+def main(argv = None, prog = None):
+    """Entry point of `tradedata create`; `argv` defaults to the command line."""
+
+    # Parse Arguments
+    parser = argparse.ArgumentParser(prog = prog, description="Create and populate the Trade Data database.")
+    parser.add_argument("--workers", type=int,
+                        help="Number of processes parsing files in parallel; 1 loads files one at a time.",
+                        default = 1)
+    parser.add_argument("--db_connections", type=int,
+                        help="Number of concurrent database loads when --workers is above 1.",
+                        default = 2)
+    parser.add_argument("--load_method", choices = LOAD_METHODS,
+                        help="How trade tables are loaded; `copy` bulk loads through Postgres COPY, `to_sql` uses pandas INSERTs.",
+                        default = 'copy')
+    parser.add_argument("--chunksize", type=int,
+                        help="Stream trade files in chunks of this many rows to bound memory use (serial loads only).",
+                        default = None)
+    parser.add_argument("--partition_by", choices = PARTITION_GRANULARITIES,
+                        help="Create the trade tables range partitioned on date, one partition per month or year.",
+                        default = None)
+    parser.add_argument("--index_workers", type=int,
+                        help="Number of indices built at once after the load.",
+                        default = 4)
+    parser.add_argument("--maintenance_work_mem",
+                        help="Postgres maintenance_work_mem for each index build.",
+                        default = "1GB")
+    parser.add_argument("--from_archives", action = "store_true",
+                        help="Parse trade files straight from the zip archives in data/ instead of extracted files.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
 
     # CONNECT TO DATABASE ----------------------------------------------------------------
     db_c = read_credentials("conf/credentials.yml")["database"]
@@ -292,36 +868,21 @@ if __name__ == '__main__':
     # CREATE TABLES ----------------------------------------------------------------------
 
     # Trade Tables ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Table - Table Specification JSON filepath mapping
-    table_specs = {
-        "control":"data/lookups/controlfilecols.json",
-        "exports":"data/lookups/noneuexportcols.json",
-        "imports":"data/lookups/noneuimportcols.json",
-        "dispatches":"data/lookups/eutradecols.json",
-        "arrivals":"data/lookups/eutradecols.json"
-    }
-
-    # Loop Over Dict and Create Table
-    for table in table_specs.keys():
-        spec_filepath = table_specs[table]
-        specification = json.loads(open(spec_filepath, "r").read())
-        create_trade_table(engine, specification["columns"], table)
+    # Compiled plan per table: specification, recoding and date format
+    plans = load_table_plans("data/lookups")
+
+    # Loop Over Plans and Create Table; control is never partitioned
+    for (table, plan) in plans.items():
+        partition_by = args.partition_by if table != "control" else None
+        create_trade_table(engine, plan.spec_list, table, partition_by)
+
+    # Load Ledger, recording every load below
+    create_load_ledger(engine)
 
     # Lookup Tables ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
-    # Load Data, define dtypes, load to Postgres
-    clearance_dtypes = {"name":Text, "seq":String(3), "code":String(3)}
-    country_dtypes = {"name":Text, "code":String(2), "seq":String(3)}
-    port_dtypes = {"name":Text, "code":String(3), "seq":String(3), "type":Text}
-    quantity_dtypes = {"code":Text, "name":Text}
-
-    create_and_load_lookup_tables(engine, "data/lookups/clearance_lookup.csv",
-                                  "clearance", clearance_dtypes)
-    create_and_load_lookup_tables(engine, "data/lookups/country_lookup.csv",
-                                  "country", country_dtypes)
-    create_and_load_lookup_tables(engine, "data/lookups/port_lookup.csv",
-                                  "port", port_dtypes)
-    create_and_load_lookup_tables(engine, "data/lookups/quantity_lookup.csv",
-                                  "quantity", quantity_dtypes)
+    # Load Data with the dtypes in LOOKUP_DTYPES, load to Postgres
+    for (table, lookup_dtypes) in LOOKUP_DTYPES.items():
+        create_and_load_lookup_tables(engine, f"data/lookups/{table}_lookup.csv", table, lookup_dtypes)
 
 
     # CREATE CONSTRAINTS ON ALL TABLES ---------------------------------------------------
@@ -340,60 +901,53 @@ if __name__ == '__main__':
 
 
     # LOAD DATA TO TRADE TABLES ----------------------------------------------------------
-    # File Prefix - Table Mapping
-    trade_files = {
-        "SMKA12":"control",                               # Commodity Lookups
-        "SMKE19":"exports", "SMKI19":"imports",           # Non EU Trade
-        "SMKX46":"dispatches", "SMKM46": "arrivals"       # EU Trade
-    }
-
-    # Recoding Dicts
-    recode_inland_mot = json.loads(open("data/lookups/recode_mode_of_transport.json", "r").read())
-    recode_border_mot = {"0"+x:y for (x,y) in recode_inland_mot.items()}
-
-    # Table Specifications
-    controlfilecols = json.loads(open(table_specs["control"], "r").read())
-    eutradecols = json.loads(open(table_specs["arrivals"], "r").read())
-    noneuimportcols = json.loads(open(table_specs["imports"], "r").read())
-    noneuexportcols = json.loads(open(table_specs["exports"], "r").read())
-
     # File List
     data_dir = Path("data/")
-    files = [x for x in data_dir.glob("*") if x.is_file()]
-    files.sort()
-
-    # Load data to tables
+    if args.from_archives:
+        files = walk_archives(data_dir)
+    else:
+        files = [x for x in data_dir.glob("*") if x.is_file()]
+        files.sort()
+
+    # Build load jobs: (file, table, spec, recode dict, date format)
+    jobs = []
     for trade_file in files:
-        file_type = trade_file.stem[0:6].upper()
-        table_name = trade_files[file_type]
-        print(f"Processing {trade_file}...")
+        table_name = file_table(trade_file)
+        plan = plans[table_name]
+        jobs.append((trade_file, table_name, plan.spec_list, plan.recode_dict, plan.date_format))
+
+    # Partitions for every month/year being loaded; rows dated in other months go to the default partition
+    if args.partition_by is not None:
+        for (trade_file, table_name) in {(job[0], job[1]) for job in jobs if job[1] != "control"}:
+            ensure_partition(engine, table_name, file_period(trade_file), args.partition_by)
+
+    # Load data to tables, without indices to maintain along the way
+    drop_indices(engine, INDEX_SPECS)
+    if args.workers > 1:
+        parallel_load(jobs, engine, workers = args.workers,
+                      db_connections = args.db_connections, method = args.load_method)
+    else:
+        for (trade_file, table_name, spec_list, recode_dict, datestring) in jobs:
+            print(f"Processing {trade_file}...")
+            if table_name == "control":
+                load_control_table(trade_file, engine, spec_list)
+            else:
+                load_trade_table(trade_file, engine, table_name, spec_list, recode_dict,
+                                 datestring, method = args.load_method, chunksize = args.chunksize)
+
+    # Move rows dated outside the months of their files out of the default partitions
+    if args.partition_by is not None:
+        for table_name in {job[1] for job in jobs if job[1] != "control"}:
+            partition_default_rows(engine, table_name, args.partition_by)
 
-        if table_name == "control":
-            load_control_table(trade_file, engine, controlfilecols["columns"])
 
-        elif table_name == "dispatches" or table_name == "arrivals":
-            recode_dict = {}
-            load_trade_table(trade_file, engine, table_name,
-                             eutradecols["columns"], recode_dict, "0%Y%m")
-
-        elif table_name == "imports":
-            recode_dict = {"border_mot":recode_border_mot, "inland_mot":recode_inland_mot}
-            load_trade_table(trade_file, engine, table_name,
-                             noneuimportcols["columns"], recode_dict, "%m/%Y")
+    # GENERATE INDICES ON TABLES ---------------------------------------------------------
+    build_indices(engine, INDEX_SPECS, workers = args.index_workers,
+                  maintenance_work_mem = args.maintenance_work_mem)
 
-        elif table_name == "exports":
-            recode_dict = {"border_mot":recode_border_mot, "inland_mot":recode_inland_mot}
-            load_trade_table(trade_file, engine, table_name,
-                             noneuexportcols["columns"], recode_dict, "%m/%Y")
+    # BUILD ROLLUPS ----------------------------------------------------------------------
+    build_rollups(engine, ["exports", "imports", "dispatches", "arrivals"])
 
 
-    # GENERATE INDICES ON TABLES ---------------------------------------------------------
-    indices = {
-        "imports":["comcode", "cod_code", "coo_code", "date", "port_code"],
-        "exports":["comcode", "cod_code", "date", "port_code"],
-        "arrivals":["comcode", "cod_code", "date"],
-        "dispatches":["comcode", "cod_code", "date"],
-        "control":["comcode"]
-    }
-
-    generate_indices(engine, indices)
+if __name__ == '__main__':
+    main()
@@ -7,129 +7,416 @@ DESCRIPTION:
 Functions for downloading the data from the uktradeinfo website.
 """
 
-import wget
 import os
+import shutil
 import zipfile
 import re
+import json
+import time
 import argparse
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 from urllib.parse import urlparse, urljoin
 from bs4 import BeautifulSoup
 
 from pathlib import Path
 from tqdm import tqdm
 
+from tradedata.utils import ArchiveMember, open_zip_chain
+from tradedata.metrics import stage, add_metrics_arguments, configure_from_args
+
+# UKTradeInfo site root, trade file prefixes, and the index pages listing the bulk datasets.
+BASE_URL = "https://www.uktradeinfo.com"
+TRADE_FILE_PREFIXES = ["SMKE19", "SMKI19", "SMKX46", "SMKM46", "SMKA12"]
+INDEX_PAGES = ["/trade-data/latest-bulk-datasets/bulk-datasets-archive/",
+               "/trade-data/latest-bulk-datasets/"]
+
+# Outcome of a single download. `status` is one of "downloaded", "resumed",
+# "skipped" (already complete on disk), "not_modified" (conditional GET
+# answered 304), "cached" (served by an ArchiveCache) or "failed".
+DownloadResult = namedtuple("DownloadResult", ["url", "path", "status", "bytes", "attempts", "error",
+                                               "etag", "last_modified"])
+DownloadResult.__new__.__defaults__ = (None, None)
+
+
+class StaleDownload(IOError):
+    """Raised when a partial download can't be completed; it is discarded and the next attempt starts from byte 0."""
+
+
 # FUNCTIONS ####################################################################
-def get_hyperlinks(prefixes = ["SMKE19", "SMKI19", "SMKX46", "SMKM46", "SMKA12"]):
-    """Programatically extract links from the UK Trade Info Bulk Datasets page."""
+def create_session(pool_size = 8):
+    """Returns a `requests.Session` whose connection pool fits `pool_size` concurrent downloads."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = pool_size, pool_maxsize = pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def get_hyperlinks(prefixes = ["SMKE19", "SMKI19", "SMKX46", "SMKM46", "SMKA12"],
+                   base_url = BASE_URL, session = None):
+    """Programatically extract links from the UK Trade Info Bulk Datasets page.
+
+    Searches the archive page first, then this year's page. Links are made
+    absolute against `base_url`.
+    """
     prefix_regex = "(" + "|".join(prefixes) + ")"
+    session = session or requests
 
-    # Archive
-    url_base = "https://www.uktradeinfo.com/trade-data/latest-bulk-datasets/bulk-datasets-archive/"
-    soup = BeautifulSoup(requests.get(url_base).content, "html.parser")
-    links = [x["href"] for x in soup.findAll("a")]
-    links = [str(url) for url in links if re.search(prefix_regex, str(url), re.IGNORECASE)]
-    links = [x for x in links if not re.search("#", x)]
-    links = ["https://www.uktradeinfo.com" + x for x in links]
-
-    # This Year
-    url_base = "https://www.uktradeinfo.com/trade-data/latest-bulk-datasets/"
-    soup = BeautifulSoup(requests.get(url_base).content, "html.parser")
-    ty_links = [x["href"] for x in soup.findAll("a")]
-    ty_links = [str(url) for url in ty_links if re.search(prefix_regex, str(url), re.IGNORECASE)]
-    ty_links = [x for x in ty_links if not re.search("#", x)]
-    ty_links = ["https://www.uktradeinfo.com" + x for x in ty_links]
+    links = []
+    for page in INDEX_PAGES:
+        soup = BeautifulSoup(session.get(urljoin(base_url, page)).content, "html.parser")
+        page_links = [x["href"] for x in soup.findAll("a", href = True)]
+        page_links = [str(url) for url in page_links if re.search(prefix_regex, str(url), re.IGNORECASE)]
+        page_links = [x for x in page_links if not re.search("#", x)]
+        links.extend([urljoin(base_url, x) for x in page_links])
 
-    links.extend(ty_links)
+    # Pages can link the same file more than once; keep the first of each
+    links = list(dict.fromkeys(links))
 
     return(links)
 
 
-def download_zipfiles(dest_path, min_year=2010, max_year=2019):
-    """Downloads zipfiles from UKTradeInfo for later extraction."""
-
-    def trade_data_download(remote_file_path, destination = dest_path):
-        """Download data if it can be found. Return remote file name if exception occurs"""
+def download_file(url, dest_path, session, retries = 3, backoff = 1.0,
+                  chunk_size = 64 * 1024, timeout = 60, etag = None, last_modified = None):
+    """Downloads a single file, resuming partial downloads and retrying on failure.
+
+    Data is written to `<name>.part` next to the target, with the response's
+    ETag / Last-Modified and expected size kept in `<name>.part.json`. A later
+    attempt (or run) resumes with an HTTP Range request, sent with `If-Range` so
+    the server returns the whole file again if it has changed. The finished file
+    is checked against the expected size before it is moved into place. A
+    partial download that can't be resumed (a 416 response short of the
+    expected size, a resume at the wrong byte) or that finishes at the wrong
+    size is deleted, with its metadata, and downloaded again from the start.
+
+    Connection errors and 5xx responses are retried `retries` times with
+    exponential backoff; other HTTP errors fail immediately.
+
+    If `etag` or `last_modified` are given (and there is no partial download to
+    resume), the request is made conditional and a 304 response is returned as
+    "not_modified" without writing anything.
+
+    :param url: URL of the file to download.
+    :type url: String
+    :param dest_path: Directory to save the file in.
+    :type dest_path: pathlib.Path() object, or str.
+    :param session: Session to make the requests with.
+    :type session: requests.Session
+    :param etag: ETag of a copy already held elsewhere, sent as `If-None-Match`.
+    :type etag: String
+    :param last_modified: Last-Modified of a copy already held elsewhere, sent as `If-Modified-Since`.
+    :type last_modified: String
+    :return: DownloadResult
+    """
+    with stage("download", file = url) as s:
+        result = _download_file(url, dest_path, session, retries, backoff, chunk_size, timeout,
+                                etag, last_modified)
+        (s.bytes, s.status) = (result.bytes, result.status)
+    return result
+
+
+def _download_file(url, dest_path, session, retries, backoff, chunk_size, timeout, etag, last_modified):
+    """Does the work of `download_file`, which records it as a `download` stage."""
+    target = Path(dest_path) / Path(urlparse(url).path).name
+    partial = target.with_name(target.name + ".part")
+    meta_file = target.with_name(target.name + ".part.json")
+
+    if target.exists() and not partial.exists():
+        return DownloadResult(url, target, "skipped", target.stat().st_size, 0, None)
+    target.parent.mkdir(parents = True, exist_ok = True)
+
+    error = None
+    resumed = False
+    for attempt in range(1, retries + 2):
         try:
-            wget.download(remote_file_path, out = destination)
-            return None
-        except:
-            return remote_file_path
-
+            offset = partial.stat().st_size if partial.exists() else 0
+            meta = json.loads(meta_file.read_text()) if meta_file.exists() else {}
+            validator = meta.get("etag") or meta.get("last_modified")
+
+            headers = {}
+            if offset and validator:
+                headers = {"Range": f"bytes={offset}-", "If-Range": validator}
+            elif not offset:
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+
+            with session.get(url, headers = headers, stream = True, timeout = timeout) as r:
+                if r.status_code == 304:
+                    return DownloadResult(url, None, "not_modified", 0, attempt, None,
+                                          r.headers.get("ETag", etag),
+                                          r.headers.get("Last-Modified", last_modified))
+                if r.status_code == 416 and offset and offset == meta.get("total"):
+                    pass # Already have every byte; just verify and move into place
+                elif r.status_code == 416 and offset:
+                    raise StaleDownload(f"Server can't resume at byte {offset}; the file may have changed")
+                else:
+                    r.raise_for_status()
+                    if r.status_code == 206:
+                        start = int(re.match(r"bytes (\d+)-", r.headers["Content-Range"]).group(1))
+                        if start != offset:
+                            raise StaleDownload(f"Server resumed at byte {start}, expected {offset}")
+                        resumed = True
+                        mode = "ab"
+                    else:
+                        meta = {"etag": r.headers.get("ETag"),
+                                "last_modified": r.headers.get("Last-Modified"),
+                                "total": int(r.headers["Content-Length"]) if "Content-Length" in r.headers else None}
+                        meta_file.write_text(json.dumps(meta))
+                        mode = "wb"
+
+                    with open(partial, mode) as f:
+                        for chunk in r.iter_content(chunk_size = chunk_size):
+                            f.write(chunk)
+
+            size = partial.stat().st_size
+            if meta.get("total") is not None and size != meta["total"]:
+                raise StaleDownload(f"Incomplete download: {size} of {meta['total']} bytes")
+
+            partial.replace(target)
+            meta_file.unlink()
+            return DownloadResult(url, target, "resumed" if resumed else "downloaded", size, attempt, None,
+                                  meta.get("etag"), meta.get("last_modified"))
+
+        except (requests.RequestException, IOError) as e:
+            error = e
+            if isinstance(e, StaleDownload):
+                for path in (partial, meta_file):
+                    if path.exists():
+                        path.unlink()
+            response = getattr(e, "response", None)
+            if response is not None and response.status_code < 500:
+                break
+            if attempt <= retries:
+                time.sleep(backoff * 2 ** (attempt - 1))
+
+    size = partial.stat().st_size if partial.exists() else 0
+    return DownloadResult(url, None, "failed", size, attempt, repr(error))
+
+
+def download_files(urls, dest_path, workers = 4, session = None, **kwargs):
+    """Downloads files concurrently with `download_file` over a shared session.
+
+    :param urls: URLs to download.
+    :type urls: List of str.
+    :param dest_path: Directory to save the files in. Created if it does not exist.
+    :type dest_path: pathlib.Path() object, or str.
+    :param workers: Number of concurrent downloads.
+    :type workers: int
+    :param session: Session to share between downloads; created if not given.
+    :type session: requests.Session
+    :param kwargs: Passed on to `download_file`.
+    :return: List of DownloadResult, in the same order as `urls`.
+    """
     os.makedirs(dest_path, exist_ok=True)
+    session = session or create_session(workers)
 
-    links = get_hyperlinks() # Get all files by default
-    years = list(range(min_year, max_year+1))
-    years = [str(year) + "archive" for year in years]
-    years_regex = "(" + "|".join(years) + ")"
-    links = [x for x in links if re.search(years_regex, x, re.IGNORECASE)]
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        results = list(tqdm(pool.map(lambda url: download_file(url, dest_path, session, **kwargs), urls),
+                            total = len(urls)))
 
-    fails = []
+    return results
 
-    # Run trade_data_download func for side effect, build list of failed downloads
-    # for future inspection if necessary.
-    for link in tqdm(links):
-        fails.append(trade_data_download(link))
 
-    fails = [x for x in fails if x is not None]
+def report_downloads(results):
+    """Prints a summary of a list of DownloadResults."""
+    fails = [x for x in results if x.status == "failed"]
     if len(fails) == 0:
         print("All Zip Files Downloaded.")
     else:
         print("The following Zip Files could not be downloaded:")
-        print("\n".join(fails))
-
-
-def unzip_trade_data(data_dir):
-    """Recursively unzip the files and rename for loading into the database."""
+        print("\n".join(f"{x.url} ({x.error})" for x in fails))
+
+
+def link_or_copy(source, dest_dir, name = None):
+    """Hard links `source` into `dest_dir`, copying instead where linking isn't possible.
+
+    :param name: File name in `dest_dir`; defaults to the name of `source`.
+    :type name: String
+    :return: pathlib.Path of the new file.
+    """
+    dest = Path(dest_dir) / (name or Path(source).name)
+    if dest.exists():
+        dest.unlink()
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+    return dest
+
+
+def download_zipfiles(dest_path, min_year=2010, max_year=2019, workers=4, base_url=BASE_URL,
+                      cache=None, revalidate=False):
+    """Downloads zipfiles from UKTradeInfo for later extraction.
+
+    If an `ArchiveCache` is given, archives are fetched through it and linked
+    into `dest_path`, so anything already cached is not downloaded again.
+
+    :return: List of DownloadResult, one per archive.
+    """
+    session = create_session(workers)
+    if cache is None:
+        links = get_hyperlinks(base_url = base_url, session = session) # Get all files by default
+    else:
+        links = cache.links(base_url, lambda: get_hyperlinks(base_url = base_url, session = session))
+    years = list(range(min_year, max_year+1))
+    years = [str(year) + "archive" for year in years]
+    years_regex = "(" + "|".join(years) + ")"
+    links = [x for x in links if re.search(years_regex, x, re.IGNORECASE)]
 
-    # Get list of zip files in path.
-    data_dir = Path(data_dir)
-    zipfiles = data_dir.rglob("*.[Zz][Ii][Pp]")
-    zipfiles = list(zipfiles)
+    if cache is None:
+        return download_files(links, dest_path, workers = workers, session = session)
 
-    # Terminate condition, or unzip + remove zipfiles one by one
-    if len(list(zipfiles)) == 0:
-        return
-    else:
-        for zip_file in tqdm(zipfiles):
-            zipfile.ZipFile(zip_file).extractall(data_dir)
-            os.remove(zip_file)
+    os.makedirs(dest_path, exist_ok=True)
+    results = cache.fetch_all(links, session, workers = workers, revalidate = revalidate)
+    for result in results:
+        if result.path is not None:
+            link_or_copy(result.path, dest_path, Path(urlparse(result.url).path).name)
+    return results
 
-    # Recursion Activate! AAAAaAaAaaaa.....
-    unzip_trade_data(data_dir)
 
+def unzip_trade_data(data_dir):
+    """Unzip the files, including nested zips, and remove the archives.
 
-def check_for_missing(data_dir, min_year = 2010, max_year = 2019):
-    """Check for expected files in data_dir that are missing"""
+    Archives are worked through from a stack: each one is extracted, deleted,
+    and any zips it contained are pushed onto the stack, so the directory
+    tree is only searched once.
+    """
 
-    # Create looping parameters, formatted to lower / 2 digit month/year strings
     data_dir = Path(data_dir)
-    files = data_dir.rglob("*")
-    files = [str(x).lower() for x in files]
-    prefixes = ["SMKE19", "SMKI19", "SMKX46", "SMKM46", "SMKA12"]
-    prefixes = [x.lower() for x in prefixes]
-    years = [f"{x:02d}" for x in range(min_year - 2000, max_year + 1 - 2000)]
-    months = [f"{x:02d}" for x in range(1,13)]
-
-    # Loop over and search for files, add those that aren't found.
-    not_found = []
-    for i in tqdm(years):
-        for prefix in prefixes:
-            for j in months:
-                expected_file = f".*{prefix}{i}{j}.*"
-                search_results = [re.search(expected_file, x) for x in files]
-                if not any(search_results):
-                    not_found.append(f"{prefix}{i}{j}")
+    zipfiles = list(data_dir.rglob("*.[Zz][Ii][Pp]"))
+
+    with tqdm() as progress:
+        while zipfiles:
+            zip_file = zipfiles.pop()
+            with stage("unzip", file = zip_file, bytes = zip_file.stat().st_size):
+                with zipfile.ZipFile(zip_file) as z:
+                    nested = [data_dir / x for x in z.namelist() if x.lower().endswith(".zip")]
+                    z.extractall(data_dir)
+            os.remove(zip_file)
+            zipfiles.extend(x for x in nested if x.exists() and x not in zipfiles)
+            progress.update()
+
+
+def walk_archives(data_dir):
+    """Finds the data files inside the zips in `data_dir` without extracting anything.
+
+    Nested zips are descended iteratively. The returned ArchiveMembers can be
+    passed straight to `etl_trade_table` / `etl_control_table`, which then parse
+    from the decompressed stream.
+
+    :param data_dir: Directory to search for zip files.
+    :type data_dir: pathlib.Path() object, or str.
+    :return: List of ArchiveMember, sorted by file name.
+    """
+    stack = [(path, ()) for path in Path(data_dir).rglob("*.[Zz][Ii][Pp]")]
+    found = []
+
+    while stack:
+        archive, members = stack.pop()
+        with open_zip_chain(archive, members) as z:
+            for info in z.infolist():
+                if info.is_dir():
+                    continue
+                if info.filename.lower().endswith(".zip"):
+                    stack.append((archive, members + (info.filename,)))
+                else:
+                    found.append(ArchiveMember(str(archive), members + (info.filename,)))
+
+    found.sort(key = lambda x: x.name)
+    return found
+
+
+def file_key(name, prefixes = TRADE_FILE_PREFIXES):
+    """Parses a trade file name into a `(prefix, yy, mm)` key.
+
+    :param name: File name or path, e.g. `SMKE192001` or `data/smke192001.zip`.
+    :type name: String, pathlib.Path() object, or ArchiveMember.
+    :return: Tuple of upper case prefix, 2 digit year and 2 digit month, or None if `name` is not a trade file.
+    """
+    name = name.name if isinstance(name, (Path, ArchiveMember)) else Path(str(name)).name
+    match = re.search("(" + "|".join(prefixes) + r")(\d{2})(\d{2})", name, re.IGNORECASE)
+    if match is None:
+        return None
+    return (match.group(1).upper(), match.group(2), match.group(3))
+
+
+def check_for_missing(data_dir = None, min_year = 2010, max_year = 2019, manifest = None):
+    """Check for expected files in data_dir (and/or a zip manifest) that are missing.
+
+    Each file name is parsed once into a `(prefix, yy, mm)` key with `file_key`;
+    an archive and the file extracted from it (`SMKE192001.zip`, `SMKE192001`)
+    count as the same file.
+
+    :param data_dir: Directory to search for trade files; may be None if `manifest` is given.
+    :type data_dir: pathlib.Path() object, or str.
+    :param min_year: First year expected.
+    :type min_year: int
+    :param max_year: Last year expected.
+    :type max_year: int
+    :param manifest: Names of files held in archives, e.g. from `walk_archives` or `ArchiveCache.members`, so coverage can be checked without extracting.
+    :type manifest: Iterable of str or ArchiveMember.
+    :return: Coverage matrix; dict of prefix : {`YYMM` : "present", "missing" or "duplicate"}.
+    """
+    names = []
+    if data_dir is not None:
+        names.extend(x.name for x in Path(data_dir).rglob("*") if x.is_file())
+    if manifest is not None:
+        names.extend(x.name if isinstance(x, ArchiveMember) else Path(x).name for x in manifest)
+
+    # Distinct files per key, treating `X.zip` and `X` as one
+    found = {}
+    for name in names:
+        key = file_key(name)
+        if key is not None:
+            stem = name.lower()[:-4] if name.lower().endswith(".zip") else name.lower()
+            found.setdefault(key, set()).add(stem)
+
+    coverage = {}
+    for prefix in TRADE_FILE_PREFIXES:
+        coverage[prefix] = {}
+        for year in range(min_year - 2000, max_year + 1 - 2000):
+            for month in range(1, 13):
+                key = (prefix, f"{year:02d}", f"{month:02d}")
+                count = len(found.get(key, ()))
+                status = "missing" if count == 0 else "present" if count == 1 else "duplicate"
+                coverage[prefix][f"{year:02d}{month:02d}"] = status
+
+    return coverage
+
+
+def missing_files(coverage):
+    """Lists the `PREFIXYYMM` names marked missing in a coverage matrix from `check_for_missing`."""
+    return [f"{prefix}{period}"
+            for (prefix, periods) in coverage.items()
+            for (period, status) in periods.items()
+            if status == "missing"]
+
+
+def unzip_main(argv = None, prog = None):
+    """Entry point of `tradedata unzip`; `argv` defaults to the command line."""
+    parser = argparse.ArgumentParser(prog = prog, description="Unzip downloaded Trade Data Files, including nested zips.")
+    parser.add_argument("-t", "--target",
+                        help="Directory holding the archives; their files are extracted alongside them.",
+                        default = 'data/')
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
 
-    print("Files not found:")
-    print("\n".join(not_found))
+    print("Unzipping Trade Data Files...")
+    unzip_trade_data(args.target)
 
 
-if __name__ == "__main__":
+def main(argv = None, prog = None):
+    """Entry point of `tradedata download`; `argv` defaults to the command line."""
 
     # Parse Arguments
-    parser = argparse.ArgumentParser(description="Download and Unzip Trade Data Files.")
+    parser = argparse.ArgumentParser(prog = prog, description="Download and Unzip Trade Data Files.")
     parser.add_argument("-t", "--target",
                         help="Target directory for the files. Created if it does not exist.",
                         required = True, default = 'data/')
@@ -139,19 +426,41 @@ if __name__ == "__main__":
     parser.add_argument("--max_year", type=int,
                         help="Ending Year for the downloads.",
                         required = True, default = 2019)
+    parser.add_argument("--workers", type=int,
+                        help="Number of concurrent downloads.",
+                        default = 4)
+    parser.add_argument("--cache_dir",
+                        help="Archive cache directory; archives already cached are not downloaded again.",
+                        default = None)
+    parser.add_argument("--revalidate", action = "store_true",
+                        help="Check cached archives are current with a conditional GET.")
+    add_metrics_arguments(parser)
 
     # Params
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    configure_from_args(args)
     data_dir = args.target
     min_year = args.min_year
     max_year = args.max_year
 
     # Download + Unzip Data
     print("Downloading Trade Data Files...")
-    download_zipfiles(data_dir, min_year, max_year)
+    cache = None
+    if args.cache_dir:
+        from tradedata.initialise.archive_cache import ArchiveCache
+        cache = ArchiveCache(args.cache_dir)
+    results = download_zipfiles(data_dir, min_year, max_year, workers = args.workers,
+                                cache = cache, revalidate = args.revalidate)
+    report_downloads(results)
     print("Unzipping Trade Data Files...")
     unzip_trade_data(data_dir)
 
     # Print Missing Files
     print("Testing for Missing Files...")
-    check_for_missing(data_dir, min_year, max_year)
+    coverage = check_for_missing(data_dir, min_year, max_year)
+    print("Files not found:")
+    print("\n".join(missing_files(coverage)))
+
+
+if __name__ == '__main__':
+    main()
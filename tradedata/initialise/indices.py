@@ -0,0 +1,136 @@
+"""
+TITLE: Indices
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Spec-driven index management for the trade tables.
+
+Each index is a dict with a `table`, a list of `columns` and optionally a
+`method` ("btree" by default, or "brin"). Most queries filter on date plus a
+comcode or country, so the default specification pairs each code with `date`.
+`date` itself gets a BRIN index, since rows are loaded in date order, `id` a
+b-tree for the API's keyset pagination, and `load_period` one for replacing the
+rows of a file that is loaded again.
+
+Independent indexes are built at the same time over separate connections.
+Postgres allows several CREATE INDEX on one table at once, as they only take
+SHARE locks. Indexes that already exist are skipped, so a build can be re-run.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import text
+
+from tradedata.metrics import stage
+
+INDEX_SPECS = [
+    {"table": "imports", "columns": ["id"]},
+    {"table": "imports", "columns": ["load_period"]},
+    {"table": "imports", "columns": ["date"], "method": "brin"},
+    {"table": "imports", "columns": ["comcode", "date"]},
+    {"table": "imports", "columns": ["cod_code", "date"]},
+    {"table": "imports", "columns": ["coo_code", "date"]},
+    {"table": "imports", "columns": ["port_code", "date"]},
+    {"table": "exports", "columns": ["id"]},
+    {"table": "exports", "columns": ["load_period"]},
+    {"table": "exports", "columns": ["date"], "method": "brin"},
+    {"table": "exports", "columns": ["comcode", "date"]},
+    {"table": "exports", "columns": ["cod_code", "date"]},
+    {"table": "exports", "columns": ["port_code", "date"]},
+    {"table": "arrivals", "columns": ["id"]},
+    {"table": "arrivals", "columns": ["load_period"]},
+    {"table": "arrivals", "columns": ["date"], "method": "brin"},
+    {"table": "arrivals", "columns": ["comcode", "date"]},
+    {"table": "arrivals", "columns": ["cod_code", "date"]},
+    {"table": "dispatches", "columns": ["id"]},
+    {"table": "dispatches", "columns": ["load_period"]},
+    {"table": "dispatches", "columns": ["date"], "method": "brin"},
+    {"table": "dispatches", "columns": ["comcode", "date"]},
+    {"table": "dispatches", "columns": ["cod_code", "date"]},
+]
+
+
+# FUNCTIONS ####################################################################
+def index_name(spec):
+    """Name for an index spec, e.g. `ix_imports_comcode_date` or `ix_imports_date_brin`."""
+    name = f"ix_{spec['table']}_" + "_".join(spec["columns"])
+    if spec.get("method", "btree") != "btree":
+        name += f"_{spec['method']}"
+    return name
+
+
+def existing_indices(engine, tables):
+    """Returns the set of index names that exist on `tables`."""
+    query = text("SELECT indexname FROM pg_indexes WHERE tablename = ANY(:tables)")
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(query, tables = list(tables))}
+
+
+def create_index(engine, spec, maintenance_work_mem = "1GB"):
+    """Builds a single index on its own connection.
+
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param spec: Index spec with `table`, `columns` and optionally `method` keys.
+    :type spec: Dict
+    :param maintenance_work_mem: Postgres `maintenance_work_mem` for the build.
+    :type maintenance_work_mem: String
+    :return: Seconds taken to build the index.
+    """
+    name = index_name(spec)
+    method = spec.get("method", "btree")
+    columns = ", ".join(f'"{x}"' for x in spec["columns"])
+
+    start = time.perf_counter()
+    # SET LOCAL lasts only as long as the transaction, so the setting never goes back to the pool
+    with stage("index", table = spec["table"], index = name), engine.begin() as conn:
+        conn.execute(f"SET LOCAL maintenance_work_mem = '{maintenance_work_mem}'")
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "{name}" ON "{spec["table"]}" USING {method} ({columns})')
+    elapsed = time.perf_counter() - start
+
+    print(f"Created Index {name} in {elapsed:.1f}s")
+    return elapsed
+
+
+def build_indices(engine, specs = INDEX_SPECS, workers = 4, maintenance_work_mem = "1GB"):
+    """Builds the indexes in `specs` concurrently, skipping any that already exist.
+
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param specs: Index specs to build.
+    :type specs: List of Dicts.
+    :param workers: Number of indexes to build at once (one connection each).
+    :type workers: int
+    :param maintenance_work_mem: Postgres `maintenance_work_mem` for each build. Total memory use is up to `workers` times this.
+    :type maintenance_work_mem: String
+    :return: Dict of index name : seconds taken, or the exception raised building it.
+    """
+    existing = existing_indices(engine, {spec["table"] for spec in specs})
+    to_build = [spec for spec in specs if index_name(spec) not in existing]
+    for spec in specs:
+        if index_name(spec) in existing:
+            print(f"Index {index_name(spec)} already exists; skipping.")
+
+    def build(spec):
+        try:
+            return create_index(engine, spec, maintenance_work_mem)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        results = dict(zip([index_name(x) for x in to_build], pool.map(build, to_build)))
+
+    for (name, result) in results.items():
+        if isinstance(result, Exception):
+            print(f"Index {name} could not be created: {result!r}")
+
+    return results
+
+
+def drop_indices(engine, specs = INDEX_SPECS):
+    """Drops the indexes in `specs`, e.g. before a bulk load; rebuild them with `build_indices` afterwards."""
+    with engine.begin() as conn:
+        for spec in specs:
+            conn.execute(f'DROP INDEX IF EXISTS "{index_name(spec)}"')
@@ -0,0 +1,167 @@
+"""
+TITLE: Partitions
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Declarative range partitioning of the trade tables by `date`.
+
+Each trade table can be partitioned by month (`imports_2020_01`) or year
+(`imports_2020`), with a `<table>_default` partition catching anything else.
+Date-filtered queries then only scan the partitions they need, and dropping a
+month is a DETACH / DROP rather than a DELETE followed by VACUUM.
+
+Every row goes to the partition of its own date. A file holds rows dated in
+other months than its own (late declarations, the EU 13th month), which land
+in the default partition if their month has no partition yet. Postgres won't
+add a partition whose range the default partition holds rows for, so
+`ensure_partition` moves those rows out of the default partition into the new
+one as it attaches it, and `partition_default_rows` gives every month held in
+the default partition its own partition.
+
+Replacing a file's rows is done by its `load_period` rather than by swapping
+partitions, as a month's partition also holds rows from other months' files;
+see `tradedata.update.monthly_update.load_trade_partition`.
+"""
+
+import re
+from datetime import date
+
+from sqlalchemy import text
+
+PARTITION_GRANULARITIES = ["month", "year"]
+
+
+# FUNCTIONS ####################################################################
+def partition_bounds(period, granularity = "month"):
+    """Returns the `[start, end)` dates of the partition containing `period`."""
+    assert granularity in PARTITION_GRANULARITIES, f"`granularity` must be one of {PARTITION_GRANULARITIES}."
+    if granularity == "year":
+        return date(period.year, 1, 1), date(period.year + 1, 1, 1)
+    start = date(period.year, period.month, 1)
+    end = date(period.year + period.month // 12, period.month % 12 + 1, 1)
+    return start, end
+
+
+def partition_name(table_name, period, granularity = "month"):
+    """Name of the partition of `table_name` containing `period`, e.g. `imports_2020_01`."""
+    if granularity == "year":
+        return f"{table_name}_{period:%Y}"
+    return f"{table_name}_{period:%Y_%m}"
+
+
+def list_partitions(engine, table_name):
+    """Returns a dict of partition name : `(start, end)` for the attached partitions of a table.
+
+    The default partition is returned with bounds of `None`.
+    """
+    query = text("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname = :table_name
+    """)
+    with engine.connect() as conn:
+        rows = conn.execute(query, table_name = table_name).fetchall()
+
+    partitions = {}
+    for (name, bound) in rows:
+        dates = re.findall(r"'(\d{4})-(\d{2})-(\d{2})'", bound or "")
+        if len(dates) == 2:
+            partitions[name] = tuple(date(*map(int, x)) for x in dates)
+        else:
+            partitions[name] = None
+    return partitions
+
+
+def partition_granularity(engine, table_name):
+    """Returns "month" or "year" for a partitioned table, or None if it is not partitioned.
+
+    Worked out from the span of the existing partitions; a partitioned table
+    with no bounded partitions yet is taken to be monthly.
+    """
+    query = text("""
+        SELECT 1 FROM pg_partitioned_table pt
+        JOIN pg_class c ON c.oid = pt.partrelid
+        WHERE c.relname = :table_name
+    """)
+    with engine.connect() as conn:
+        if conn.execute(query, table_name = table_name).fetchone() is None:
+            return None
+
+    for bounds in list_partitions(engine, table_name).values():
+        if bounds is not None:
+            months = (bounds[1].year - bounds[0].year) * 12 + bounds[1].month - bounds[0].month
+            return "year" if months == 12 else "month"
+    return "month"
+
+
+def create_default_partition(engine, table_name):
+    """Creates the default partition, which holds rows outside every range partition."""
+    with engine.begin() as conn:
+        conn.execute(f'CREATE TABLE IF NOT EXISTS "{table_name}_default" '
+                     f'PARTITION OF "{table_name}" DEFAULT')
+
+
+def ensure_partition(engine, table_name, period, granularity = "month"):
+    """Creates and attaches the partition containing `period` if it does not exist.
+
+    Rows for the partition's range already in the default partition are moved
+    into it in the same transaction. The new table carries a CHECK constraint
+    matching its bounds, so attaching it needs no validation scan of it.
+
+    :return: Name of the partition.
+    """
+    name = partition_name(table_name, period, granularity)
+    partitions = list_partitions(engine, table_name)
+    if name in partitions:
+        return name
+
+    start, end = partition_bounds(period, granularity)
+    default = f"{table_name}_default"
+    with engine.begin() as conn:
+        if default not in partitions:
+            conn.execute(f'CREATE TABLE "{name}" PARTITION OF "{table_name}" '
+                         f"FOR VALUES FROM ('{start}') TO ('{end}')")
+            return name
+
+        conn.execute(f'CREATE TABLE "{name}" (LIKE "{table_name}" INCLUDING DEFAULTS)')
+        conn.execute(f'ALTER TABLE "{name}" ADD CONSTRAINT "{name}_date_check" '
+                     f"CHECK (date IS NOT NULL AND date >= '{start}' AND date < '{end}')")
+        conn.execute(f'WITH moved AS (DELETE FROM "{default}" '
+                     f"WHERE date >= '{start}' AND date < '{end}' RETURNING *) "
+                     f'INSERT INTO "{name}" SELECT * FROM moved')
+        conn.execute(f'ALTER TABLE "{table_name}" ATTACH PARTITION "{name}" '
+                     f"FOR VALUES FROM ('{start}') TO ('{end}')")
+    return name
+
+
+def partition_default_rows(engine, table_name, granularity = "month"):
+    """Gives each month (or year) held in the default partition a partition of its own; see `ensure_partition`.
+
+    :return: Names of the partitions created.
+    """
+    default = f"{table_name}_default"
+    if default not in list_partitions(engine, table_name):
+        return []
+    with engine.connect() as conn:
+        periods = [row[0] for row in conn.execute(
+            f"SELECT DISTINCT date_trunc('month', date)::date FROM \"{default}\" WHERE date IS NOT NULL")]
+
+    names = []
+    for period in sorted(periods):
+        name = partition_name(table_name, period, granularity)
+        if name not in names:
+            names.append(ensure_partition(engine, table_name, period, granularity))
+    return names
+
+
+def drop_partition(engine, table_name, period, granularity = "month"):
+    """Detaches and drops the partition containing `period`, removing its data."""
+    name = partition_name(table_name, period, granularity)
+    if name not in list_partitions(engine, table_name):
+        return
+    with engine.begin() as conn:
+        conn.execute(f'ALTER TABLE "{table_name}" DETACH PARTITION "{name}"')
+        conn.execute(f'DROP TABLE "{name}"')
@@ -0,0 +1,300 @@
+"""
+TITLE: Table Plans
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Compiles the JSON table specifications into reusable ETL plans.
+
+A `TablePlan` works out everything the ETL needs from a specification once:
+the column names, the dtypes to read and convert to, the SQLAlchemy types, the
+date format and the recode maps. Plans are cached by `compile_plan`, so every
+file loaded with the same specification (including in worker processes) shares
+one plan instead of re-parsing the specification.
+
+`load_table_plans` reads the specifications and recodes from `data/lookups/`
+for every table, and `TRADE_FILES` maps file prefixes to tables. Both
+`create_database` and `monthly_update` use these.
+"""
+
+import re
+import json
+import threading
+from pathlib import Path
+from datetime import datetime
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import String, Integer, Float, Boolean, BigInteger, Text, CHAR, Date
+
+# Trade File Abbreviation - Table Name mapping
+TRADE_FILES = {
+    "SMKA12":"control",                               # Commodity Lookups
+    "SMKE19":"exports", "SMKI19":"imports",           # Non EU Trade
+    "SMKX46":"dispatches", "SMKM46": "arrivals"       # EU Trade
+}
+
+# Table - Table Specification JSON filename mapping, within the lookups directory
+TABLE_SPECS = {
+    "control":"controlfilecols.json",
+    "exports":"noneuexportcols.json",
+    "imports":"noneuimportcols.json",
+    "dispatches":"eutradecols.json",
+    "arrivals":"eutradecols.json"
+}
+
+# Table - `strptime` format of its period column
+DATE_FORMATS = {"exports": "%m/%Y", "imports": "%m/%Y", "dispatches": "0%Y%m", "arrivals": "0%Y%m"}
+
+# Low cardinality code columns read as pandas categoricals unless their column
+# specification says otherwise with `"categorical": false`; any other text
+# column can opt in with `"categorical": true`.
+CATEGORICAL_COLUMNS = ["comcode", "cod_code", "coo_code", "port_code", "border_mot", "inland_mot"]
+
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+# FUNCTIONS ####################################################################
+def parse_specification(dict_list):
+    """Returns a Dictionary of name : SQLAlchemy dtypes from specification jsons"""
+
+    names = [x["name"] for x in dict_list]
+
+    dtypes = []
+    for column in dict_list:
+        if column["type"] == "boolean":
+            dtypes.append(Boolean())
+        elif column["type"] == "date":
+            dtypes.append(Date())
+        elif column["type"] == "integer":
+            dtypes.append(Integer())
+        elif column["type"] == "bigint":
+            dtypes.append(BigInteger())
+        elif column["type"] == "float":
+            dtypes.append(Float())
+        elif column["type"] == "text":
+            dtypes.append(Text())
+        elif re.findall("varchar", column["type"]):
+            stringlength = int(re.findall("[0-9]+", column["type"])[0])
+            dtypes.append(String(stringlength))
+        elif re.findall("char", column["type"]):
+            stringlength = int(re.findall("[0-9]+", column["type"])[0])
+            dtypes.append(CHAR(stringlength))
+        else:
+            dtypes.append("REMOVE")
+
+    dtypes_dict = dict(zip(names,dtypes))
+    dtypes_dict = {name:dtype for (name,dtype) in dtypes_dict.items() if not dtype == "REMOVE"}
+
+    return dtypes_dict
+
+
+def convert_trade_dates(dates, date_format, period):
+    """Converts a column of trade period strings to dates.
+
+    A file holds only a handful of distinct periods, so each distinct string is
+    parsed once and the result broadcast back over the rows.
+
+    The 13th month in EU trade (`0YYYY13`) is set to 31st December of that year,
+    and the all-zero period (`0000000`) is set to the month the file covers.
+
+    :param dates: Period strings as read from the Trade Data File.
+    :type dates: pandas.Series of str.
+    :param date_format: `strptime` Date String to transform date columns.
+    :type date_format: String.
+    :param period: Month the file covers, as returned by `file_period`.
+    :type period: datetime.date
+    :return: pandas.Series of `datetime.date`, indexed as `dates`.
+    """
+    codes, uniques = pd.factorize(dates)
+
+    converted = []
+    for date in uniques:
+        if re.search("020..13", date):
+            date_transformed = datetime.strptime(date[0:5] + "12", date_format).date()
+            converted.append(date_transformed + timedelta(days = 30)) # Set to YYYY/12/31
+        elif date == "0000000":
+            converted.append(period) # Set to file year/month
+        else:
+            converted.append(datetime.strptime(date, date_format).date())
+
+    # Trailing None catches any missing values (factorize code -1)
+    converted = np.array(converted + [None], dtype = object)
+    return pd.Series(converted[codes], index = dates.index, name = dates.name)
+
+
+def categorical_columns(spec_list):
+    """Names of the text columns in `spec_list` to hold as pandas categoricals.
+
+    A column is categorical if its specification has `"categorical": true`, or
+    has no `categorical` key and is named in `CATEGORICAL_COLUMNS`.
+    """
+    return [x["name"] for x in spec_list
+            if re.findall("char|str|text", x["type"])
+            and x.get("categorical", x["name"] in CATEGORICAL_COLUMNS)]
+
+
+def map_categories(series, mapping):
+    """Applies `mapping` to the categories of a categorical Series rather than to every row.
+
+    Categories that map to the same value are merged.
+
+    :param series: Categorical data.
+    :type series: pandas.Series
+    :param mapping: Function or dict applied to each category; categories missing from a dict are kept.
+    :type mapping: Function, or Dict.
+    :return: Categorical pandas.Series.
+    """
+    categories = series.cat.categories
+    if isinstance(mapping, dict):
+        mapped = [mapping.get(x, x) for x in categories]
+    else:
+        mapped = [mapping(x) for x in categories]
+
+    # Factorize the new categories so duplicates share a code; -1 (missing) stays -1
+    new_codes, new_categories = pd.factorize(pd.Index(mapped, dtype = object))
+    codes = np.append(new_codes, -1)[series.cat.codes]
+    return pd.Series(pd.Categorical.from_codes(codes, new_categories),
+                     index = series.index, name = series.name)
+
+
+class TablePlan:
+    """Compiled ETL plan for one table specification.
+
+    :param spec_list: Specification for the data file.
+    :type spec_list: List of Dictionaries with keys `name` and `type`.
+    :param recode_dict: Dict of Dicts that specifies recoding for data columns.
+    :type recode_dict: Dictionary with keys corresponding to column names from `spec_list`.
+    :param date_format: `strptime` Date String to transform date columns.
+    :type date_format: String
+    """
+
+    def __init__(self, spec_list, recode_dict = None, date_format = None):
+        assert type(spec_list) == type([]), "`spec_list` is not a list."
+        assert all(["name" in x.keys() and "type" in x.keys() for x in spec_list]), "`spec_list` dicts do not all contain `name` and `type` keys"
+
+        self.spec_list = spec_list
+        self.recode_dict = recode_dict or {}
+        self.date_format = date_format
+
+        self.column_names = [x["name"] for x in spec_list]
+        self.dtype_dict = parse_specification(spec_list)
+        self.categorical = categorical_columns(spec_list)
+        self.read_dtypes = {x: "category" if x in self.categorical else "str" for x in self.column_names}
+
+        # Target pandas dtype of each column, matched in the same order as ever
+        self.date_columns = []
+        self.convert_dtypes = {}
+        self.removed = []
+        for column in spec_list:
+            (name, col_dtype) = (column["name"], column["type"])
+            if re.findall("date", col_dtype):
+                self.date_columns.append(name)
+            elif re.findall("char", col_dtype) or re.findall("str", col_dtype):
+                if name not in self.categorical:
+                    self.convert_dtypes[name] = "str"
+            elif re.findall("bigint", col_dtype):
+                self.convert_dtypes[name] = "int64"
+            elif re.findall("int", col_dtype):
+                self.convert_dtypes[name] = "int32"
+            elif re.findall("float", col_dtype):
+                self.convert_dtypes[name] = "float"
+            elif re.findall("boo", col_dtype):
+                self.convert_dtypes[name] = "bool"
+            else:
+                self.removed.append(name)
+
+        # Recodes as Series, so `Series.map` looks codes up by index
+        self.recode_maps = {column: pd.Series(mapping, dtype = object)
+                            for (column, mapping) in self.recode_dict.items()}
+
+    def __repr__(self):
+        return f"TablePlan({len(self.column_names)} columns, date_format = {self.date_format!r})"
+
+    def recode(self, series, column):
+        """Recodes a column; codes without a recode are kept as they are."""
+        if series.dtype.name == "category":
+            return map_categories(series, self.recode_dict[column])
+        mapped = series.map(self.recode_maps[column])
+        return mapped.where(mapped.notna(), series)
+
+    def convert(self, data, period):
+        """Drops unused columns and converts data types, including the date columns.
+
+        :param data: Raw data, as returned by `read_trade_table` with this plan's `read_dtypes`.
+        :type data: pandas.DataFrame
+        :param period: Month the file covers, as returned by `file_period`.
+        :type period: datetime.date
+        :return: Converted DataFrame.
+        """
+        data = data.drop(columns = self.removed).astype(self.convert_dtypes, copy = False)
+        for column in self.date_columns:
+            data[column] = convert_trade_dates(data[column], self.date_format, period)
+        return data
+
+    def recode_columns(self, data):
+        """Recodes the columns of a converted DataFrame and trims the comcode check digit."""
+        for column in self.recode_dict.keys():
+            data[column] = self.recode(data[column], column)
+        if data["comcode"].dtype.name == "category":
+            data["comcode"] = map_categories(data["comcode"], lambda x: x[0:-1])
+        else:
+            data["comcode"] = data["comcode"].str[0:-1]
+        return data
+
+    def transform(self, data, period):
+        """Converts data types and recodes columns of a raw trade DataFrame; `convert` then `recode_columns`.
+
+        :param data: Raw data, as returned by `read_trade_table` with this plan's `read_dtypes`.
+        :type data: pandas.DataFrame
+        :param period: Month the file covers, as returned by `file_period`.
+        :type period: datetime.date
+        :return: Processed DataFrame.
+        """
+        return self.recode_columns(self.convert(data, period))
+
+
+def compile_plan(spec_list, recode_dict = None, date_format = None):
+    """Returns the `TablePlan` for a specification, compiling it on first use."""
+    key = json.dumps([spec_list, recode_dict or {}, date_format], sort_keys = True)
+    with _plans_lock:
+        if key not in _plans:
+            _plans[key] = TablePlan(spec_list, recode_dict, date_format)
+        return _plans[key]
+
+
+def load_table_plans(lookups_dir = "data/lookups"):
+    """Reads the table specifications and recodes, and compiles a plan for every table.
+
+    :param lookups_dir: Directory holding the specification and recode JSON files.
+    :type lookups_dir: pathlib.Path() object, or str.
+    :return: Dict of table name : TablePlan.
+    """
+    lookups_dir = Path(lookups_dir)
+
+    # Recoding Dicts
+    recode_inland_mot = json.loads((lookups_dir / "recode_mode_of_transport.json").read_text())
+    recode_border_mot = {"0"+x:y for (x,y) in recode_inland_mot.items()}
+    recode_mot = {"border_mot":recode_border_mot, "inland_mot":recode_inland_mot}
+    recodes = {"exports": recode_mot, "imports": recode_mot}
+
+    specs = {}
+    plans = {}
+    for (table, filename) in TABLE_SPECS.items():
+        if filename not in specs:
+            specs[filename] = json.loads((lookups_dir / filename).read_text())["columns"]
+        plans[table] = compile_plan(specs[filename], recodes.get(table), DATE_FORMATS.get(table))
+    return plans
+
+
+def file_table(path, strict = True):
+    """Name of the table a trade file loads into, from the prefix of its name (see `TRADE_FILES`).
+
+    Raises KeyError for a file with no known prefix, or returns None if `strict` is unset.
+    """
+    table = TRADE_FILES.get(path.stem[0:6].upper())
+    if table is None and strict:
+        raise KeyError(f"{path} is not a known trade file.")
+    return table
@@ -0,0 +1,231 @@
+"""
+TITLE: Load Ledger
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+The `load_ledger` table records every load into the database: which table and
+month, the source file and its checksum, the row count, how long it took and
+whether it completed. Skip logic and coverage reports read the ledger rather
+than counting rows in the trade tables.
+
+A trade file holds rows dated in months other than its own (late declarations,
+the EU 13th month), so each load also records `months`: every month whose rows
+it changed, e.g. `2019-12,2020-01`. Readers that follow the ledger, such as the
+rollup refresh and the API's result cache, act on those months rather than on
+the file's `period` alone.
+
+A load is recorded as "loading" when it starts and set to "complete" or "failed"
+when it ends, so a load that was interrupted part way through is left visible
+as "loading".
+
+A database loaded before the ledger existed starts with an empty ledger, so
+`create_load_ledger` seeds it once from the trade tables: one entry per table
+and month holding rows, counted by the rows' own dates. Without it the next
+update would reload, and duplicate, every month already there.
+"""
+
+import time
+import hashlib
+from contextlib import contextmanager
+from datetime import datetime
+
+from sqlalchemy import MetaData, Table, Column, Index
+from sqlalchemy import Integer, BigInteger, Float, Text, Date, DateTime
+from sqlalchemy import select, func, inspect
+
+from tradedata.utils import ArchiveMember
+
+metadata = MetaData()
+
+# Trade tables an empty ledger is seeded from
+TRADE_TABLES = ["exports", "imports", "dispatches", "arrivals"]
+
+# Rows a month needs to be seeded as a complete load of its file, as the
+# monthly update's row count check required before the ledger
+SEED_THRESHOLD = 50000
+
+load_ledger = Table(
+    "load_ledger", metadata,
+    Column("id", Integer, primary_key = True),
+    Column("table_name", Text, nullable = False),
+    Column("period", Date),                         # NULL for lookup tables
+    Column("source_file", Text),
+    Column("checksum", Text),
+    Column("row_count", BigInteger),
+    Column("duration", Float),
+    Column("status", Text, nullable = False),       # loading / complete / failed / partial (seeded)
+    Column("started_at", DateTime, nullable = False),
+    Column("finished_at", DateTime),
+    Column("months", Text),                         # months changed, e.g. "2019-12,2020-01"
+    Index("ix_load_ledger_table_name_period", "table_name", "period")
+)
+
+
+# FUNCTIONS ####################################################################
+def create_load_ledger(engine):
+    """Creates the `load_ledger` table if it does not already exist, adding columns missing from an older ledger."""
+    metadata.create_all(engine, tables = [load_ledger])
+    if "months" not in {x["name"] for x in inspect(engine).get_columns("load_ledger")}:
+        with engine.begin() as conn:
+            conn.execute("ALTER TABLE load_ledger ADD COLUMN months TEXT")
+    seed_load_ledger(engine)
+
+
+def seed_load_ledger(engine, tables = TRADE_TABLES, threshold = SEED_THRESHOLD):
+    """Records the months already held by the trade tables as loads, if the ledger is empty.
+
+    Months are those of the rows' own dates, with one grouped count per table.
+    Late declarations in later files put a few rows in months whose own file
+    was never loaded, so only months with at least `threshold` rows are
+    recorded as "complete"; the rest are recorded as "partial", and the monthly
+    update loads them again.
+
+    :param tables: Trade tables to seed the ledger from; those that don't exist are skipped.
+    :type tables: List of str.
+    :param threshold: Rows a month needs to be recorded as complete.
+    :type threshold: int
+    :return: Number of ledger entries added.
+    """
+    with engine.connect() as conn:
+        if conn.execute(select([load_ledger.c.id]).limit(1)).first() is not None:
+            return 0
+
+    now = datetime.now()
+    entries = []
+    for table in tables:
+        if not engine.has_table(table):
+            continue
+        with engine.connect() as conn:
+            counts = conn.execute(f"SELECT date_trunc('month', date)::date AS period, COUNT(*) AS row_count "
+                                  f'FROM "{table}" WHERE date IS NOT NULL GROUP BY 1').fetchall()
+        entries.extend({"table_name": table, "period": period, "row_count": row_count,
+                        "status": "complete" if row_count >= threshold else "partial",
+                        "started_at": now, "finished_at": now,
+                        "months": format_months([period])}
+                       for (period, row_count) in counts)
+
+    if entries:
+        with engine.begin() as conn:
+            conn.execute(load_ledger.insert(), entries)
+        print(f"Seeded the load ledger with {len(entries)} months already in the trade tables.")
+    return len(entries)
+
+
+def format_months(months):
+    """Ledger `months` value for an iterable of dates: their months, sorted and comma separated; None if empty."""
+    months = sorted({f"{x:%Y-%m}" for x in months or ()})
+    return ",".join(months) if months else None
+
+
+def parse_months(value):
+    """Inverse of `format_months`: the first day of each month, as a sorted list of `datetime.date`."""
+    if not value:
+        return []
+    return [datetime.strptime(x, "%Y-%m").date() for x in value.split(",")]
+
+
+def file_checksum(path, block_size = 1024 * 1024):
+    """SHA-256 hex digest of a source file on disk or inside an archive."""
+    digest = hashlib.sha256()
+    f = path.open() if isinstance(path, ArchiveMember) else open(path, "rb")
+    with f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def start_load(engine, table_name, period, source_file = None, checksum = None):
+    """Records the start of a load and returns its ledger id."""
+    with engine.begin() as conn:
+        result = conn.execute(load_ledger.insert().values(
+            table_name = table_name, period = period,
+            source_file = source_file, checksum = checksum,
+            status = "loading", started_at = datetime.now()))
+        return result.inserted_primary_key[0]
+
+
+def finish_load(engine, load_id, status, row_count = None, duration = None, months = None):
+    """Records the end of a load started with `start_load`, and the months (dates) it changed."""
+    with engine.begin() as conn:
+        conn.execute(load_ledger.update()
+                     .where(load_ledger.c.id == load_id)
+                     .values(status = status, row_count = row_count, duration = duration,
+                             finished_at = datetime.now(), months = format_months(months)))
+
+
+@contextmanager
+def recorded_load(engine, table_name, period, source_file = None, checksum = None):
+    """Context manager recording the load in its body in the ledger.
+
+    Yields a dict; set its `row_count` key to the number of rows loaded, and
+    `months` to the dates (any day of each month) whose rows the load changed.
+    The entry is marked "complete" if the body finishes and "failed" if it raises.
+
+    >>> with recorded_load(engine, "imports", date(2020, 1, 1), "SMKI192001") as entry:
+    ...     entry["row_count"] = load_trade_table(...)
+    """
+    load_id = start_load(engine, table_name, period,
+                         None if source_file is None else str(source_file), checksum)
+    entry = {"id": load_id, "row_count": None, "months": None}
+    start = time.perf_counter()
+    try:
+        yield entry
+    except BaseException:
+        finish_load(engine, load_id, "failed", entry["row_count"], time.perf_counter() - start, entry["months"])
+        raise
+    finish_load(engine, load_id, "complete", entry["row_count"], time.perf_counter() - start, entry["months"])
+
+
+def latest_loads(engine, tables = None, period = None):
+    """Returns the most recent ledger entry for each table and period.
+
+    :param tables: Only return these tables.
+    :type tables: List of str.
+    :param period: Only return this month.
+    :type period: datetime.date
+    :return: Dict of `(table_name, period)` : row mapping of the latest entry.
+    """
+    latest = (select([func.max(load_ledger.c.id).label("id")])
+              .group_by(load_ledger.c.table_name, load_ledger.c.period))
+    if tables is not None:
+        latest = latest.where(load_ledger.c.table_name.in_(tables))
+    if period is not None:
+        latest = latest.where(load_ledger.c.period == period)
+    latest = latest.alias("latest")
+
+    query = select([load_ledger]).select_from(
+        load_ledger.join(latest, load_ledger.c.id == latest.c.id))
+
+    with engine.connect() as conn:
+        rows = conn.execute(query).fetchall()
+
+    return {(row["table_name"], row["period"]): dict(row) for row in rows}
+
+
+def load_months(engine, table_name, period):
+    """Months changed by the latest load of a table's month, as recorded in its `months`.
+
+    :return: Sorted list of `datetime.date`, the first day of each month; empty if there is no load.
+    """
+    entry = latest_loads(engine, [table_name], period).get((table_name, period))
+    return [] if entry is None else parse_months(entry["months"])
+
+
+def loaded_tables(engine, period, tables):
+    """Returns the subset of `tables` whose latest load for `period` completed."""
+    loads = latest_loads(engine, tables, period)
+    return [table for table in tables
+            if loads.get((table, period), {}).get("status") == "complete"]
+
+
+def ledger_coverage(engine, tables = None):
+    """Returns rows loaded per table and month, according to the ledger.
+
+    :param tables: Only return these tables.
+    :type tables: List of str.
+    :return: Dict of `(table_name, period)` : dict with the `row_count` and `status` of the latest load.
+    """
+    loads = latest_loads(engine, tables)
+    return {key: {"row_count": row["row_count"], "status": row["status"]}
+            for (key, row) in loads.items() if key[1] is not None}
@@ -0,0 +1,332 @@
+"""
+TITLE: Pipeline Metrics
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Per-stage instrumentation for the pipeline: download, unzip, parse, convert,
+recode, load and index.
+
+Each stage of each file is wrapped in `stage`, which records its wall time,
+rows, bytes, throughput and the process's peak resident set size while it ran:
+
+    with stage("parse", file = path, table = "imports") as s:
+        data = read_trade_table(...)
+        s.rows = len(data)
+
+Records go to the sinks set up with `configure`: a JSON lines file (one object
+per stage), and/or a Prometheus text file of running totals by stage and table,
+for the node exporter's textfile collector. With no sinks configured `stage`
+records nothing and costs next to nothing.
+
+`configure` can also profile stages with cProfile, writing one `.prof` file per
+stage run; stages nested in a stage already being profiled are covered by the
+outer profile. Every script takes the same switches through
+`add_metrics_arguments` / `configure_from_args`:
+
+    --metrics_jsonl logs/metrics.jsonl --metrics_prometheus /var/lib/node_exporter/tradedata.prom
+    --profile parse convert --profile_dir profiles/
+
+Stages run in worker processes (`create_database --workers`) are written to the
+JSON lines file, which is appended to a line at a time, but the Prometheus file
+only totals the stages of the process that configured it.
+"""
+
+import os
+import mmap
+import json
+import time
+import cProfile
+import threading
+from pathlib import Path
+from datetime import datetime
+
+STAGES = ["download", "unzip", "parse", "convert", "recode", "load", "index"]
+
+# Seconds between samples of the resident set size
+RSS_INTERVAL = 0.005
+
+_local = threading.local()
+
+
+# FUNCTIONS ####################################################################
+def current_rss():
+    """Resident set size of this process in bytes, or None where `/proc` is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * mmap.PAGESIZE
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+class PeakRSS:
+    """Context manager sampling the resident set size on a thread, keeping the peak in `peak`."""
+
+    def __init__(self, interval = RSS_INTERVAL):
+        self.interval = interval
+        self.start = self.peak = None
+        self._done = threading.Event()
+
+    def _sample(self):
+        while not self._done.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        if self.start is not None:
+            self._thread = threading.Thread(target = self._sample, daemon = True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.start is not None:
+            self._done.set()
+            self._thread.join()
+            self.peak = max(self.peak, current_rss())
+
+
+class JsonLinesSink:
+    """Appends each stage record to a file as one line of JSON."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+
+    def emit(self, record):
+        # One write per record in append mode, so processes sharing the file don't interleave lines
+        line = json.dumps(record, default = str) + "\n"
+        with open(self.path, "a") as f:
+            f.write(line)
+
+
+class PrometheusSink:
+    """Keeps running totals by stage and table, rewriting a Prometheus text file after each stage."""
+
+    METRICS = [
+        ("tradedata_stage_runs_total", "counter", "Pipeline stage runs, by outcome."),
+        ("tradedata_stage_seconds_total", "counter", "Wall time spent in each pipeline stage."),
+        ("tradedata_stage_rows_total", "counter", "Rows handled by each pipeline stage."),
+        ("tradedata_stage_bytes_total", "counter", "Bytes handled by each pipeline stage."),
+        ("tradedata_stage_peak_rss_bytes", "gauge", "Highest resident set size seen during each pipeline stage."),
+        ("tradedata_stage_last_run_timestamp_seconds", "gauge", "When each pipeline stage last finished.")
+    ]
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents = True, exist_ok = True)
+        self.pid = os.getpid()
+        self.totals = {}
+        self._lock = threading.Lock()
+
+    def emit(self, record):
+        if os.getpid() != self.pid:
+            return
+        key = (record["stage"], record["table"] or "")
+        with self._lock:
+            totals = self.totals.setdefault(key, {"runs": {}, "seconds": 0.0, "rows": 0, "bytes": 0,
+                                                  "peak_rss": 0, "last_run": 0.0})
+            totals["runs"][record["status"]] = totals["runs"].get(record["status"], 0) + 1
+            totals["seconds"] += record["seconds"]
+            totals["rows"] += record["rows"] or 0
+            totals["bytes"] += record["bytes"] or 0
+            totals["peak_rss"] = max(totals["peak_rss"], record["peak_rss_bytes"] or 0)
+            totals["last_run"] = time.time()
+            self._write()
+
+    def _write(self):
+        lines = []
+        for (name, kind, description) in self.METRICS:
+            lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+            for ((stage_name, table), totals) in sorted(self.totals.items()):
+                labels = f'stage="{stage_name}",table="{table}"'
+                if name == "tradedata_stage_runs_total":
+                    lines += [f'{name}{{{labels},status="{status}"}} {count}'
+                              for (status, count) in sorted(totals["runs"].items())]
+                    continue
+                value = {"tradedata_stage_seconds_total": totals["seconds"],
+                         "tradedata_stage_rows_total": totals["rows"],
+                         "tradedata_stage_bytes_total": totals["bytes"],
+                         "tradedata_stage_peak_rss_bytes": totals["peak_rss"],
+                         "tradedata_stage_last_run_timestamp_seconds": totals["last_run"]}[name]
+                lines.append(f"{name}{{{labels}}} {value}")
+
+        # Write then rename, so the collector never reads a half written file
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text("\n".join(lines) + "\n")
+        tmp.replace(self.path)
+
+
+class MetricsRecorder:
+    """Sends stage records to its sinks, and decides which stages are profiled."""
+
+    def __init__(self, sinks = (), profile = None, profile_dir = "profiles"):
+        self.sinks = list(sinks)
+        self.profile = profile
+        self.profile_dir = Path(profile_dir)
+        self._runs = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.sinks) or self.profile is not None
+
+    def profiles(self, stage_name):
+        """Whether runs of `stage_name` are profiled; `profile` is a list of stages, and empty means all."""
+        return self.profile is not None and (not self.profile or stage_name in self.profile)
+
+    def profile_path(self, stage_name, label):
+        with self._lock:
+            self._runs += 1
+            run = self._runs
+        safe_label = "".join(x if x.isalnum() or x in "-_." else "_" for x in label)
+        return self.profile_dir / f"{stage_name}-{safe_label}-{os.getpid()}-{run}.prof"
+
+    def emit(self, record):
+        for sink in self.sinks:
+            sink.emit(record)
+
+
+_recorder = MetricsRecorder()
+
+
+def configure(jsonl = None, prometheus = None, profile = None, profile_dir = "profiles"):
+    """Sets up where stage records go for the rest of the process.
+
+    :param jsonl: JSON lines file to append a record to for each stage run.
+    :type jsonl: pathlib.Path() object, or str.
+    :param prometheus: Prometheus text file of running totals by stage and table.
+    :type prometheus: pathlib.Path() object, or str.
+    :param profile: Stages to run under cProfile; an empty list profiles every stage, None none.
+    :type profile: List of str.
+    :param profile_dir: Directory the cProfile `.prof` files are written to.
+    :type profile_dir: pathlib.Path() object, or str.
+    :return: The MetricsRecorder now in use.
+    """
+    global _recorder
+    sinks = []
+    if jsonl is not None:
+        sinks.append(JsonLinesSink(jsonl))
+    if prometheus is not None:
+        sinks.append(PrometheusSink(prometheus))
+    _recorder = MetricsRecorder(sinks, profile, profile_dir)
+    if profile is not None:
+        _recorder.profile_dir.mkdir(parents = True, exist_ok = True)
+    return _recorder
+
+
+def add_metrics_arguments(parser):
+    """Adds the metrics and profiling switches to a script's argparse parser."""
+    parser.add_argument("--metrics_jsonl",
+                        help="Append a JSON record of each pipeline stage (time, rows, bytes, peak RSS) to this file.",
+                        default = None)
+    parser.add_argument("--metrics_prometheus",
+                        help="Keep running totals per pipeline stage in this Prometheus text file.",
+                        default = None)
+    parser.add_argument("--profile", nargs = "*", choices = STAGES, metavar = "STAGE",
+                        help=f"Run stages under cProfile; give stages to profile ({', '.join(STAGES)}), or none for all.",
+                        default = None)
+    parser.add_argument("--profile_dir",
+                        help="Directory for the cProfile output of --profile.",
+                        default = "profiles")
+
+
+def configure_from_args(args):
+    """Configures metrics from the switches added by `add_metrics_arguments`."""
+    return configure(args.metrics_jsonl, args.metrics_prometheus, args.profile, args.profile_dir)
+
+
+def file_label(path):
+    """Short name of a file or URL for stage records."""
+    if path is None:
+        return None
+    return getattr(path, "name", None) or Path(str(path)).name
+
+
+class stage:
+    """Context manager recording one run of a pipeline stage; see the module docstring.
+
+    Set `rows` and `bytes` on the object inside the block where known, and
+    `status` to record an outcome other than "ok" / "failed" (e.g. "skipped").
+
+    :param name: Stage name, one of `STAGES`.
+    :type name: String
+    :param file: File (or URL) the stage works on.
+    :type file: pathlib.Path() object, str, or ArchiveMember.
+    :param table: Table the stage works on.
+    :type table: String
+    :param rows: Rows handled, if known up front.
+    :type rows: int
+    :param bytes: Bytes handled, if known up front.
+    :type bytes: int
+    :param labels: Further fields for the JSON record, e.g. `index = "ix_imports_date"`.
+    """
+
+    def __init__(self, name, file = None, table = None, rows = None, bytes = None, **labels):
+        self.name = name
+        self.file = file_label(file)
+        self.table = table
+        self.rows = rows
+        self.bytes = bytes
+        self.labels = labels
+        self.status = None
+        self.discard = False
+        self.recorder = _recorder
+
+    def __enter__(self):
+        if not self.recorder.enabled:
+            return self
+
+        self.profiler = None
+        if self.recorder.profiles(self.name) and not getattr(_local, "profiling", False):
+            self.profiler = cProfile.Profile()
+            _local.profiling = True
+            self.profiler.enable()
+
+        self.started_at = datetime.now()
+        self.rss = PeakRSS().__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if not self.recorder.enabled:
+            return False
+
+        seconds = time.perf_counter() - self.start
+        self.rss.__exit__(exc_type, exc, traceback)
+        if self.profiler is not None:
+            self.profiler.disable()
+            _local.profiling = False
+            self.profiler.dump_stats(self.recorder.profile_path(self.name, self.file or self.table or "all"))
+        if self.discard:
+            return False
+
+        self.recorder.emit({
+            "stage": self.name, "table": self.table, "file": self.file,
+            "status": "failed" if exc_type is not None else self.status or "ok",
+            "started_at": self.started_at.isoformat(), "seconds": seconds,
+            "rows": self.rows, "bytes": self.bytes,
+            "rows_per_second": self.rows / seconds if self.rows is not None and seconds > 0 else None,
+            "bytes_per_second": self.bytes / seconds if self.bytes is not None and seconds > 0 else None,
+            "peak_rss_bytes": self.rss.peak,
+            "rss_growth_bytes": self.rss.peak - self.rss.start if self.rss.start is not None else None,
+            "pid": os.getpid(),
+            **self.labels
+        })
+        return False
+
+
+def iter_stage(name, iterable, **kwargs):
+    """Yields from `iterable`, recording the production of each item (e.g. a parsed chunk) as a run of stage `name`.
+
+    Each item's length is recorded as its rows; `kwargs` are passed on to `stage`.
+    """
+    iterator = iter(iterable)
+    while True:
+        with stage(name, **kwargs) as s:
+            try:
+                item = next(iterator)
+            except StopIteration:
+                s.discard = True
+                return
+            s.rows = len(item)
+        yield item
@@ -0,0 +1 @@
+"""Columnar Parquet mirror of the trade tables; see `tradedata.mirror.export` and `tradedata.mirror.query`."""
@@ -0,0 +1,284 @@
+"""
+TITLE: Parquet Mirror Export
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Writes the trade tables to a Hive-partitioned Parquet dataset,
+
+    <mirror_dir>/table=imports/year=2020/month=1/part-0.parquet
+
+for scan-heavy analytics away from the database (see `tradedata.mirror.query`).
+`tradedata mirror --mirror_dir data/mirror` exports every loaded month.
+
+As with the database partitions, each row goes into the partition of its own
+date, so a trade file's late declarations and EU 13th month rows land in
+earlier months than the file's. A month's partition therefore holds rows from
+several files, kept apart by name: `part-<YYYYMM>-<n>.parquet` holds rows of
+the file for month YYYYMM (their `load_period`).
+
+Rows are written from the output of `etl_trade_table`, or exported from the
+loaded table, into a temporary directory per month that is then swapped in.
+Mirroring a trade file replaces only that file's parts in each month its rows
+are dated in, or were dated in when it was last mirrored; exporting months
+from the database replaces them whole. Either can be re-run, so the mirror can
+be updated incrementally alongside each monthly load. Months mirrored before
+rows were split by date (as `part-<n>.parquet`) should be exported again.
+
+Every partition is written with the same Arrow schema, built from the table
+specification plus `load_period`. Code columns (char / varchar / text) are
+dictionary encoded and rows are sorted by comcode, so row group statistics can
+skip ranges of codes.
+"""
+
+import shutil
+import argparse
+from pathlib import Path
+from datetime import date
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import MetaData, Table, select, and_, literal_column
+from sqlalchemy import Boolean, Date, Integer, BigInteger, Float, String
+
+from tradedata.utils import read_credentials, connect_to_postgres
+from tradedata.initialise.table_plan import compile_plan
+from tradedata.initialise.create_database import etl_trade_table, etl_trade_table_chunks, file_period
+from tradedata.initialise.partitions import partition_bounds
+from tradedata.initialise.download_data import link_or_copy
+from tradedata.ledger import latest_loads
+
+MIRROR_DIR = "data/mirror"
+
+# Columns added by the database rather than the table specification, left out of the mirror
+DATABASE_COLUMNS = ["id", "row_key", "row_hash", "load_period"]
+
+# Rows per Parquet row group; smaller groups give finer grained statistics to skip on.
+ROW_GROUP_SIZE = 256 * 1024
+
+
+# FUNCTIONS ####################################################################
+def arrow_schema(dtype_dict):
+    """Arrow schema for a table from its SQLAlchemy dtypes (see `TablePlan.dtype_dict`).
+
+    String columns become dictionary encoded; unrecognised types are left out.
+    """
+    fields = []
+    for (name, dtype) in dtype_dict.items():
+        if isinstance(dtype, Boolean):
+            fields.append(pa.field(name, pa.bool_()))
+        elif isinstance(dtype, Date):
+            fields.append(pa.field(name, pa.date32()))
+        elif isinstance(dtype, BigInteger):
+            fields.append(pa.field(name, pa.int64()))
+        elif isinstance(dtype, Integer):
+            fields.append(pa.field(name, pa.int32()))
+        elif isinstance(dtype, Float):
+            fields.append(pa.field(name, pa.float64()))
+        elif isinstance(dtype, String):
+            fields.append(pa.field(name, pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(fields)
+
+
+def mirror_schema(dtype_dict):
+    """Arrow schema of a table in the mirror: its columns, from `arrow_schema`, plus `load_period`."""
+    return arrow_schema({**dtype_dict, "load_period": Date()})
+
+
+def month_path(mirror_dir, table_name, period):
+    """Directory of a month's partition within the mirror."""
+    return Path(mirror_dir) / f"table={table_name}" / f"year={period.year}" / f"month={period.month}"
+
+
+def part_prefix(load_period):
+    """Name prefix of the files holding rows loaded from a month's file; `part-none-` for rows without a `load_period`."""
+    return "part-none-" if pd.isna(load_period) else f"part-{load_period:%Y%m}-"
+
+
+def row_months(data, load_period = None):
+    """Month (first day) of each row's own date, as a Series of `datetime.date`; rows without a date get `load_period`."""
+    months = pd.Series(pd.to_datetime(data["date"]).to_numpy().astype("datetime64[M]"), index = data.index)
+    months = months.dt.date.astype(object)
+    return months.where(months.notna(), load_period)
+
+
+def write_months(chunks, mirror_dir, table_name, schema, load_period = None, months = ()):
+    """Writes rows to the partitions of the months they are dated in; see the module docstring.
+
+    With `load_period`, the rows are those of the month's trade file: only
+    that file's parts of each month are replaced, and its parts in months the
+    rows no longer reach are removed. Without it, every month written to (and
+    each of `months`) is replaced whole.
+
+    :param chunks: Data, as one DataFrame or an iterable of them (e.g. from `etl_trade_table_chunks`); one file is written per chunk, month and `load_period`.
+    :type chunks: pandas.DataFrame, or iterable of DataFrames.
+    :param mirror_dir: Root of the Parquet dataset.
+    :type mirror_dir: pathlib.Path() object, or str.
+    :param table_name: Trade table the data belongs to.
+    :type table_name: String
+    :param schema: Arrow schema of the table, from `mirror_schema`.
+    :type schema: pyarrow.Schema
+    :param load_period: Month of the trade file the rows came from, as returned by `file_period`; written to each row.
+    :type load_period: datetime.date
+    :param months: Months to replace even if no rows are dated in them.
+    :type months: Iterable of datetime.date.
+    :return: Dict of month : rows written, for every month replaced.
+    """
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+
+    staged = {}     # month : (staging directory, files written per prefix)
+    written = {}
+
+    def stage(month):
+        # Dot-prefixed working directories are ignored by dataset discovery
+        if month not in staged:
+            target = month_path(mirror_dir, table_name, month)
+            staging = target.with_name(f".{target.name}.tmp")
+            shutil.rmtree(staging, ignore_errors = True)
+            staging.mkdir(parents = True)
+            if load_period is not None and target.exists():
+                for path in target.glob("*.parquet"):
+                    if not path.name.startswith(part_prefix(load_period)):
+                        link_or_copy(path, staging)
+            staged[month] = (staging, {})
+            written[month] = 0
+        return staged[month]
+
+    for month in months:
+        stage(month)
+    if load_period is not None:
+        table_dir = Path(mirror_dir) / f"table={table_name}"
+        for path in table_dir.glob(f"year=*/month=*/{part_prefix(load_period)}*.parquet"):
+            keys = dict(x.split("=") for x in path.parent.relative_to(table_dir).parts)
+            stage(date(int(keys["year"]), int(keys["month"]), 1))
+
+    for data in chunks:
+        if load_period is not None:
+            data = data.assign(load_period = load_period)
+        for (month, rows) in data.groupby(row_months(data, load_period), sort = False):
+            (staging, counts) = stage(month)
+            for (prefix, part) in rows.groupby(rows["load_period"].map(part_prefix), sort = False):
+                part = part.sort_values("comcode") if "comcode" in part.columns else part
+                table = pa.Table.from_pandas(part[schema.names], schema = schema, preserve_index = False)
+                n = counts.get(prefix, 0)
+                pq.write_table(table, staging / f"{prefix}{n}.parquet", row_group_size = ROW_GROUP_SIZE)
+                counts[prefix] = n + 1
+                written[month] += table.num_rows
+
+    # Swap each new month in; readers only ever see a complete partition
+    for (month, (staging, _)) in staged.items():
+        target = month_path(mirror_dir, table_name, month)
+        old = target.with_name(f".{target.name}.old")
+        if target.exists():
+            target.rename(old)
+        if any(staging.iterdir()):
+            staging.rename(target)
+        else:
+            staging.rmdir()
+        shutil.rmtree(old, ignore_errors = True)
+    return written
+
+
+def mirror_trade_file(trade_file, mirror_dir, table_name, spec_list, recode_dict, datestring, chunksize = None,
+                      data = None):
+    """Processes a trade file with `etl_trade_table` and writes its rows to the partitions of their months.
+
+    Rows mirrored from an earlier run of the same file are replaced.
+
+    :param trade_file: Path to the Trade Data File, or a file within a zip archive.
+    :type trade_file: pathlib.Path() object, str, or ArchiveMember.
+    :param mirror_dir: Root of the Parquet dataset.
+    :type mirror_dir: pathlib.Path() object, or str.
+    :param table_name: Trade table the file belongs to.
+    :type table_name: String
+    :param spec_list: Specification for the data file.
+    :type spec_list: List of Dictionaries with keys `name` and `type`.
+    :param recode_dict: Dict of Dicts that specifies recoding for data columns.
+    :type recode_dict: Dictionary with keys corresponding to column names from `spec_list`.
+    :param datestring: `strptime` Date String to transform date columns.
+    :type datestring: String
+    :param chunksize: If set, stream the file in chunks of this many rows, one Parquet file each per month.
+    :type chunksize: int
+    :param data: The file already processed by `etl_trade_table`, to write in place of running the ETL again; `chunksize` is then ignored.
+    :type data: pandas.DataFrame
+    :return: Number of rows written.
+    """
+    schema = mirror_schema(compile_plan(spec_list).dtype_dict)
+    if data is not None:
+        chunks = data
+    elif chunksize is None:
+        chunks = etl_trade_table(trade_file, spec_list, recode_dict, datestring)
+    else:
+        chunks = etl_trade_table_chunks(trade_file, spec_list, recode_dict, datestring, chunksize)
+
+    written = write_months(chunks, mirror_dir, table_name, schema, load_period = file_period(trade_file))
+    rows = sum(written.values())
+    months = ", ".join(f"{x:%Y-%m}" for x in sorted(written))
+    print(f"Mirrored {rows} rows of {trade_file} to {table_name} months {months}")
+    return rows
+
+
+def export_table(engine, table_name, mirror_dir = MIRROR_DIR, periods = None, chunksize = 500000):
+    """Exports months of a loaded trade table from the database to the mirror, selecting rows by their own dates.
+
+    :param engine: SQLAlchemy Engine holding the table.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Trade table to export.
+    :type table_name: String
+    :param mirror_dir: Root of the Parquet dataset.
+    :type mirror_dir: pathlib.Path() object, or str.
+    :param periods: Months to export; defaults to every month with a complete load in the ledger.
+    :type periods: List of datetime.date.
+    :param chunksize: Rows read from the database at a time.
+    :type chunksize: int
+    :return: Dict of month : rows written.
+    """
+    table = Table(table_name, MetaData(), autoload = True, autoload_with = engine)
+    schema = mirror_schema({x.name: x.type for x in table.columns if x.name not in DATABASE_COLUMNS})
+    # Tables loaded before `load_period` was recorded export it as null
+    if "load_period" in table.c:
+        load_period = table.c.load_period
+    else:
+        load_period = literal_column("NULL::date").label("load_period")
+    columns = [table.c[x] for x in schema.names if x != "load_period"] + [load_period]
+
+    if periods is None:
+        loads = latest_loads(engine, [table_name])
+        periods = sorted(period for ((_, period), entry) in loads.items()
+                         if period is not None and entry["status"] == "complete")
+
+    written = {}
+    for period in periods:
+        start, end = partition_bounds(period, "month")
+        query = select(columns).where(and_(table.c.date >= start, table.c.date < end))
+        with engine.connect() as conn:
+            chunks = pd.read_sql(query, conn, chunksize = chunksize)
+            written[period] = write_months(chunks, mirror_dir, table_name, schema, months = [period])[period]
+        print(f"Exported {written[period]} rows of {table_name} for {period:%Y-%m}")
+    return written
+
+
+# MAIN #########################################################################
+def main(argv = None, prog = None):
+    """Entry point of `tradedata mirror`; `argv` defaults to the command line."""
+
+    # Parse Arguments
+    parser = argparse.ArgumentParser(prog = prog, description="Export the loaded trade tables to the Parquet mirror.")
+    parser.add_argument("--mirror_dir", help="Root of the Parquet dataset.", default = MIRROR_DIR)
+    parser.add_argument("--tables", nargs = "+",
+                        help="Trade tables to export.",
+                        default = ["exports", "imports", "dispatches", "arrivals"])
+    args = parser.parse_args(argv)
+
+    db_c = read_credentials("conf/credentials.yml")["database"]
+    engine = connect_to_postgres(username = db_c["username"], password = db_c["password"],
+                                 host = db_c["host"], database = db_c["database"])
+
+    for table_name in args.tables:
+        export_table(engine, table_name, args.mirror_dir)
+
+
+if __name__ == '__main__':
+    main()
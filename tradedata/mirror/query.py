@@ -0,0 +1,171 @@
+"""
+TITLE: Parquet Mirror Queries
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Filtered aggregates over the Parquet mirror written by `tradedata.mirror.export`.
+
+Filters are pushed down to the scan: date ranges prune whole `year=` / `month=`
+directories and, with code filters, skip row groups by their statistics. Only
+the columns a query needs are read. Batches are aggregated as they are scanned,
+so memory use depends on the number of groups rather than the rows scanned.
+
+Filters are built only from comparisons, which pyarrow 2.0 can evaluate on the
+dictionary encoded code columns: a list of codes is an OR of equalities, and a
+comcode prefix the range of codes from the prefix up to the next one.
+
+>>> aggregate("data/mirror", "imports", ["year", "chapter"], start = date(2010, 1, 1),
+...           end = date(2019, 12, 31), codes = {"cod_code": ["CN"]})
+"""
+
+import re
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from tradedata.mirror.export import MIRROR_DIR
+
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16()), ("month", pa.int8())]), flavor = "hive")
+
+# Derived group by keys : leading comcode digits
+COMCODE_LEVELS = {"chapter": 2, "heading": 4}
+
+
+# FUNCTIONS ####################################################################
+def open_table(table_name, mirror_dir = MIRROR_DIR):
+    """Returns a trade table of the mirror as a `pyarrow.dataset.Dataset`, with `year` and `month` columns."""
+    return ds.dataset(f"{mirror_dir}/table={table_name}", format = "parquet", partitioning = PARTITIONING)
+
+
+def month_filter(start = None, end = None):
+    """Expression on the `year` / `month` partition columns covering `[start, end]`, or None."""
+    expression = None
+    if start is not None:
+        after = (ds.field("year") > start.year) | ((ds.field("year") == start.year) & (ds.field("month") >= start.month))
+        expression = after
+    if end is not None:
+        before = (ds.field("year") < end.year) | ((ds.field("year") == end.year) & (ds.field("month") <= end.month))
+        expression = before if expression is None else expression & before
+    return expression
+
+
+def any_of(expressions):
+    """OR of a list of expressions, or None if it is empty."""
+    expression = None
+    for x in expressions:
+        expression = x if expression is None else expression | x
+    return expression
+
+
+def prefix_filter(column, prefix):
+    """Expression keeping the values of a string column starting with `prefix`, as a range comparison."""
+    expression = ds.field(column) >= prefix
+    if prefix[-1] < chr(0x10FFFF):
+        expression = expression & (ds.field(column) < prefix[0:-1] + chr(ord(prefix[-1]) + 1))
+    return expression
+
+
+def build_filter(start = None, end = None, comcode = None, codes = None):
+    """Builds the scan filter for `aggregate`.
+
+    :param start: First date included.
+    :type start: datetime.date
+    :param end: Last date included.
+    :type end: datetime.date
+    :param comcode: Comcode, or prefix of one (e.g. a chapter), to keep.
+    :type comcode: String
+    :param codes: Column : list of codes to keep, e.g. `{"cod_code": ["FR", "DE"]}`.
+    :type codes: Dict
+    :return: pyarrow.dataset.Expression, or None for no filter.
+    """
+    conditions = []
+    partitions = month_filter(start, end)
+    if partitions is not None:
+        conditions.append(partitions)
+    if start is not None:
+        conditions.append(ds.field("date") >= pa.scalar(start, pa.date32()))
+    if end is not None:
+        conditions.append(ds.field("date") <= pa.scalar(end, pa.date32()))
+    if comcode:
+        if len(comcode) == 8:
+            conditions.append(ds.field("comcode") == comcode)
+        else:
+            conditions.append(prefix_filter("comcode", comcode))
+    for (column, values) in (codes or {}).items():
+        values = list(values)
+        conditions.append(any_of([ds.field(column) == x for x in values]) if values else ds.scalar(False))
+
+    expression = None
+    for condition in conditions:
+        expression = condition if expression is None else expression & condition
+    return expression
+
+
+def aggregate(mirror_dir, table_name, group_by, measures = ("value",), start = None, end = None,
+              comcode = None, codes = None, batch_size = 1024 * 1024):
+    """Sums `measures` over a table of the mirror, grouped by `group_by`.
+
+    :param mirror_dir: Root of the Parquet dataset.
+    :type mirror_dir: pathlib.Path() object, or str.
+    :param table_name: Trade table to query.
+    :type table_name: String
+    :param group_by: Columns to group by: any column of the table, `year` / `month`, or `chapter` / `heading` (leading digits of comcode).
+    :type group_by: List of str.
+    :param measures: Columns to sum.
+    :type measures: List of str.
+    :param start: First date included.
+    :type start: datetime.date
+    :param end: Last date included.
+    :type end: datetime.date
+    :param comcode: Comcode, or prefix of one, to keep.
+    :type comcode: String
+    :param codes: Column : list of codes to keep.
+    :type codes: Dict
+    :param batch_size: Most rows held in memory at once while scanning.
+    :type batch_size: int
+    :return: pandas.DataFrame with one row per group, plus a `row_count` column.
+    """
+    dataset = open_table(table_name, mirror_dir)
+    derived = {x: COMCODE_LEVELS[x] for x in group_by if x in COMCODE_LEVELS}
+    keys = [x for x in group_by if x not in derived] + (["comcode"] if derived else [])
+    columns = list(dict.fromkeys(keys + list(measures)))
+
+    batches = dataset.to_batches(columns = columns, filter = build_filter(start, end, comcode, codes),
+                                 batch_size = batch_size)
+
+    partials = []
+    for batch in batches:
+        if batch.num_rows == 0:
+            continue
+        data = batch.to_pandas()
+        for (name, digits) in derived.items():
+            # Slice each distinct comcode once; trailing None catches missing values (code -1)
+            comcodes = data["comcode"].astype("category").cat
+            prefixes = np.append(comcodes.categories.str[0:digits].to_numpy(dtype = object), None)
+            data[name] = prefixes[comcodes.codes]
+        data["row_count"] = 1
+        partials.append(data.groupby(list(group_by), observed = True)[list(measures) + ["row_count"]].sum())
+
+    if not partials:
+        return pd.DataFrame(columns = list(group_by) + list(measures) + ["row_count"])
+    result = pd.concat(partials).groupby(level = list(range(len(group_by))), observed = True).sum()
+    return result.reset_index()
+
+
+def partition_keys(path):
+    """Hive partition keys in a path, e.g. `{"table": "imports", "year": "2020", "month": "1"}`."""
+    return dict(re.findall(r"([^/=]+)=([^/]*)", str(path).replace("\\", "/")))
+
+
+def months_available(mirror_dir, table_name):
+    """Months present in a table of the mirror, as a sorted list of `datetime.date`."""
+    dataset = open_table(table_name, mirror_dir)
+    months = set()
+    for path in dataset.files:
+        keys = partition_keys(path)
+        months.add(date(int(keys["year"]), int(keys["month"]), 1))
+    return sorted(months)
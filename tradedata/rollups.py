@@ -0,0 +1,169 @@
+"""
+TITLE: Rollups
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Pre-aggregated rollup tables for the common trade queries: the sum of each
+measure by month, country of dispatch/destination and commodity code prefix.
+
+Each trade table gets one rollup per level in `ROLLUP_LEVELS`, e.g.
+`imports_rollup_chapter`, holding `date`, `cod_code`, `code` (the first 2, 4 or
+8 digits of the comcode), the summed measures and the `row_count` summed over.
+The comcode rollup is aggregated from the raw rows and each coarser level from
+the one below it, so only one pass is made over the trade table.
+
+Rollups are plain tables rather than materialized views so that a single
+month can be refreshed after a load, with a DELETE and INSERT in one
+transaction, instead of rebuilding the whole view. Each refresh is recorded in
+the load ledger as `<table>_rollups`, so readers of the ledger (such as the API's
+result cache) know when a month's rollups have changed.
+
+A trade file's rows aren't all dated in its own month, so after a load
+`refresh_load_rollups` refreshes every month the ledger records the load as
+having changed.
+"""
+
+from sqlalchemy import MetaData, Table, Column, Index
+from sqlalchemy import Text, Date, Float, BigInteger
+from sqlalchemy import select, func, and_, literal_column
+
+from tradedata.initialise.partitions import partition_bounds
+from tradedata.ledger import recorded_load, load_months
+
+# Rollup level : number of leading comcode digits it is grouped by
+ROLLUP_LEVELS = {"chapter": 2, "heading": 4, "comcode": 8}
+
+# Columns summed in the rollups, where the trade table has them
+ROLLUP_MEASURES = ["value", "net_mass"]
+
+
+# FUNCTIONS ####################################################################
+def rollup_name(table_name, level):
+    """Name of a trade table's rollup at `level`, e.g. `imports_rollup_chapter`."""
+    return f"{table_name}_rollup_{level}"
+
+
+def choose_rollup_level(level, comcode = None):
+    """Smallest rollup level that can group by `level` and filter on the `comcode` prefix.
+
+    :param level: Level the results are grouped by; one of `ROLLUP_LEVELS`.
+    :type level: String
+    :param comcode: Comcode prefix filtered on, if any.
+    :type comcode: String
+    :return: Rollup level name.
+    """
+    digits = max(ROLLUP_LEVELS[level], len(comcode or ""))
+    for (name, n) in sorted(ROLLUP_LEVELS.items(), key = lambda x: x[1]):
+        if n >= digits:
+            return name
+    return "comcode"
+
+
+def rollup_tables(engine, table_name, measures = ROLLUP_MEASURES):
+    """Defines the rollup tables for a trade table, without creating them.
+
+    :param engine: SQLAlchemy Engine the trade table is in.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Trade table.
+    :type table_name: String
+    :param measures: Columns to sum; those the trade table does not have are left out.
+    :type measures: List of str.
+    :return: Tuple of (reflected trade table, dict of level : rollup Table).
+    """
+    source = Table(table_name, MetaData(), autoload = True, autoload_with = engine)
+    measures = [x for x in measures if x in source.c]
+
+    metadata = MetaData()
+    rollups = {}
+    for level in ROLLUP_LEVELS:
+        name = rollup_name(table_name, level)
+        rollups[level] = Table(
+            name, metadata,
+            Column("date", Date, nullable = False),
+            Column("cod_code", Text),
+            Column("code", Text, nullable = False),
+            *[Column(x, Float) for x in measures],
+            Column("row_count", BigInteger, nullable = False),
+            Index(f"ix_{name}_code_date", "code", "date"),
+            Index(f"ix_{name}_date", "date")
+        )
+    return source, rollups
+
+
+def refresh_rollups(engine, table_name, period = None, measures = ROLLUP_MEASURES):
+    """Creates a trade table's rollups if needed, and rebuilds them for one month or in full.
+
+    All levels are refreshed in a single transaction, so queries never see a
+    month missing or half rebuilt.
+
+    :param engine: SQLAlchemy Engine the trade table is in.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Trade table.
+    :type table_name: String
+    :param period: Month to refresh, e.g. the month just loaded; None rebuilds every month.
+    :type period: datetime.date
+    :param measures: Columns to sum.
+    :type measures: List of str.
+    :return: Dict of rollup name : rows it holds for the refreshed period.
+    """
+    source, rollups = rollup_tables(engine, table_name, measures)
+    next(iter(rollups.values())).metadata.create_all(engine)
+    measures = [x for x in measures if x in source.c]
+
+    counts = {}
+    with recorded_load(engine, f"{table_name}_rollups", period) as entry, engine.begin() as conn:
+        # Finest level first, so each coarser level can be built from the one below
+        previous = None
+        for level in sorted(ROLLUP_LEVELS, key = lambda x: -ROLLUP_LEVELS[x]):
+            target = rollups[level]
+            base = source if previous is None else previous
+            code_column = base.c.comcode if previous is None else base.c.code
+            row_count = func.count() if previous is None else func.sum(base.c.row_count)
+
+            # Literal substr arguments keep the SELECT and GROUP BY expressions identical
+            code = func.substr(code_column, literal_column("1"), literal_column(str(ROLLUP_LEVELS[level])))
+            query = (select([base.c.date, base.c.cod_code, code.label("code")]
+                            + [func.sum(base.c[x]).label(x) for x in measures]
+                            + [row_count.label("row_count")])
+                     .group_by(base.c.date, base.c.cod_code, code))
+            delete = target.delete()
+
+            if period is not None:
+                start, end = partition_bounds(period, "month")
+                query = query.where(and_(base.c.date >= start, base.c.date < end))
+                delete = delete.where(and_(target.c.date >= start, target.c.date < end))
+
+            conn.execute(delete)
+            result = conn.execute(target.insert().from_select(
+                ["date", "cod_code", "code"] + measures + ["row_count"], query))
+            counts[target.name] = result.rowcount
+            previous = target
+        entry["row_count"] = sum(counts.values())
+        entry["months"] = None if period is None else [period]
+
+    return counts
+
+
+def refresh_load_rollups(engine, table_name, period, measures = ROLLUP_MEASURES):
+    """Refreshes a trade table's rollups for each month changed by the latest load of a month's file.
+
+    :param engine: SQLAlchemy Engine the trade table is in.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Trade table.
+    :type table_name: String
+    :param period: Month of the file loaded, as returned by `file_period`.
+    :type period: datetime.date
+    :param measures: Columns to sum.
+    :type measures: List of str.
+    :return: Dict of month : the `refresh_rollups` counts for it.
+    """
+    months = sorted(set(load_months(engine, table_name, period)) | {period})
+    return {month: refresh_rollups(engine, table_name, month, measures) for month in months}
+
+
+def build_rollups(engine, tables, measures = ROLLUP_MEASURES):
+    """Builds the rollups of each trade table in full; see `refresh_rollups`."""
+    for table_name in tables:
+        counts = refresh_rollups(engine, table_name, None, measures)
+        print(f"Rollups for {table_name} built: " + ", ".join(f"{k} ({v} rows)" for (k, v) in counts.items()))
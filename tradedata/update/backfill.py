@@ -0,0 +1,546 @@
+"""
+TITLE: Backfill
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Loads a range of months, running the stages of the monthly update for
+different months at the same time.
+
+    python3 -m tradedata.update.backfill --from 201901 --to 202012 --parse_workers 4 --load_workers 2
+
+Each stage has its own workers and hands its output to the next through a
+bounded queue:
+
+    download   fetch the month's archives (through the archive cache by default)
+    extract    unzip them into `<target>/<YYYYMM>/` and pick the files to load
+    parse      run the ETL on each file, in a pool of processes
+    load       write each file to the database as the monthly update does
+               (`load_trade_file`), refreshing the rollups of the months it changed
+
+Load workers take a lock per table, so two files of the same table are never
+loaded at once: two months' files can change the same month (late
+declarations), whose rollup refresh deletes and reinserts its rows, and both
+may create the same partition. Files of different tables load side by side.
+
+When a queue is full the stage feeding it waits, so if the database falls
+behind, parsing stops once `--queue_size` parsed files are waiting to load,
+then extraction and downloads stop in turn. Memory is bounded by the parsed
+files in the queue and in the hands of the parse and load workers.
+
+Control files are upserted in month order whatever order they are parsed in,
+so the latest month's descriptions win, as when the months are loaded one by
+one with `monthly_update`.
+
+Progress is checkpointed per month in `<checkpoint_dir>/<YYYYMM>.json`: the
+stages finished and the outcome of each file. Re-running the same command
+after an interruption or failure skips the months completed and the files
+already loaded, and the load ledger skips tables already holding the month.
+"""
+
+import json
+import queue
+import shutil
+import argparse
+import threading
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from tradedata.initialise.download_data import get_hyperlinks
+from tradedata.initialise.download_data import create_session
+from tradedata.initialise.download_data import download_files
+from tradedata.initialise.download_data import report_downloads
+from tradedata.initialise.download_data import unzip_trade_data
+from tradedata.initialise.download_data import BASE_URL
+from tradedata.initialise.archive_cache import ArchiveCache
+from tradedata.initialise.create_database import etl_file
+from tradedata.initialise.create_database import load_control_table
+from tradedata.initialise.create_database import LOAD_METHODS
+from tradedata.initialise.table_plan import load_table_plans, file_table
+from tradedata.update.monthly_update import fetch_month_archives, link_cached_members
+from tradedata.update.monthly_update import check_month_in_database, load_trade_file
+from tradedata.utils import read_credentials, connect_to_postgres
+from tradedata.ledger import create_load_ledger
+from tradedata.metrics import add_metrics_arguments, configure_from_args
+
+CHECKPOINT_DIR = "data/backfill/checkpoints"
+
+# Marks the end of a stage's input
+DONE = object()
+
+
+# FUNCTIONS ####################################################################
+def month_range(start, end):
+    """Months from `start` to `end` inclusive, as `YYYYMM` strings.
+
+    :raises ValueError: If either month is not a valid `YYYYMM` string.
+    """
+    start, end = datetime.strptime(start, "%Y%m"), datetime.strptime(end, "%Y%m")
+    assert start <= end, "The first month must not be after the last."
+
+    months = []
+    (year, month) = (start.year, start.month)
+    while (year, month) <= (end.year, end.month):
+        months.append(f"{year}{month:02d}")
+        (year, month) = (year, month + 1) if month < 12 else (year + 1, 1)
+    return months
+
+
+class MonthCheckpoint:
+    """Progress of one month of a backfill, saved to `<checkpoint_dir>/<YYYYMM>.json` whenever it changes.
+
+    The month's `status` is "running" until every file picked for it has been
+    loaded or has failed, and then "complete", or "failed" if anything failed.
+    Each file's outcome is kept under `files`, and when each stage finished
+    under `stages`.
+    """
+
+    def __init__(self, checkpoint_dir, month):
+        self.month = month
+        self.path = Path(checkpoint_dir) / f"{month}.json"
+        self.pending = None
+        self._lock = threading.Lock()
+        if self.path.exists():
+            self.state = json.loads(self.path.read_text())
+        else:
+            self.state = {"month": month, "status": "pending", "stages": {}, "files": {}, "errors": []}
+
+    @property
+    def complete(self):
+        return self.state["status"] == "complete"
+
+    def loaded(self, name):
+        """Whether the file `name` was loaded by an earlier run."""
+        return self.state["files"].get(name, {}).get("status") == "loaded"
+
+    def _save(self):
+        self.state["updated_at"] = datetime.now().isoformat(timespec = "seconds")
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(self.state, indent = 2))
+        tmp.replace(self.path)
+
+    def start(self):
+        """Marks the month as running, clearing the errors of earlier runs."""
+        with self._lock:
+            self.state.update(status = "running", errors = [])
+            self._save()
+
+    def stage_done(self, stage_name):
+        with self._lock:
+            self.state["stages"][stage_name] = datetime.now().isoformat(timespec = "seconds")
+            self._save()
+
+    def error(self, stage_name, error):
+        """Records a failure that leaves the month incomplete, e.g. an archive that would not download."""
+        with self._lock:
+            self.state["errors"].append({"stage": stage_name, "error": error})
+            self._save()
+
+    def expect(self, names):
+        """Sets the files still to load for the month; returns True if there are none, finishing the month."""
+        with self._lock:
+            self.pending = set(names)
+            # Outcomes of earlier runs other than loads are superseded
+            self.state["files"] = {k: v for (k, v) in self.state["files"].items() if v["status"] == "loaded"}
+            for name in names:
+                self.state["files"][name] = {"status": "queued"}
+            return self._finish_if_done()
+
+    def finish_file(self, name, table_name, status, rows = None, error = None):
+        """Records a file's outcome ("loaded" or "failed"); returns True if it was the month's last file."""
+        with self._lock:
+            self.state["files"][name] = {"table": table_name, "status": status, "rows": rows, "error": error}
+            self.pending.discard(name)
+            return self._finish_if_done()
+
+    def fail(self, stage_name, error):
+        """Records an error that stops the month altogether, finishing it as failed."""
+        with self._lock:
+            self.state["errors"].append({"stage": stage_name, "error": error})
+            self.pending = set()
+            return self._finish_if_done()
+
+    def _finish_if_done(self):
+        if self.pending:
+            self._save()
+            return False
+        failed = self.state["errors"] or any(x["status"] == "failed" for x in self.state["files"].values())
+        self.state["status"] = "failed" if failed else "complete"
+        self._save()
+        return True
+
+
+class Backfill:
+    """Loads a range of months as a pipeline of download, extract, parse and load stages; see the module docstring.
+
+    :param months: Months to load, as `YYYYMM` strings.
+    :type months: List of str.
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param plans: Compiled plan per table, from `load_table_plans`.
+    :type plans: Dict of table name : TablePlan.
+    :param target: Directory the months' files are extracted to, one subdirectory per month.
+    :type target: pathlib.Path() object, or str.
+    :param checkpoint_dir: Directory of the per-month checkpoints.
+    :type checkpoint_dir: pathlib.Path() object, or str.
+    :param cache: Archive cache to download through; None downloads straight into each month's directory.
+    :type cache: ArchiveCache
+    :param workers: Workers per stage, as a Dict with keys `download`, `extract`, `parse` and `load`.
+    :type workers: Dict
+    :param queue_size: Most items waiting between two stages.
+    :type queue_size: int
+    :param method: One of `LOAD_METHODS`, passed to `load_trade_table`.
+    :type method: String.
+    :param mirror_dir: Also write each trade file loaded to this Parquet mirror.
+    :type mirror_dir: pathlib.Path() object, or str.
+    :param base_url: Page the archives are listed on.
+    :type base_url: String
+    :param revalidate: Check cached archives are current with a conditional GET.
+    :type revalidate: bool
+    :param keep_files: Keep each month's extracted files once it is complete.
+    :type keep_files: bool
+    """
+
+    STAGES = ["download", "extract", "parse", "load"]
+
+    def __init__(self, months, engine, plans, target, checkpoint_dir = CHECKPOINT_DIR, cache = None,
+                 workers = None, queue_size = 2, method = "copy", mirror_dir = None, base_url = BASE_URL,
+                 revalidate = False, keep_files = False):
+        self.workers = {"download": 2, "extract": 1, "parse": 4, "load": 2, **(workers or {})}
+        assert all(x > 0 for x in self.workers.values()), "Every stage needs at least one worker."
+        assert queue_size > 0, "`queue_size` must be positive."
+        assert method in LOAD_METHODS, f"`method` must be one of {LOAD_METHODS}."
+
+        self.engine = engine
+        self.plans = plans
+        self.target = Path(target)
+        self.cache = cache
+        self.queue_size = queue_size
+        self.method = method
+        self.mirror_dir = mirror_dir
+        self.base_url = base_url
+        self.revalidate = revalidate
+        self.keep_files = keep_files
+        self.links = None
+        self.stop = threading.Event()
+
+        Path(checkpoint_dir).mkdir(parents = True, exist_ok = True)
+        self.checkpoints = {month: MonthCheckpoint(checkpoint_dir, month) for month in months}
+        for checkpoint in self.checkpoints.values():
+            if checkpoint.complete:
+                print(f"{checkpoint.month} was completed by an earlier run; skipping.")
+        self.months = [month for month in months if not self.checkpoints[month].complete]
+
+        # Control files waiting for an earlier month's to be upserted
+        self._control_order = list(self.months)
+        self._control_waiting = {}
+        self._control_lock = threading.Lock()
+
+        # Held while a file of the table loads
+        self._table_locks = {table: threading.Lock() for table in plans}
+
+    def month_dir(self, month):
+        return self.target / month
+
+    def put(self, outbox, item):
+        """Puts `item` on a stage's output queue, waiting while it is full unless the backfill is stopped."""
+        while not self.stop.is_set():
+            try:
+                outbox.put(item, timeout = 0.5)
+                return
+            except queue.Full:
+                continue
+
+    def run_stage(self, name, function, inbox, outbox):
+        """Starts the workers of a stage, each applying `function` to items from `inbox` until `DONE`.
+
+        `function` returns (or yields) the items to pass to `outbox`. When the
+        last worker finishes, `DONE` is passed on.
+        """
+        running = [self.workers[name]]
+        lock = threading.Lock()
+
+        def work():
+            try:
+                while not self.stop.is_set():
+                    try:
+                        item = inbox.get(timeout = 0.5)
+                    except queue.Empty:
+                        continue
+                    if item is DONE:
+                        inbox.put(DONE)     # For the stage's other workers
+                        break
+                    for output in function(item):
+                        self.put(outbox, output)
+            finally:
+                with lock:
+                    running[0] -= 1
+                    last = running[0] == 0
+                if last and outbox is not None:
+                    self.put(outbox, DONE)
+
+        threads = [threading.Thread(target = work, name = f"{name}-{i}", daemon = True)
+                   for i in range(self.workers[name])]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    # STAGES ===================================================================
+    def download(self, month):
+        """Download stage: fetches the month's archives, yielding `(month, results)`."""
+        checkpoint = self.checkpoints[month]
+        checkpoint.start()
+        (year, mm) = (month[2:4], month[4:6])
+        try:
+            if self.cache is not None:
+                results = fetch_month_archives(self.cache, month = mm, year = year, base_url = self.base_url,
+                                               revalidate = self.revalidate)
+            else:
+                month_dir = self.month_dir(month)
+                shutil.rmtree(month_dir, ignore_errors = True)
+                month_dir.mkdir(parents = True)
+                links = [x for x in self.links if x.find(f"{year}{mm}.zip") >= 0]
+                results = download_files(links, month_dir, session = create_session())
+        except Exception as e:
+            self.fail_month(month, "download", e)
+            return
+
+        report_downloads(results)
+        for result in results:
+            if result.status == "failed":
+                checkpoint.error("download", f"{result.url}: {result.error}")
+        if not results:
+            self.fail_month(month, "download", "No files were found for the month.")
+            return
+        checkpoint.stage_done("download")
+        yield (month, results)
+
+    def extract(self, item):
+        """Extract stage: unzips the month's archives, yielding `(month, trade_file)` for each file to load."""
+        (month, results) = item
+        checkpoint = self.checkpoints[month]
+        month_dir = self.month_dir(month)
+        try:
+            if self.cache is not None:
+                shutil.rmtree(month_dir, ignore_errors = True)
+                files = link_cached_members(self.cache, results, month_dir)
+            else:
+                unzip_trade_data(month_dir)
+                files = [x for x in month_dir.rglob("*") if x.is_file()]
+            tables_to_load = check_month_in_database(self.engine, f"{month}01")
+        except Exception as e:
+            self.fail_month(month, "extract", e)
+            return
+
+        files = sorted(x for x in files if file_table(x, strict = False) in tables_to_load
+                       and not checkpoint.loaded(x.name))
+        if not any(file_table(x) == "control" for x in files):
+            self.control_arrived(month, None)
+
+        checkpoint.stage_done("extract")
+        if checkpoint.expect([x.name for x in files]):
+            self.finish_month(month)
+        for trade_file in files:
+            yield (month, trade_file)
+
+    def parse(self, item, parsers):
+        """Parse stage: runs the ETL on a file in the process pool, yielding `(month, trade_file, data)`."""
+        (month, trade_file) = item
+        table_name = file_table(trade_file)
+        plan = self.plans[table_name]
+        print(f"Parsing {trade_file}...")
+        try:
+            data = parsers.submit(etl_file, trade_file, table_name, plan.spec_list,
+                                  plan.recode_dict, plan.date_format).result()
+        except Exception as e:
+            self.file_failed(month, trade_file, "parse", e)
+            if table_name == "control":
+                self.control_arrived(month, None)
+            return
+        yield (month, trade_file, data)
+
+    def load(self, item):
+        """Load stage: loads a parsed file with `load_trade_file`, as the monthly update does, one file per table at a time."""
+        (month, trade_file, data) = item
+        table_name = file_table(trade_file)
+        if table_name == "control":
+            self.control_arrived(month, (trade_file, data))
+            return ()
+
+        try:
+            with self._table_locks[table_name]:
+                rows = load_trade_file(trade_file, self.engine, table_name, self.plans[table_name],
+                                       mirror_dir = self.mirror_dir, method = self.method, data = data)
+        except Exception as e:
+            self.file_failed(month, trade_file, "load", e)
+            return ()
+
+        if self.checkpoints[month].finish_file(trade_file.name, table_name, "loaded", rows):
+            self.finish_month(month)
+        return ()
+
+    # CONTROL FILES ============================================================
+    def control_arrived(self, month, parsed):
+        """Upserts a month's parsed control file once every earlier month's has been; None if the month has none to load."""
+        with self._control_lock:
+            self._control_waiting[month] = parsed
+            while self._control_order and self._control_order[0] in self._control_waiting:
+                next_month = self._control_order.pop(0)
+                parsed = self._control_waiting.pop(next_month)
+                if parsed is not None:
+                    self.load_control(next_month, *parsed)
+
+    def load_control(self, month, trade_file, data):
+        try:
+            counts = load_control_table(trade_file, self.engine, self.plans["control"].spec_list, data = data)
+        except Exception as e:
+            self.file_failed(month, trade_file, "load", e)
+            return
+        print(f"Upserted {trade_file}: {counts}")
+        if self.checkpoints[month].finish_file(trade_file.name, "control", "loaded", sum(counts.values())):
+            self.finish_month(month)
+
+    # OUTCOMES =================================================================
+    def file_failed(self, month, trade_file, stage_name, error):
+        print(f"Failed to {stage_name} {trade_file}: {error!r}")
+        if self.checkpoints[month].finish_file(trade_file.name, file_table(trade_file), "failed",
+                                               error = f"{stage_name}: {error!r}"):
+            self.finish_month(month)
+
+    def fail_month(self, month, stage_name, error):
+        print(f"Failed to {stage_name} {month}: {error!r}")
+        self.control_arrived(month, None)
+        if self.checkpoints[month].fail(stage_name, repr(error)):
+            self.finish_month(month)
+
+    def finish_month(self, month):
+        checkpoint = self.checkpoints[month]
+        print(f"{month} {checkpoint.state['status']}.")
+        if checkpoint.complete and not self.keep_files:
+            shutil.rmtree(self.month_dir(month), ignore_errors = True)
+
+    # SCHEDULER ================================================================
+    def run(self):
+        """Runs the pipeline over every month not yet complete.
+
+        On KeyboardInterrupt the stages stop after their current items; months
+        left unfinished are resumed from their checkpoints by the next run.
+
+        :return: Dict of month : checkpoint state.
+        """
+        if not self.months:
+            return {month: x.state for (month, x) in self.checkpoints.items()}
+
+        create_load_ledger(self.engine)
+        if self.cache is None:
+            self.links = get_hyperlinks(base_url = self.base_url, session = create_session())
+
+        months = queue.Queue()
+        for month in self.months:
+            months.put(month)
+        months.put(DONE)
+        (extract_queue, parse_queue, load_queue) = (queue.Queue(maxsize = self.queue_size) for _ in range(3))
+
+        parsers = ProcessPoolExecutor(max_workers = self.workers["parse"])
+        threads = (self.run_stage("download", self.download, months, extract_queue) +
+                   self.run_stage("extract", self.extract, extract_queue, parse_queue) +
+                   self.run_stage("parse", lambda x: self.parse(x, parsers), parse_queue, load_queue) +
+                   self.run_stage("load", self.load, load_queue, None))
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(timeout = 0.5)
+        except KeyboardInterrupt:
+            print("Interrupted; stopping after the current files. Re-run to resume from the checkpoints.")
+            self.stop.set()
+            for thread in threads:
+                thread.join()
+        finally:
+            parsers.shutdown(wait = not self.stop.is_set())
+
+        return {month: x.state for (month, x) in self.checkpoints.items()}
+
+
+def report_backfill(states):
+    """Prints the outcome of each month of a backfill; returns the months that are not complete."""
+    incomplete = []
+    for (month, state) in sorted(states.items()):
+        loaded = [x for x in state["files"].values() if x["status"] == "loaded"]
+        rows = sum(x.get("rows") or 0 for x in loaded)
+        print(f"{month}: {state['status']} ({len(loaded)} files, {rows} rows loaded)")
+        for error in state["errors"]:
+            print(f"    {error['stage']}: {error['error']}")
+        for (name, entry) in sorted(state["files"].items()):
+            if entry["status"] != "loaded":
+                print(f"    {name}: {entry['status']} {entry.get('error') or ''}")
+        if state["status"] != "complete":
+            incomplete.append(month)
+    return incomplete
+
+
+# MAIN #########################################################################
+def main(argv = None, prog = None):
+    """Entry point of `tradedata backfill`; `argv` defaults to the command line."""
+
+    # Parse Arguments
+    parser = argparse.ArgumentParser(prog = prog, description="Load a range of months' trade data to the database, pipelining the stages.")
+    parser.add_argument("--from", dest = "from_month", required = True,
+                        help="First month to load, as YYYYMM.")
+    parser.add_argument("--to", dest = "to_month", required = True,
+                        help="Last month to load, as YYYYMM.")
+    parser.add_argument("-t", "--target",
+                        help="Directory the months' files are extracted to. Created if it does not exist.",
+                        default = 'data/backfill/')
+    parser.add_argument("--checkpoint_dir",
+                        help="Directory of the per-month checkpoints that an interrupted backfill resumes from.",
+                        default = CHECKPOINT_DIR)
+    parser.add_argument("--download_workers", type=int, help="Months downloaded at once.", default = 2)
+    parser.add_argument("--extract_workers", type=int, help="Months extracted at once.", default = 1)
+    parser.add_argument("--parse_workers", type=int, help="Parser processes.", default = 4)
+    parser.add_argument("--load_workers", type=int, help="Concurrent database loads.", default = 2)
+    parser.add_argument("--queue_size", type=int,
+                        help="Most items waiting between two stages; bounds the parsed files held in memory.",
+                        default = 2)
+    parser.add_argument("--load_method", choices = LOAD_METHODS,
+                        help="How trade tables are loaded; `copy` bulk loads through Postgres COPY, `to_sql` uses pandas INSERTs.",
+                        default = 'copy')
+    parser.add_argument("--cache_dir",
+                        help="Archive cache directory; cached months are not downloaded again.",
+                        default = 'data/cache/')
+    parser.add_argument("--no_cache", action = "store_true",
+                        help="Download and unzip straight into the target directory, bypassing the archive cache.")
+    parser.add_argument("--revalidate", action = "store_true",
+                        help="Check cached archives are current with a conditional GET.")
+    parser.add_argument("--mirror_dir",
+                        help="Also write each trade file loaded to this Parquet mirror (see tradedata.mirror).",
+                        default = None)
+    parser.add_argument("--keep_files", action = "store_true",
+                        help="Keep each month's extracted files once it is complete.")
+    add_metrics_arguments(parser)
+    args = parser.parse_args(argv)
+    configure_from_args(args)
+
+    months = month_range(args.from_month, args.to_month)
+    plans = load_table_plans("data/lookups")
+
+    db_c = read_credentials("conf/credentials.yml")["database"]
+    engine = connect_to_postgres(username = db_c["username"], password = db_c["password"],
+                                 host = db_c["host"], database = db_c["database"])
+
+    backfill = Backfill(months, engine, plans, args.target, args.checkpoint_dir,
+                        cache = None if args.no_cache else ArchiveCache(args.cache_dir),
+                        workers = {"download": args.download_workers, "extract": args.extract_workers,
+                                   "parse": args.parse_workers, "load": args.load_workers},
+                        queue_size = args.queue_size, method = args.load_method, mirror_dir = args.mirror_dir,
+                        revalidate = args.revalidate, keep_files = args.keep_files)
+    incomplete = report_backfill(backfill.run())
+
+    if incomplete:
+        print(f"{len(incomplete)} months are incomplete; re-run the same command to retry them.")
+    else:
+        print("Backfill Completed Successfully!")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,48 +1,168 @@
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from tradedata.initialise.create_database import connect_to_postgres
+"""
+TITLE: Check Trade Records
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+What the database holds, according to the load ledger.
 
-def return_month_data(engine, datestring, threshold=50000):
+    tradedata status                              latest load of each table, and any unfinished loads
+    tradedata coverage --from 201001 --to 202012  months loaded per table, and the gaps
+    tradedata coverage --plot coverage.png        plot of records per table and month
+
+Only the ledger is read, so neither command touches the trade tables. pandas
+and the plotting libraries are imported only for `--plot`.
+"""
+
+import argparse
+from datetime import date, datetime
+
+from tradedata.utils import read_credentials, connect_to_postgres
+from tradedata.ledger import latest_loads, ledger_coverage
+
+TRADE_TABLES = ["exports", "imports", "dispatches", "arrivals"]
+
+
+# FUNCTIONS ####################################################################
+def connect(credentials = "conf/credentials.yml"):
+    """Engine for the database in the credentials file."""
+    db_c = read_credentials(credentials)["database"]
+    return connect_to_postgres(username = db_c["username"], password = db_c["password"],
+                               host = db_c["host"], database = db_c["database"])
+
+
+def return_month_data(engine, tables=["exports", "imports", "dispatches", "arrivals"]):
     """
-    Check tables don't have data in them already by loading # records and comparing them to threshold.
-    Returns list of tables to load for the month passed in the argument.
+    Return records loaded per table and month from the load ledger, in long format.
+    Loads that did not complete are included with their status so they can be spotted.
     """
+    import pandas as pd
+
+    coverage = ledger_coverage(engine, tables)
+    records = [{"date": period, "table": table,
+                "records": entry["row_count"], "status": entry["status"]}
+               for ((table, period), entry) in coverage.items()]
+
+    return pd.DataFrame(records, columns = ["date", "table", "records", "status"])
+
+
+def plot_month_data(df_records, path):
+    """Plots records per table and month, as returned by `return_month_data`, to an image file."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import seaborn as sns
+
+    plot = sns.lineplot(x = "date", y = "records", hue = "table", data = df_records)
+    plot.get_figure().savefig(path)
+
+
+def month_list(start, end):
+    """First days of the months from `start` to `end` inclusive."""
+    months = []
+    while start <= end:
+        months.append(start)
+        start = date(start.year + start.month // 12, start.month % 12 + 1, 1)
+    return months
+
+
+def table_coverage(engine, tables = TRADE_TABLES, start = None, end = None):
+    """Summarises the months each table holds between `start` and `end`.
+
+    :param start: First month; defaults to the earliest month in the ledger.
+    :type start: datetime.date
+    :param end: Last month; defaults to the latest month in the ledger.
+    :type end: datetime.date
+    :return: Dict of table : dict of `complete` (months), `rows`, `missing` (months with no load) and `incomplete` (month : status of the latest load).
+    """
+    coverage = ledger_coverage(engine, tables)
+    periods = [period for (_, period) in coverage]
+    if not periods:
+        return {table: {"complete": 0, "rows": 0, "missing": [], "incomplete": {}} for table in tables}
+    months = month_list(start or min(periods), end or max(periods))
+
+    summary = {}
+    for table in tables:
+        entries = {month: coverage.get((table, month)) for month in months}
+        complete = [m for (m, x) in entries.items() if x is not None and x["status"] == "complete"]
+        summary[table] = {
+            "complete": len(complete),
+            "rows": sum(entries[m]["row_count"] or 0 for m in complete),
+            "missing": [m for (m, x) in entries.items() if x is None],
+            "incomplete": {m: x["status"] for (m, x) in entries.items()
+                           if x is not None and x["status"] != "complete"}
+        }
+    return summary
+
+
+def print_status(engine):
+    """Prints the latest complete month of each table, and the loads that did not complete."""
+    loads = latest_loads(engine)
+    tables = sorted({table for (table, _) in loads})
+    if not tables:
+        print("Nothing has been loaded.")
+        return
+
+    for table in tables:
+        entries = {period: x for ((t, period), x) in loads.items() if t == table}
+        complete = sorted(p for (p, x) in entries.items() if p is not None and x["status"] == "complete")
+        if None in entries:
+            entry = entries[None]
+            print(f"{table:<11} {entry['status']} ({entry['row_count']} rows, {entry['started_at']:%Y-%m-%d %H:%M})")
+        elif complete:
+            latest = entries[complete[-1]]
+            print(f"{table:<11} {len(complete)} months to {complete[-1]:%Y-%m} "
+                  f"(latest {latest['row_count']} rows from {latest['source_file']})")
+        else:
+            print(f"{table:<11} no complete months")
+
+        for (period, entry) in sorted((p, x) for (p, x) in entries.items() if x["status"] != "complete"):
+            month = "" if period is None else f"{period:%Y-%m} "
+            print(f"    {month}{entry['status']}, started {entry['started_at']:%Y-%m-%d %H:%M}")
+
 
-    def return_monthly_records(engine, table_name, datestring):
-        """Query Database to return monthly records from Postgres"""
-        with engine.connect() as conn:
-            records = conn.execute(f"SELECT COUNT(date) FROM {table_name} WHERE date = '{datestring}'")
-            records = records.fetchone()[0]
-        return records
+def print_coverage(summary):
+    """Prints the output of `table_coverage`."""
+    for (table, entry) in summary.items():
+        print(f"{table:<11} {entry['complete']} months complete, {entry['rows']} rows")
+        if entry["missing"]:
+            print(f"    missing: {', '.join(f'{m:%Y-%m}' for m in entry['missing'])}")
+        for (month, status) in sorted(entry["incomplete"].items()):
+            print(f"    {month:%Y-%m}: {status}")
 
-    table_records = {}
-    for table in ["exports", "imports", "dispatches", "arrivals"]:
-        records = return_monthly_records(engine, table, datestring)
-        table_records[table] = records
 
-    table_records["date"] = datestring
+def status_main(argv = None, prog = None):
+    """Entry point of `tradedata status`."""
+    parser = argparse.ArgumentParser(prog = prog, description="Show the latest load of each table, from the load ledger.")
+    parser.parse_args(argv)
 
-    # Check for tables to load in update according to threshold and return.
-    return pd.DataFrame(table_records, index = [0])
+    print_status(connect())
 
 
+def coverage_main(argv = None, prog = None):
+    """Entry point of `tradedata coverage`."""
+    def month(value):
+        return datetime.strptime(value, "%Y%m").date()
 
-yr = [str(x) for x in range(10, 21)]
-mth = [str(x).rjust(2, "0") for x in range(1,13)]
+    parser = argparse.ArgumentParser(prog = prog, description="Show the months loaded per trade table, from the load ledger.")
+    parser.add_argument("--from", dest = "from_month", type = month,
+                        help="First month to check, as YYYYMM; defaults to the earliest loaded.", default = None)
+    parser.add_argument("--to", dest = "to_month", type = month,
+                        help="Last month to check, as YYYYMM; defaults to the latest loaded.", default = None)
+    parser.add_argument("--tables", nargs = "+", choices = TRADE_TABLES,
+                        help="Trade tables to check.", default = TRADE_TABLES)
+    parser.add_argument("--plot", help="Also plot records per table and month to this image file.", default = None)
+    args = parser.parse_args(argv)
 
-engine = connect_to_postgres(username = "postgres", password = "postgres",
-                                host = "localhost", database = "trade")
+    engine = connect()
+    print_coverage(table_coverage(engine, args.tables, args.from_month, args.to_month))
 
-month_data_records = []
-for year in yr:
-    for month in mth:
-        print("Testing " + datestring)
-        datestring = f"20{year}{month}01"
-        month_data_records.append(return_month_data(engine, datestring))
+    if args.plot is not None:
+        df_records = return_month_data(engine, args.tables)
+        df_records = df_records.sort_values(["table", "date"])
+        plot_month_data(df_records, args.plot)
+        print(f"Plot saved to {args.plot}")
 
-df_records = pd.concat(month_data_records)
-df_records["date"] = pd.to_datetime(df_records["date"])
-df_records = df_records.melt(id_vars = ["date"], var_name = "table", value_name = "records")
 
-sns.lineplot(x = "date", y = "records", hue = "table", data = df_records)
+# MAIN #########################################################################
+if __name__ == '__main__':
+    coverage_main()
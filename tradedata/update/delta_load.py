@@ -0,0 +1,261 @@
+"""
+TITLE: Delta Load
+AUTHOR: Louis Tsiattalou
+DATE STARTED: 2020-02-17
+REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
+DESCRIPTION:
+Reloads a revised month of a trade table by applying only the rows that
+changed, rather than deleting and reloading the month.
+
+HMRC republishes earlier months with revisions, which usually touch a few
+thousand of a month's rows. Each parsed row gets two 64 bit hashes:
+
+    row_key    its code columns (everything but the measures, see `key_columns`)
+               plus an occurrence number among rows with the same codes
+    row_hash   its full content
+
+which are stored with the row, along with `load_period`, the month of the file
+it came from. A delta load compares the file's hashes with those stored for the
+month: rows whose key is new are inserted, rows whose key is stored with a
+different hash are updated, and stored keys missing from the file are deleted.
+The changed rows are COPYed to a temporary staging table and applied with an
+UPDATE, INSERT and DELETE in one transaction, so readers see either the old
+month or the revised one.
+
+Rows loaded without hashes (by `load_trade_table`) can't be compared, so the
+first delta load of such a month replaces it in full: the rows loaded from the
+month's file, by their `load_period` whatever they are dated, are deleted and
+the file inserted with its hashes. Rows loaded before `load_period` was
+recorded can't be told apart from other files' rows of the same months, so a
+delta load refuses to run on a table holding any; reload the table in full
+first. Hashes come from `pandas.util.hash_pandas_object`; were a pandas upgrade
+to change them, the next delta load would delete and reinsert every row once,
+and still be right.
+"""
+
+import numpy as np
+import pandas as pd
+
+from sqlalchemy import String, Text, Date, BigInteger
+
+from tradedata.initialise.table_plan import compile_plan
+from tradedata.initialise.create_database import etl_trade_table, file_period, copy_dataframe, data_months
+from tradedata.initialise.partitions import partition_granularity, ensure_partition
+from tradedata.ledger import recorded_load, file_checksum
+from tradedata.metrics import stage
+
+# Columns added to the trade tables for delta loads
+DELTA_COLUMNS = {"row_key": BigInteger(), "row_hash": BigInteger(), "load_period": Date()}
+
+
+class DeltaLoadError(ValueError):
+    """Raised when a table's rows can't be matched to the file they were loaded from."""
+
+
+# FUNCTIONS ####################################################################
+def ensure_delta_columns(engine, table_name):
+    """Adds the `DELTA_COLUMNS` to a trade table, and an index to find a file's rows by, if missing.
+
+    Adding a column with no default doesn't rewrite the table, so this is cheap on a loaded table.
+    """
+    with engine.begin() as conn:
+        conn.execute(f'ALTER TABLE "{table_name}" '
+                     'ADD COLUMN IF NOT EXISTS row_key BIGINT, '
+                     'ADD COLUMN IF NOT EXISTS row_hash BIGINT, '
+                     'ADD COLUMN IF NOT EXISTS load_period DATE')
+        conn.execute(f'CREATE INDEX IF NOT EXISTS "ix_{table_name}_load_period_row_key" '
+                     f'ON "{table_name}" (load_period, row_key)')
+
+
+def key_columns(dtype_dict):
+    """Columns identifying a row of a trade table: the code and date columns, i.e. all but the measures."""
+    return [name for (name, dtype) in dtype_dict.items() if isinstance(dtype, (String, Text, Date))]
+
+
+def row_hashes(data, keys):
+    """Computes the `row_key` and `row_hash` of each row of processed trade data.
+
+    Rows with the same codes are numbered in order of their content hash, so
+    the keys don't depend on the order of rows in the file, and identical rows
+    get distinct keys.
+
+    :param data: Processed trade data, as returned by `etl_trade_table`.
+    :type data: pandas.DataFrame
+    :param keys: Columns identifying a row, from `key_columns`.
+    :type keys: List of str.
+    :return: Tuple of numpy int64 arrays `(row_key, row_hash)`, in the order of `data`.
+    """
+    key_hash = pd.util.hash_pandas_object(data[keys], index = False).to_numpy()
+    content_hash = pd.util.hash_pandas_object(data, index = False).to_numpy()
+
+    # Occurrence number within each run of equal key hashes, once sorted
+    order = np.lexsort((content_hash, key_hash))
+    sorted_keys = key_hash[order]
+    positions = np.arange(len(data))
+    starts = np.maximum.accumulate(np.where(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]], positions, 0))
+    occurrence = np.empty(len(data), dtype = np.int64)
+    occurrence[order] = positions - starts
+
+    row_key = pd.util.hash_pandas_object(pd.DataFrame({"key": key_hash, "occurrence": occurrence}),
+                                         index = False).to_numpy()
+    return row_key.view(np.int64), content_hash.view(np.int64)
+
+
+def read_row_hashes(cursor, table_name, period):
+    """Reads the stored hashes of the rows loaded from a month's file.
+
+    :param cursor: psycopg2 cursor.
+    :type cursor: psycopg2.extensions.cursor
+    :raises DeltaLoadError: If the table holds rows loaded without a `load_period`, which can't be matched to their file.
+    :return: Tuple of (pandas.Series of row_hash indexed by row_key for rows loaded from the month's file, whether any of the file's rows are stored without hashes).
+    """
+    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM "{table_name}" WHERE load_period IS NULL)')
+    if cursor.fetchone()[0]:
+        raise DeltaLoadError(f"{table_name} holds rows loaded without a load_period, which can't be matched to "
+                             f"the file they came from; drop it and reload it in full (`tradedata create`) before delta loading it.")
+
+    cursor.execute(f'SELECT row_key, row_hash FROM "{table_name}" '
+                   f'WHERE load_period = %s AND row_hash IS NOT NULL', (period,))
+    stored = pd.DataFrame(cursor.fetchall(), columns = ["row_key", "row_hash"], dtype = "int64")
+
+    cursor.execute(f'SELECT EXISTS (SELECT 1 FROM "{table_name}" WHERE load_period = %s AND row_hash IS NULL)',
+                   (period,))
+    unhashed = cursor.fetchone()[0]
+    return stored.set_index("row_key")["row_hash"], unhashed
+
+
+def apply_delta(data, engine, table_name, dtype_dict, period, full = False):
+    """Applies processed trade data for a month to a table as inserts, updates and deletes; see the module docstring.
+
+    :param data: Processed trade data for the month, as returned by `etl_trade_table`.
+    :type data: pandas.DataFrame
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Trade table to apply the data to.
+    :type table_name: String
+    :param dtype_dict: Dictionary of column name : SQLAlchemy type, from the table's plan.
+    :type dtype_dict: Dict
+    :param period: Month of the file the data came from, as returned by `file_period`.
+    :type period: datetime.date
+    :param full: Replace the file's rows in full rather than comparing hashes.
+    :type full: bool
+    :raises DeltaLoadError: If the table holds rows loaded without a `load_period`; see `read_row_hashes`.
+    :return: Dict with counts of `inserted`, `updated`, `deleted` and `unchanged` rows, and `months`: the set of months (their first days) whose rows changed.
+    """
+    ensure_delta_columns(engine, table_name)
+    (row_key, row_hash) = row_hashes(data, key_columns(dtype_dict))
+    data = data.assign(row_key = row_key, row_hash = row_hash, load_period = period)
+
+    # Rows dated in months without a partition would otherwise fail to insert
+    granularity = partition_granularity(engine, table_name)
+    if granularity is not None:
+        for month in data_months(data):
+            ensure_partition(engine, table_name, month, granularity)
+
+    columns = list(dtype_dict) + list(DELTA_COLUMNS)
+    staging_dtypes = {**dtype_dict, **DELTA_COLUMNS}
+    column_list = ", ".join(f'"{x}"' for x in columns)
+    measures = [x for x in dtype_dict if x not in key_columns(dtype_dict)] + ["row_hash"]
+    set_list = ", ".join(f'"{x}" = s."{x}"' for x in measures)
+
+    with stage("load", table = table_name, records = len(data)) as s:
+        conn = engine.raw_connection()
+        try:
+            with conn.cursor() as cursor:
+                (stored, unhashed) = read_row_hashes(cursor, table_name, period)
+                replace = full or unhashed
+                (updated, deleted) = (0, 0)
+
+                if replace:
+                    cursor.execute(f"SELECT DISTINCT date_trunc('month', date)::date FROM \"{table_name}\" "
+                                   f"WHERE load_period = %s AND date IS NOT NULL", (period,))
+                    months = {row[0] for row in cursor.fetchall()}
+                    cursor.execute(f'DELETE FROM "{table_name}" WHERE load_period = %s', (period,))
+                    deleted = cursor.rowcount
+                    staged = data
+                    removed = []
+                else:
+                    # Stage rows whose key is new, or stored with another hash. Only
+                    # stored keys are looked up: a month never loaded has none.
+                    position = stored.index.get_indexer(data["row_key"])
+                    known = position >= 0
+                    changed = ~known
+                    changed[known] = stored.to_numpy()[position[known]] != data["row_hash"].to_numpy()[known]
+                    staged = data[changed]
+                    removed = stored.index.difference(pd.Index(data["row_key"]))
+                    months = set()
+
+                cursor.execute(f'CREATE TEMPORARY TABLE delta_staging ON COMMIT DROP AS '
+                               f'SELECT {column_list} FROM "{table_name}" WITH NO DATA')
+                copy_dataframe(cursor, staged[columns], "delta_staging", staging_dtypes)
+
+                if not replace:
+                    cursor.execute(f'UPDATE "{table_name}" t SET {set_list} FROM delta_staging s '
+                                   f'WHERE t.load_period = s.load_period AND t.row_key = s.row_key')
+                    updated = cursor.rowcount
+                cursor.execute(f'INSERT INTO "{table_name}" ({column_list}) SELECT {column_list} FROM delta_staging s '
+                               f'WHERE NOT EXISTS (SELECT 1 FROM "{table_name}" t '
+                               f'WHERE t.load_period = s.load_period AND t.row_key = s.row_key)')
+                inserted = cursor.rowcount
+
+                if len(removed):
+                    cursor.execute("CREATE TEMPORARY TABLE delta_deleted (row_key BIGINT) ON COMMIT DROP")
+                    copy_dataframe(cursor, pd.DataFrame({"row_key": removed}), "delta_deleted",
+                                   {"row_key": BigInteger()})
+                    cursor.execute(f'DELETE FROM "{table_name}" t USING delta_deleted d '
+                                   f'WHERE t.load_period = %s AND t.row_key = d.row_key '
+                                   f'RETURNING t.date', (period,))
+                    deleted = cursor.rowcount
+                    months.update(x.replace(day = 1) for (x,) in cursor.fetchall() if x is not None)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        s.rows = len(staged) + len(removed)
+
+    # The date is a key column, so an updated row stays in its month
+    months.update(data_months(staged))
+    counts = {"inserted": inserted, "updated": updated, "deleted": deleted,
+              "unchanged": len(data) - inserted - updated, "months": months}
+    how = "Replaced" if replace else "Delta loaded"
+    print(f"{how} {table_name} for {period:%Y-%m}: {counts['inserted']} inserted, {counts['updated']} updated, "
+          f"{counts['deleted']} deleted, {counts['unchanged']} unchanged.")
+    return counts
+
+
+def delta_load_table(trade_file, engine, table_name, spec_list, recode_dict, datestring, full = False, data = None):
+    """Processes a trade file with `etl_trade_table` and applies it to its month with `apply_delta`.
+
+    The load is recorded in the load ledger, with the rows the month now holds
+    and the months whose rows it changed.
+
+    :param trade_file: Path to the Trade Data File, or a file within a zip archive.
+    :type trade_file: pathlib.Path() object, str, or ArchiveMember.
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Name of the table to apply the file to.
+    :type table_name: String
+    :param spec_list: Specification for the data file to be loaded.
+    :type spec_list: List of Dictionaries with keys `name` and `type`.
+    :param recode_dict: Dict of Dicts that specifies recoding for data columns.
+    :type recode_dict: Dictionary with keys corresponding to column names from `spec_list`.
+    :param datestring: `strptime` Date String to transform date columns.
+    :type datestring: String.
+    :param full: Replace the file's rows in full rather than comparing hashes.
+    :type full: bool
+    :param data: The file already processed by `etl_trade_table`, to load in place of running the ETL again.
+    :type data: pandas.DataFrame
+    :return: Dict with counts of `inserted`, `updated`, `deleted` and `unchanged` rows, and the `months` changed; see `apply_delta`.
+    """
+    dtype_dict = compile_plan(spec_list).dtype_dict
+    period = file_period(trade_file)
+
+    with recorded_load(engine, table_name, period, trade_file, file_checksum(trade_file)) as entry:
+        if data is None:
+            data = etl_trade_table(trade_file, spec_list, recode_dict, datestring)
+        counts = apply_delta(data, engine, table_name, dtype_dict, period, full)
+        entry["row_count"] = len(data)
+        entry["months"] = counts["months"]
+    return counts
@@ -6,96 +6,207 @@ REPOSITORY: https://github.com/LouisTsiattalou/TradeDataAPI
 DESCRIPTION:
 Update the database with each month's new data.
 
-Interesting tidbit; module imports work fine with REPL and `python3 -m
-tradedata.update.monthly_update --args`, but not `python3
-tradedata/update/monthly_update.py --args` because the latter has the current
+Run as `tradedata update --args` (see `tradedata.cli`), or `python3 -m
+tradedata.update.monthly_update --args`; not `python3
+tradedata/update/monthly_update.py --args`, because the latter has the current
 working directory set to the update folder when it runs...
 """
 
-import wget
 from pathlib import Path
-import os
 import argparse
-import json
-from tqdm import tqdm
+from datetime import datetime
 
 from tradedata.initialise.download_data import unzip_trade_data
+from tradedata.initialise.download_data import walk_archives
 from tradedata.initialise.download_data import get_hyperlinks
-from tradedata.initialise.create_database import connect_to_postgres
-from tradedata.initialise.create_database import parse_specification
-from tradedata.initialise.create_database import etl_control_table
-from tradedata.initialise.create_database import etl_trade_table
+from tradedata.initialise.download_data import create_session
+from tradedata.initialise.download_data import download_files
+from tradedata.initialise.download_data import report_downloads
+from tradedata.initialise.download_data import BASE_URL
+from tradedata.initialise.download_data import link_or_copy
+from tradedata.initialise.archive_cache import ArchiveCache
 from tradedata.initialise.create_database import load_control_table
-from tradedata.initialise.create_database import load_trade_table
-from tradedata.utils import read_credentials
+from tradedata.initialise.create_database import load_trade_table, ensure_load_period, ensure_id
+from tradedata.initialise.create_database import LOAD_METHODS
+from tradedata.initialise.create_database import file_period
+from tradedata.initialise.table_plan import load_table_plans, file_table
+from tradedata.initialise.partitions import partition_granularity, ensure_partition
+from tradedata.initialise.partitions import partition_default_rows
+from tradedata.utils import read_credentials, connect_to_postgres
+from tradedata.ledger import create_load_ledger, latest_loads
+from tradedata.rollups import refresh_load_rollups
+from tradedata.mirror.export import mirror_trade_file
+from tradedata.update.delta_load import delta_load_table
+from tradedata.metrics import add_metrics_arguments, configure_from_args
 
 
 # FUNCTIONS ####################################################################
-def download_individual_zipfiles(dest_path: str, month: str = "01", year: str = "20"):
-    """Downloads single month trade data zip files from UKTradeInfo"""
+def download_individual_zipfiles(dest_path: str, month: str = "01", year: str = "20",
+                                 workers: int = 4, base_url: str = BASE_URL):
+    """Downloads single month trade data zip files from UKTradeInfo.
 
-    links = get_hyperlinks() # Get all files by default
+    Returns a list of DownloadResult, one per archive.
+    """
+
+    session = create_session(workers)
+    links = get_hyperlinks(base_url = base_url, session = session) # Get all files by default
     links = [x for x in links if x.find(f"{year}{month}.zip") >= 0]
 
-    # Create path
-    Path(dest_path).mkdir(exist_ok=True)
-    dest_path = str(dest_path) # Ensure string for wget compatibility
+    return download_files(links, dest_path, workers = workers, session = session)
 
-    def trade_data_download(remote_file_path, destination = dest_path):
-        """Download data if it can be found. Return remote file name if exception occurs"""
-        try:
-            wget.download(remote_file_path, out = destination)
-            return None
-        except:
-            return remote_file_path
 
-    fails = []
+def fetch_month_archives(cache: ArchiveCache, month: str = "01", year: str = "20",
+                         workers: int = 4, base_url: str = BASE_URL, revalidate: bool = False):
+    """Fetches a month's zip files into the archive cache.
 
-    # Run trade_data_download func for side effect, build list of failed downloads
-    # for future inspection if necessary.
-    for link in tqdm(links):
-        fails.append(trade_data_download(link))
+    If every file prefix for the month is already cached (and `revalidate` is
+    not set), neither the index pages nor the archives are requested, so
+    re-running an update costs no network I/O.
+
+    Returns a list of DownloadResult, one per archive.
+    """
+    prefixes = ["SMKE19", "SMKI19", "SMKX46", "SMKM46", "SMKA12"]
+
+    def month_links(links):
+        return [x for x in links if x.find(f"{year}{month}.zip") >= 0]
+
+    session = create_session(workers)
+    links = month_links(cache.cached_urls())
+    cached_prefixes = {p for p in prefixes for x in links if p.lower() in x.lower()}
+    if revalidate or cached_prefixes != set(prefixes):
+        links = month_links(cache.links(base_url, lambda: get_hyperlinks(base_url = base_url,
+                                                                         session = session)))
+
+    return cache.fetch_all(links, session, workers = workers, revalidate = revalidate)
 
-    fails = [x for x in fails if x is not None]
-    if len(fails) == 0:
-        print("All Zip Files Downloaded.")
-    else:
-        print("The following Zip Files could not be downloaded:")
-        print("\n".join(fails))
 
+def link_cached_members(cache: ArchiveCache, results, dest_path: str):
+    """Links the extracted members of cached archives into `dest_path`.
 
-def check_month_in_database(engine, datestring, threshold=50000):
+    Returns a list of the paths linked, skipping archives that failed to download.
     """
-    Check tables don't have data in them already by loading # records and comparing them to threshold.
-    Returns list of tables to load for the month passed in the argument.
+    Path(dest_path).mkdir(parents = True, exist_ok = True)
+    paths = []
+    for result in results:
+        if result.path is not None:
+            for member in cache.extract(result.url):
+                paths.append(link_or_copy(member, dest_path))
+    return paths
+
+
+def fetch_month_from_cache(cache: ArchiveCache, dest_path: str, month: str = "01", year: str = "20",
+                           workers: int = 4, base_url: str = BASE_URL, revalidate: bool = False):
+    """Fetches a month's zip files through the archive cache and links their extracted members into `dest_path`.
+
+    See `fetch_month_archives`; returns a list of DownloadResult, one per archive.
     """
+    results = fetch_month_archives(cache, month, year, workers, base_url, revalidate)
+    link_cached_members(cache, results, dest_path)
+    return results
 
-    def return_monthly_records(engine, table_name, datestring):
-        """Query Database to return monthly records from Postgres"""
-        with engine.connect() as conn:
-            records = conn.execute(f"SELECT COUNT(date) FROM {table_name} WHERE date = '{datestring}'")
-            records = records.fetchone()[0]
-        return records
 
-    table_records = {}
-    for table in ["exports", "imports", "dispatches", "arrivals"]:
-        records = return_monthly_records(engine, table, datestring)
-        table_records[table] = records
+def check_month_in_database(engine, datestring):
+    """
+    Check which tables already hold the month's data, according to the load ledger.
+    Returns list of tables to load for the month passed in the argument.
 
-    # Check for tables to load in update according to threshold and return.
-    tables_to_load = ["control"] + [table for (table,records) in table_records.items() if records < threshold]
-    [print(f"{table} has already been loaded ({records} records); skipping load.")
-     for (table,records) in table_records.items()
-     if records >= threshold]
+    A table is skipped only if its latest ledger entry for the month completed;
+    loads that failed or were interrupted ("loading") are reported and loaded again.
+    """
+    period = datetime.strptime(datestring, "%Y%m%d").date()
+    trade_tables = ["exports", "imports", "dispatches", "arrivals"]
+    loads = latest_loads(engine, trade_tables, period)
+
+    tables_to_load = ["control"]
+    for table in trade_tables:
+        entry = loads.get((table, period))
+        if entry is None:
+            tables_to_load.append(table)
+        elif entry["status"] == "complete":
+            source = entry["source_file"] or "rows loaded before the ledger"
+            print(f"{table} has already been loaded ({entry['row_count']} records from {source}); skipping load.")
+        else:
+            print(f"{table} has a partial load ({entry['status']}, started {entry['started_at']}); loading again.")
+            tables_to_load.append(table)
 
     return tables_to_load
 
 
+def load_trade_partition(trade_file, engine, table_name, spec_list, recode_dict, datestring, **kwargs):
+    """Loads a trade file, replacing the rows of any earlier load of the same file.
+
+    A file holds rows dated in months other than its own (late declarations,
+    the EU 13th month), so the earlier load's rows are found by their
+    `load_period` rather than by date, and deleted in the same transaction as
+    the file is loaded. On a partitioned table each row goes to the partition
+    of its own date: the partition for the file's month is created before the
+    load, and rows dated in months without a partition are moved out of the
+    default partition into new ones after it. Keyword arguments are passed on
+    to `load_trade_table`.
+
+    Returns the number of rows loaded.
+    """
+    ensure_load_period(engine, table_name)
+    ensure_id(engine, table_name)
+    granularity = partition_granularity(engine, table_name)
+    if granularity is not None:
+        ensure_partition(engine, table_name, file_period(trade_file), granularity)
+
+    rows = load_trade_table(trade_file, engine, table_name, spec_list, recode_dict, datestring,
+                            replace = True, **kwargs)
+    if granularity is not None:
+        partition_default_rows(engine, table_name, granularity)
+    return rows
+
+
+def load_trade_file(trade_file, engine, table_name, plan, delta = False, mirror_dir = None,
+                    method = "copy", chunksize = None, data = None):
+    """Loads a trade file, and refreshes what is derived from it: the rollups of every month it changed, and its rows in the Parquet mirror.
+
+    Both the monthly update and `tradedata.update.backfill` load each file with this.
+
+    :param trade_file: Path to the Trade Data File, or a file within a zip archive.
+    :type trade_file: pathlib.Path() object, str, or ArchiveMember.
+    :param engine: SQLAlchemy PostgreSQL Engine class.
+    :type engine: SQLAlchemy Engine class `sqlalchemy.engine.base.Engine`.
+    :param table_name: Trade table the file belongs to.
+    :type table_name: String
+    :param plan: The table's plan, from `load_table_plans`.
+    :type plan: tradedata.initialise.table_plan.TablePlan
+    :param delta: Apply only the rows that changed with `delta_load_table`, rather than replacing the file's rows with `load_trade_partition`.
+    :type delta: bool
+    :param mirror_dir: Root of the Parquet mirror to write the file's rows to; None leaves the mirror alone.
+    :type mirror_dir: pathlib.Path() object, or str.
+    :param method: One of `LOAD_METHODS`, passed to `load_trade_table`.
+    :type method: String.
+    :param chunksize: Rows per chunk to stream the file in, passed to `load_trade_table` and `mirror_trade_file`.
+    :type chunksize: int
+    :param data: The file already processed by `etl_trade_table`, to load in place of running the ETL again.
+    :type data: pandas.DataFrame
+    :return: Number of rows in the file.
+    """
+    spec_list, recode_dict, date_format = plan.spec_list, plan.recode_dict, plan.date_format
+    if delta:
+        counts = delta_load_table(trade_file, engine, table_name, spec_list, recode_dict, date_format, data = data)
+        rows = counts["inserted"] + counts["updated"] + counts["unchanged"]
+    else:
+        rows = load_trade_partition(trade_file, engine, table_name, spec_list, recode_dict, date_format,
+                                    method = method, chunksize = chunksize, data = data)
+
+    # Rebuild only the months of the table's rollups the file changed, and its rows in the Parquet mirror
+    refresh_load_rollups(engine, table_name, file_period(trade_file))
+    if mirror_dir is not None:
+        mirror_trade_file(trade_file, mirror_dir, table_name, spec_list, recode_dict, date_format,
+                          chunksize = chunksize, data = data)
+    return rows
+
+
 # MAIN #########################################################################
-if __name__ == '__main__':
+def main(argv = None, prog = None):
+    """Entry point of `tradedata update`; `argv` defaults to the command line."""
 
     # Parse Arguments
-    parser = argparse.ArgumentParser(description="Load a recent month's trade data to the database.")
+    parser = argparse.ArgumentParser(prog = prog, description="Load a recent month's trade data to the database.")
     parser.add_argument("-t", "--target",
                         help="Target directory for the files. Created if it does not exist.",
                         required = True, default = 'data/monthlyupdate/')
@@ -105,54 +216,64 @@ if __name__ == '__main__':
     parser.add_argument("-m", "--month",
                         help="Month to be downloaded; 2 digit string.",
                         required = True, default = '01')
+    parser.add_argument("--load_method", choices = LOAD_METHODS,
+                        help="How trade tables are loaded; `copy` bulk loads through Postgres COPY, `to_sql` uses pandas INSERTs.",
+                        default = 'copy')
+    parser.add_argument("--cache_dir",
+                        help="Archive cache directory; cached months are not downloaded again.",
+                        default = 'data/cache/')
+    parser.add_argument("--no_cache", action = "store_true",
+                        help="Download and unzip straight into the target directory, bypassing the archive cache.")
+    parser.add_argument("--revalidate", action = "store_true",
+                        help="Check cached archives are current with a conditional GET.")
+    parser.add_argument("--from_archives", action = "store_true",
+                        help="With --no_cache, parse trade files straight from the downloaded zips instead of unzipping them.")
+    parser.add_argument("--chunksize", type=int,
+                        help="Stream trade files in chunks of this many rows to bound memory use.",
+                        default = None)
+
+    parser.add_argument("--delta", action = "store_true",
+                        help="Apply each trade file as row level inserts, updates and deletes against the month already loaded (e.g. for revised months), rather than skipping loaded tables.")
+    parser.add_argument("--mirror_dir",
+                        help="Also write each trade file loaded to this Parquet mirror (see tradedata.mirror).",
+                        default = None)
+    add_metrics_arguments(parser)
 
     # Params
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
+    configure_from_args(args)
     data_dir = args.target
     data_year= args.year
     data_month = args.month
+    load_method = args.load_method
+    chunksize = args.chunksize
 
     # Handle %Y format (YYYY)
     if len(data_year) == 4:
         data_year = data_year[2:]
 
-    # DATA REFERENCES ====================================================================
-    # Table - Table Specification JSON filepath mapping
-    table_specs = {
-        "control":"data/lookups/controlfilecols.json",
-        "exports":"data/lookups/noneuexportcols.json",
-        "imports":"data/lookups/noneuimportcols.json",
-        "dispatches":"data/lookups/eutradecols.json",
-        "arrivals":"data/lookups/eutradecols.json"
-    }
-
-    # Table Specification Loads
-    controlfilecols = json.loads(open(table_specs["control"], "r").read())
-    eutradecols = json.loads(open(table_specs["arrivals"], "r").read())
-    noneuimportcols = json.loads(open(table_specs["imports"], "r").read())
-    noneuexportcols = json.loads(open(table_specs["exports"], "r").read())
-
-    # Trade File Abbreviation - Table Name mapping
-    trade_files = {
-        "SMKA12":"control",                               # Commodity Lookups
-        "SMKE19":"exports", "SMKI19":"imports",           # Non EU Trade
-        "SMKX46":"dispatches", "SMKM46": "arrivals"       # EU Trade
-    }
-
-    # Recoding Dicts
-    recode_inland_mot = json.loads(open("data/lookups/recode_mode_of_transport.json", "r").read())
-    recode_border_mot = {"0"+x:y for (x,y) in recode_inland_mot.items()}
+    # DATA REFERENCES ==================================================================
+    # Compiled plan per table: specification, recoding and date format
+    plans = load_table_plans("data/lookups")
 
 
     # DOWNLOAD DATA ======================================================================
     update_path = Path(data_dir)
+    update_path.mkdir(parents = True, exist_ok = True)
     for f in update_path.glob("*"): # Clearout
         if f.is_file():
             f.unlink()
 
-    download_individual_zipfiles(update_path, month = data_month, year = data_year)
-
-    unzip_trade_data(update_path)
+    if args.no_cache:
+        results = download_individual_zipfiles(update_path, month = data_month, year = data_year)
+        report_downloads(results)
+        if not args.from_archives:
+            unzip_trade_data(update_path)
+    else:
+        cache = ArchiveCache(args.cache_dir)
+        results = fetch_month_from_cache(cache, update_path, month = data_month, year = data_year,
+                                         revalidate = args.revalidate)
+        report_downloads(results)
 
     # CHECK DATABASE FOR UPDATE ==========================================================
     # Connect to Database
@@ -163,40 +284,40 @@ if __name__ == '__main__':
 
     # Return table names if they don't contain data arg year/month combination
     datestring = f"20{data_year}{data_month}01"
-    tables_to_load = check_month_in_database(engine, datestring, 50000)
+    create_load_ledger(engine)
+    if args.delta:
+        tables_to_load = list(plans)
+    else:
+        tables_to_load = check_month_in_database(engine, datestring)
 
     # LOAD DATA TO DATABASE ==============================================================
     # Load Files
-    files = [x for x in update_path.glob("*") if x.is_file()]
-    files.sort()
+    if args.no_cache and args.from_archives:
+        files = walk_archives(update_path)
+    else:
+        files = [x for x in update_path.glob("*") if x.is_file()]
+        files.sort()
 
     files_to_load = []
     for f in files:
-        if trade_files[f.stem[0:6].upper()] in tables_to_load:
+        if file_table(f) in tables_to_load:
             files_to_load.append(f)
 
     # Load to Database
     for trade_file in files_to_load:
-        file_type = trade_file.stem[0:6].upper()
-        table_name = trade_files[file_type]
+        table_name = file_table(trade_file)
+        plan = plans[table_name]
         print(f"Processing {trade_file}...")
 
         if table_name == "control":
-            load_control_table(trade_file, engine, controlfilecols["columns"])
+            load_control_table(trade_file, engine, plan.spec_list)
+            continue
 
-        elif table_name == "dispatches" or table_name == "arrivals":
-            recode_dict = {}
-            load_trade_table(trade_file, engine, table_name,
-                             eutradecols["columns"], recode_dict, "0%Y%m")
+        load_trade_file(trade_file, engine, table_name, plan, delta = args.delta, mirror_dir = args.mirror_dir,
+                        method = load_method, chunksize = chunksize)
 
-        elif table_name == "imports":
-            recode_dict = {"border_mot":recode_border_mot, "inland_mot":recode_inland_mot}
-            load_trade_table(trade_file, engine, table_name,
-                             noneuimportcols["columns"], recode_dict, "%m/%Y")
+    print("Monthly Update Completed Successfully!")
 
-        elif table_name == "exports":
-            recode_dict = {"border_mot":recode_border_mot, "inland_mot":recode_inland_mot}
-            load_trade_table(trade_file, engine, table_name,
-                             noneuexportcols["columns"], recode_dict, "%m/%Y")
 
-    print("Monthly Update Completed Successfully!")
+if __name__ == '__main__':
+    main()
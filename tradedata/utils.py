@@ -1,7 +1,66 @@
-from pathlib import Path
+import io
+import zipfile
+from collections import namedtuple
+from pathlib import Path, PurePosixPath
 import yaml
+from sqlalchemy import create_engine
 
 def read_credentials(path_to_file: str = "conf/credentials.yml") -> dict:
     """Read Credentials in yaml format."""
     credentials = yaml.safe_load(Path(path_to_file).read_text())
     return(credentials)
+
+
+def connect_to_postgres(username = "", password = "", host = "localhost", database = ""):
+    """Returns a SQLAlchemy PostgreSQL engine using psycopg2"""
+    engine = create_engine(f'postgresql+psycopg2://{username}:{password}@{host}/{database}')
+    return engine
+
+
+def open_zip_chain(archive, members=()):
+    """Opens a zip archive, descending through any nested zips named in `members`.
+
+    Nested archives are read into memory (compressed) rather than extracted to disk.
+    """
+    z = zipfile.ZipFile(archive)
+    for member in members:
+        z = zipfile.ZipFile(io.BytesIO(z.read(member)))
+    return z
+
+
+class ArchiveMember(namedtuple("ArchiveMember", ["archive", "members"])):
+    """A data file inside a zip archive, possibly within nested zips.
+
+    `archive` is the path of the outermost zip on disk, and `members` the chain
+    of member names leading to the file, e.g. `("SMKE192001.zip", "SMKE192001")`.
+    Has the `name` and `stem` of the file so it can stand in for a
+    pathlib.Path in the ETL functions, and can be pickled to worker processes.
+    """
+    __slots__ = ()
+
+    @property
+    def name(self):
+        return PurePosixPath(self.members[-1]).name
+
+    @property
+    def stem(self):
+        return PurePosixPath(self.members[-1]).stem
+
+    def open(self):
+        """Returns a binary stream of the decompressed file."""
+        return open_zip_chain(self.archive, self.members[:-1]).open(self.members[-1])
+
+    def __str__(self):
+        return "!".join([str(self.archive)] + list(self.members))
+
+
+def data_path(path):
+    """Returns `path` as a pathlib.Path, or unchanged if it is an ArchiveMember."""
+    return path if isinstance(path, ArchiveMember) else Path(path)
+
+
+def open_data_file(path, encoding="utf-8", newline=None):
+    """Opens a data file on disk or inside an archive as a text stream."""
+    if isinstance(path, ArchiveMember):
+        return io.TextIOWrapper(path.open(), encoding=encoding, newline=newline)
+    return open(path, "r", encoding=encoding, newline=newline)